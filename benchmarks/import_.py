@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Benchmark POST /releases/import
+
+Generates release documents, as another system would export them, and times
+importing them into the database configured in orlo.ini. The import is timed
+through the test client, so includes parsing the JSON document. The previous
+import, one release and one commit at a time, is timed on a sample of the
+releases for comparison. Run against an empty, disposable database, e.g.:
+
+    ORLO_CONFIG=/tmp/bench.ini python benchmarks/import_.py --releases 100000
+
+With --stream, the releases are instead uploaded to /releases/import/stream
+as newline delimited JSON, generated as the endpoint reads it, and the peak
+resident memory of the process is printed. It should not grow with the number
+of releases.
+"""
+from __future__ import print_function
+import argparse
+import json
+import random
+import time
+
+import arrow
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from orlo.app import app
+from orlo.cache import bump_data_version
+from orlo.config import config
+from orlo.orm import db, Release, Package, ReleaseNote
+from orlo.rollup import track_releases
+from orlo.util import append_or_create_platforms
+
+__author__ = 'alforbes'
+
+
+def iter_documents(n_releases, n_packages, n_platforms, per_release=3,
+                   seed=None):
+    """
+    Yield generated release documents, a year of history
+    """
+    rand = random.Random(seed)
+    start = arrow.utcnow().replace(days=-365)
+    statuses = ['SUCCESSFUL'] * 8 + ['FAILED', 'IN_PROGRESS']
+    for i in range(0, n_releases):
+        stime = start.replace(seconds=i * 365 * 86400 // n_releases)
+        yield {
+            'platforms': ['platform{}'.format(i % n_platforms)],
+            'user': 'user{}'.format(i % 50),
+            'team': 'team{}'.format(i % 10),
+            'stime': stime.isoformat(),
+            'ftime': stime.replace(minutes=5).isoformat(),
+            'references': ['TICKET-{}'.format(i)],
+            'notes': ['Imported from other_system'],
+            'packages': [{
+                'name': 'package{}'.format(rand.randrange(n_packages)),
+                'version': '1.0.{}'.format(i),
+                'status': rand.choice(statuses),
+                'rollback': rand.random() < 0.05,
+                # Unix time, as exports often have
+                'stime': stime.timestamp,
+                'ftime': stime.replace(minutes=1).timestamp,
+            } for _ in range(0, per_release)],
+        }
+
+
+def documents(n_releases, n_packages, n_platforms):
+    """
+    Return a list of generated release documents
+    """
+    return list(iter_documents(n_releases, n_packages, n_platforms))
+
+
+class NdjsonStream(object):
+    """
+    File-like object of release documents as newline delimited JSON, which
+    are generated as it is read
+    """
+    def __init__(self, documents):
+        self.lines = ((json.dumps(d) + '\n').encode('utf-8')
+                      for d in documents)
+        self.buffer = b''
+
+    def readline(self, size=-1):
+        if not self.buffer:
+            self.buffer = next(self.lines, b'')
+        if 0 <= size < len(self.buffer):
+            line, self.buffer = self.buffer[:size], self.buffer[size:]
+        else:
+            line, self.buffer = self.buffer, b''
+        return line
+
+    def read(self, size=-1):
+        data = b''
+        while size < 0 or len(data) < size:
+            line = self.readline(-1 if size < 0 else size - len(data))
+            if not line:
+                break
+            data += line
+        return data
+
+
+def legacy(releases):
+    """
+    The previous import, a release at a time
+    """
+    for r in releases:
+        release = Release(
+            platforms=append_or_create_platforms(r['platforms']),
+            user=r['user'],
+            team=r.get('team'),
+            references=json.dumps(r['references']),
+        )
+        with track_releases(release.id):
+            release.stime = arrow.get(r['stime'])
+            release.ftime = arrow.get(r['ftime'])
+            release.duration = release.ftime - release.stime
+            for n in r['notes']:
+                db.session.add(ReleaseNote(release.id, n))
+            for p in r['packages']:
+                package = Package(release_id=release.id, name=p['name'],
+                                  version=p['version'])
+                package.rollback = p['rollback']
+                package.status = p['status']
+                package.stime = arrow.get(p['stime'])
+                package.ftime = arrow.get(p['ftime'])
+                package.duration = package.ftime - package.stime
+                db.session.add(package)
+            db.session.add(release)
+        bump_data_version()
+        db.session.commit()
+
+
+def bulk(releases):
+    """
+    The current import, through the endpoint
+    """
+    response = app.test_client().post(
+        '/releases/import', data=json.dumps(releases),
+        content_type='application/json')
+    assert response.status_code == 200, response.data
+
+
+def stream(args):
+    """
+    Import through /releases/import/stream, and print the peak memory of the
+    process
+    """
+    import resource
+
+    def upload():
+        return NdjsonStream(iter_documents(
+            args.releases, args.packages, args.platforms, seed=0))
+    # The length of the upload, without holding it in memory
+    length = 0
+    for line in upload().lines:
+        length += len(line)
+
+    # The test client only takes a stream it can seek, so the request is
+    # made directly
+    environ = EnvironBuilder('/releases/import/stream', method='POST',
+                             content_type='application/x-ndjson').get_environ()
+    environ['wsgi.input'] = upload()
+    environ['CONTENT_LENGTH'] = str(length)
+
+    start = time.time()
+    body, status, _ = run_wsgi_app(app, environ, buffered=True)
+    elapsed = time.time() - start
+    # KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert status.startswith('200'), body
+    print('{:<8} {:>8} releases {:>9.2f}s {:>9.0f}/s {:>9.1f} MB peak, '
+          '{} MB uploaded'.format(
+              'stream', json.loads(b''.join(body))['imported'], elapsed,
+              args.releases / elapsed, peak / 1024.0,
+              length // 1024 ** 2))
+
+
+def run(name, function, releases):
+    """
+    Print the time and rate of an import
+    """
+    start = time.time()
+    function(releases)
+    elapsed = time.time() - start
+    print('{:<8} {:>8} releases {:>9.2f}s {:>9.0f}/s'.format(
+        name, len(releases), elapsed, len(releases) / elapsed))
+    return elapsed / len(releases)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--releases', type=int, default=100000)
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--platforms', type=int, default=5)
+    parser.add_argument('--legacy', type=int, default=1000,
+                        help='Releases to import the previous way')
+    parser.add_argument('--chunk-size')
+    parser.add_argument('--stream', action='store_true',
+                        help='Import through /releases/import/stream')
+    args = parser.parse_args()
+
+    if args.chunk_size:
+        config.set('import', 'chunk_size', args.chunk_size)
+    # If recorded, as when testing, every statement of the request is kept
+    # until it ends
+    app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+    db.create_all()
+    if args.stream:
+        return stream(args)
+
+    per_release = {}
+    if args.legacy:
+        per_release['legacy'] = run('legacy', legacy, documents(
+            args.legacy, args.packages, args.platforms))
+    per_release['bulk'] = run('bulk', bulk, documents(
+        args.releases, args.packages, args.platforms))
+    if args.legacy:
+        print('{:.1f}x'.format(per_release['legacy'] / per_release['bulk']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Benchmark the hot queries with and without the join and filter indexes
+
+Creates the schema in the database configured in orlo.ini, fills it with a
+generated dataset, then for each query prints the plan and timing without the
+indexes added in revision 7c3f5d1e9a42, and again with them. Run against an
+empty, disposable database, e.g.:
+
+    ORLO_CONFIG=/tmp/bench.ini python benchmarks/indexes.py --releases 100000
+
+The composite primary key on release_platform is left in place throughout,
+only the secondary indexes are dropped for the "before" run.
+"""
+from __future__ import print_function
+import argparse
+import datetime
+from collections import OrderedDict
+import random
+import time
+import uuid
+
+import arrow
+from sqlalchemy import inspect
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from orlo import queries
+from orlo.orm import db, Release, Package, ReleaseNote, ReleaseMetadata, \
+    ReleaseReference, PackageResult, Platform, release_platform
+
+__author__ = 'alforbes'
+
+INDEX_NAMES = [
+    'ix_package_release_id_status_rollback',
+    'ix_package_name_status_stime',
+    'ix_package_result_package_id',
+    'ix_release_metadata_release_id',
+    'ix_release_note_release_id',
+    'ix_release_platform_platform_id',
+    'ix_release_team',
+    'ix_release_user',
+]
+
+
+def indexes():
+    """
+    Return the Index objects to drop and recreate
+    """
+    found = dict((index.name, index)
+                 for table in db.Model.metadata.tables.values()
+                 for index in table.indexes)
+    return [found[name] for name in INDEX_NAMES]
+
+
+def index_exists(index):
+    """
+    Whether an index is in the database, e.g. after an interrupted run
+    """
+    return index.name in [i['name'] for i in
+                          inspect(db.engine).get_indexes(index.table.name)]
+
+
+def generate(n_releases, n_packages, n_platforms, batch_size=5000):
+    """
+    Insert a generated dataset
+    """
+    platforms = [{'id': uuid.uuid4(), 'name': 'platform{}'.format(i)}
+                 for i in range(0, n_platforms)]
+    db.session.bulk_insert_mappings(Platform, platforms)
+
+    start = arrow.utcnow().replace(days=-365)
+    statuses = ['SUCCESSFUL'] * 8 + ['FAILED', 'IN_PROGRESS']
+    for offset in range(0, n_releases, batch_size):
+        releases, packages, notes, metadata, references, results, links = \
+            [], [], [], [], [], [], []
+        for i in range(offset, min(offset + batch_size, n_releases)):
+            release_id = uuid.uuid4()
+            stime = start.replace(seconds=i * 365 * 86400 // n_releases)
+            releases.append({
+                'id': release_id, 'stime': stime,
+                'ftime': stime.replace(minutes=5),
+                'duration': datetime.timedelta(minutes=5),
+                'user': 'user{}'.format(i % 50),
+                'team': 'team{}'.format(i % 10),
+                'references': '["TICKET-{}"]'.format(i),
+            })
+            references.append({'id': uuid.uuid4(), 'release_id': release_id,
+                               'reference': 'TICKET-{}'.format(i),
+                               'position': 0})
+            links.append({'release_id': release_id,
+                          'platform_id': random.choice(platforms)['id']})
+            for _ in range(0, random.randint(1, 3)):
+                package_id = uuid.uuid4()
+                packages.append({
+                    'id': package_id, 'release_id': release_id,
+                    'name': 'package{}'.format(random.randint(0, n_packages)),
+                    'version': '1.0.{}'.format(i),
+                    'stime': stime, 'ftime': stime.replace(minutes=5),
+                    'duration': datetime.timedelta(minutes=5),
+                    'status': random.choice(statuses),
+                    'rollback': random.random() < 0.05,
+                })
+                results.append({'id': uuid.uuid4(), 'package_id': package_id,
+                                'content': 'ok'})
+            notes.append({'id': uuid.uuid4(), 'release_id': release_id,
+                          'content': 'note {}'.format(i)})
+            metadata.append({'id': uuid.uuid4(), 'release_id': release_id,
+                             'key': 'env', 'value': 'prod'})
+        db.session.bulk_insert_mappings(Release, releases)
+        db.session.execute(release_platform.insert(), links)
+        db.session.bulk_insert_mappings(Package, packages)
+        db.session.bulk_insert_mappings(PackageResult, results)
+        db.session.bulk_insert_mappings(ReleaseNote, notes)
+        db.session.bulk_insert_mappings(ReleaseMetadata, metadata)
+        db.session.bulk_insert_mappings(ReleaseReference, references)
+        db.session.commit()
+        print('Inserted {} releases'.format(offset + len(releases)))
+
+
+def benchmark_queries():
+    """
+    Return (name, query) for the queries to time
+    """
+    release_id = db.session.query(Release.id).limit(1).scalar()
+    package_id = db.session.query(Package.id).limit(1).scalar()
+    return [
+        ('stats by package', queries.release_stats('package')),
+        ('stats by platform', queries.release_stats('platform')),
+        ('releases by user', queries.apply_filters(
+            db.session.query(Release), {'user': 'user7'})),
+        ('releases by team', queries.apply_filters(
+            db.session.query(Release), {'team': 'team3'})),
+        ('releases by platform', queries.apply_filters(
+            db.session.query(Release), {'platform': 'platform1'})),
+        ('packages of a release', db.session.query(Package)
+            .filter(Package.release_id == release_id)),
+        ('notes of a release', db.session.query(ReleaseNote)
+            .filter(ReleaseNote.release_id == release_id)),
+        ('metadata of a release', db.session.query(ReleaseMetadata)
+            .filter(ReleaseMetadata.release_id == release_id)),
+        ('results of a package', db.session.query(PackageResult)
+            .filter(PackageResult.package_id == package_id)),
+        ('package versions', queries.package_versions()),
+        ('successful release filter', queries.filter_release_status(
+            db.session.query(Release.id), 'SUCCESSFUL')),
+    ]
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN of a statement, which keeps the statement's bound parameters
+    """
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kwargs):
+    if compiler.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN'
+    else:
+        prefix = 'EXPLAIN'
+    return '{} {}'.format(prefix, compiler.process(element.statement, **kwargs))
+
+
+def explain(query):
+    """
+    Return the plan of a query as text
+    """
+    # Read the cursor directly, the statement's result types do not apply
+    rows = db.session.execute(Explain(query.statement)).cursor.fetchall()
+    return '\n'.join('    ' + ' '.join(str(c) for c in row) for row in rows)
+
+
+def run(label, repeat):
+    """
+    Print the plan and best time of each query
+    """
+    print('\n==== {} ===='.format(label))
+    timings = OrderedDict()
+    for name, query in benchmark_queries():
+        best = None
+        for _ in range(0, repeat):
+            start = time.time()
+            query.all()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print('\n{}: {:.4f}s'.format(name, best))
+        print(explain(query))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--releases', type=int, default=100000)
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--platforms', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    db.create_all()
+    if db.session.query(Release.id).first() is None:
+        generate(args.releases, args.packages, args.platforms)
+
+    for index in indexes():
+        if index_exists(index):
+            index.drop(db.engine)
+    db.session.execute('ANALYZE')
+    db.session.commit()
+    before = run('Without indexes', args.repeat)
+
+    for index in indexes():
+        index.create(db.engine)
+    db.session.execute('ANALYZE')
+    db.session.commit()
+    after = run('With indexes', args.repeat)
+
+    print('\n==== Summary ====')
+    print('{:<28} {:>10} {:>10}'.format('', 'before', 'after'))
+    for name in before:
+        print('{:<28} {:>9.4f}s {:>9.4f}s {:>7.1f}x'.format(
+            name, before[name], after[name],
+            before[name] / after[name] if after[name] else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
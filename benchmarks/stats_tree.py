@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Benchmark building the /stats/by_date tree
+
+Feeds rows shaped like those of stats.add_objects_by_time_to_dict, i.e.
+year/month/day/hour/package/category, into stats.append_tree. Run from the
+repository root with orlo installed:
+
+    python benchmarks/stats_tree.py --rows 1000000
+
+With --legacy, also times the previous recursive implementation, which
+formatted the whole tree into a debug message on every call. It is quadratic
+in the size of the tree, so use it with a small number of rows.
+"""
+from __future__ import print_function
+import argparse
+import itertools
+import logging
+import time
+
+from orlo.app import app
+from orlo.stats import append_tree
+
+__author__ = 'alforbes'
+
+CATEGORIES = [
+    ('normal', 'successful'), ('normal', 'failed'),
+    ('rollback', 'successful'), ('rollback', 'failed'),
+]
+
+
+def legacy_append_tree_recursive(tree, parent, nodes, node_index=0):
+    """
+    The implementation append_tree replaced
+    """
+    app.logger.debug('Called recursive function with args:\n{}, {}, {}'.format(
+        str(tree), str(parent), str(nodes)))
+
+    child_index = node_index + 1
+    try:
+        child = nodes[child_index]
+    except IndexError:
+        if parent in tree:
+            tree[parent] += 1
+        else:
+            tree[parent] = 1
+        return tree
+
+    if parent not in tree:
+        tree[parent] = {}
+    legacy_append_tree_recursive(tree[parent], child, nodes,
+                                 node_index=child_index)
+
+
+def rows(n, packages):
+    """
+    Generate n rows of tree nodes, spread over hours, packages and categories
+    """
+    hours = itertools.cycle(range(0, 24 * 365))
+    for i in range(0, n):
+        hour = next(hours)
+        day, hour = divmod(hour, 24)
+        month, day = divmod(day, 28)
+        nodes = ['2016', str(month + 1), str(day + 1), str(hour),
+                 'package-{}'.format(i % packages)]
+        nodes.extend(CATEGORIES[i % len(CATEGORIES)])
+        yield nodes
+
+
+def run(name, function, n, packages):
+    tree = {}
+    start = time.time()
+    for nodes in rows(n, packages):
+        function(tree, nodes)
+    elapsed = time.time() - start
+    print('{:<10} {:>9} rows {:>8.2f}s {:>10.0f} rows/s'.format(
+        name, n, elapsed, n / elapsed if elapsed else float('inf')))
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--packages', type=int, default=20)
+    parser.add_argument('--legacy', type=int, default=0, metavar='ROWS',
+                        help='Also time the recursive implementation')
+    args = parser.parse_args()
+
+    # As in production, debug messages are not emitted
+    app.logger.setLevel(logging.INFO)
+
+    run('iterative', append_tree, args.rows, args.packages)
+    if args.legacy:
+        tree = run('iterative', append_tree, args.legacy, args.packages)
+        legacy_tree = run(
+            'recursive',
+            lambda t, nodes: legacy_append_tree_recursive(t, nodes[0], nodes),
+            args.legacy, args.packages)
+        assert tree == legacy_tree
+
+
+if __name__ == '__main__':
+    main()
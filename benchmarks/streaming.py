@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Benchmark serving GET /releases with one execution of the query
+
+Times streaming a filtered set of releases as get_releases did before, where
+the query was executed, counted and then iterated, against peeking at the
+first result of a single execution. Uses the database configured in
+orlo.ini, generating a dataset as benchmarks/indexes.py does if it is empty:
+
+    ORLO_CONFIG=/tmp/bench.ini python benchmarks/streaming.py \\
+        --filter reference=TICKET-1999 --limit 100
+
+The saving is largest for filters which are expensive to evaluate. On SQLite
+the legacy execute only runs the query up to its first row, so the saving is
+smaller than on Postgres, where each execution runs the query to completion.
+"""
+from __future__ import print_function
+import argparse
+import gc
+import time
+
+from orlo import queries
+from orlo.orm import db, Release
+from orlo.util import peek, stream_json_list
+
+from indexes import generate
+
+__author__ = 'alforbes'
+
+
+def legacy(query):
+    """
+    The previous request path, three executions of the query
+    """
+    db.session.execute(query)
+    if query.count() == 0:
+        return 0
+    return sum(len(s) for s in stream_json_list('releases', query))
+
+
+def single(query):
+    """
+    The current request path, one execution
+    """
+    first, results = peek(query)
+    if first is None:
+        return 0
+    return sum(len(s) for s in stream_json_list('releases', results))
+
+
+def run(functions, filters, repeat):
+    """
+    Print the best time of each function, alternating between them
+    """
+    best = dict((name, None) for name, _ in functions)
+    for _ in range(0, repeat):
+        for name, function in functions:
+            query = queries.build_query(Release, **filters)
+            gc.collect()
+            start = time.time()
+            size = function(query)
+            elapsed = time.time() - start
+            if best[name] is None or elapsed < best[name]:
+                best[name] = elapsed
+    for name, _ in functions:
+        print('{:<8} {:>12} bytes {:>9.4f}s'.format(name, size, best[name]))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--releases', type=int, default=100000)
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--platforms', type=int, default=5)
+    parser.add_argument('--filter', action='append', default=[],
+                        metavar='FIELD=VALUE',
+                        help='Filter as for /releases, may be repeated')
+    parser.add_argument('--limit', default='1000')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    db.create_all()
+    if db.session.query(Release.id).first() is None:
+        generate(args.releases, args.packages, args.platforms)
+
+    filters = dict(f.split('=', 1) for f in args.filter)
+    filters['limit'] = args.limit
+    print('Filters: {}'.format(filters))
+
+    best = run([('legacy', legacy), ('single', single)], filters, args.repeat)
+    print('{:.1f}x'.format(best['legacy'] / best['single']
+                           if best['single'] else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
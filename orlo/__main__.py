@@ -14,7 +14,8 @@ from orlo.exceptions import OrloStartupError
 
 from orlo.config import config
 from orlo.app import app, OrloApplication, alembic
-from orlo.orm import db
+from orlo.orm import db, rebuild_current_versions
+from orlo import rollup
 
 
 __author__ = 'alforbes'
@@ -69,6 +70,8 @@ class Start(Command):
             console else '-',
             'loglevel': loglevel or config.get('logging', 'level'),
             'on_starting': on_starting,
+            'timeout': config.get('gunicorn', 'timeout'),
+            'worker_class': config.get('gunicorn', 'worker_class'),
             'workers': workers or config.get('gunicorn', 'workers'),
         }
         try:
@@ -93,9 +96,41 @@ class WriteConfig(Command):
         config.write(config_file)
 
 
+class RebuildStats(Command):
+    """
+    Rebuild the release stats rollup from the release and package tables
+    """
+    option_list = (
+        Option('-b', '--batch-size', default=1000, type=int,
+               dest='batch_size', help="Number of releases to read at a time"),
+    )
+
+    def run(self, batch_size):
+        """ Rebuild the rollup """
+        rows = rollup.rebuild(batch_size=batch_size)
+        print('Rebuilt release stats rollup, {} rows'.format(rows))
+
+
+class RebuildVersions(Command):
+    """
+    Rebuild the package current versions from the release and package tables
+    """
+    option_list = (
+        Option('-b', '--batch-size', default=1000, type=int,
+               dest='batch_size', help="Number of releases to read at a time"),
+    )
+
+    def run(self, batch_size):
+        """ Rebuild the current versions """
+        rows = rebuild_current_versions(batch_size=batch_size)
+        print('Rebuilt package current versions, {} rows'.format(rows))
+
+
 script_manager = Manager(app)
 script_manager.add_command('db', alembic_script)
 script_manager.add_command('start', Start)
+script_manager.add_command('rebuild_stats', RebuildStats)
+script_manager.add_command('rebuild_versions', RebuildVersions)
 
 
 def on_starting(server):
@@ -0,0 +1 @@
+__version__ = '0.4.3'
\ No newline at end of file
@@ -0,0 +1,414 @@
+from __future__ import print_function
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from flask import request, Response
+from sqlalchemy import event, exc
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import make_transient_to_detached
+from orlo.app import app
+from orlo.config import config
+from orlo.orm import db, DataVersion, Platform
+
+__author__ = 'alforbes'
+
+"""
+Caching of responses to read-only endpoints, and of the queries behind them
+
+Responses are cached per process, and stored along with the data version, a
+counter in the database which write paths increment with bump_data_version.
+A cached response is served only while the data version is unchanged, so
+serving it costs one query rather than the queries of the endpoint.
+
+Queries are cached as compiled SQL with bound parameters, see
+StatementCache. They do not depend on the data, so are always cached.
+
+Platform ids are cached by name, see PlatformCache.
+"""
+
+DATA_VERSION_ID = 1
+
+
+def enabled():
+    """
+    Whether responses are cached
+    """
+    return config.getboolean('cache', 'enabled')
+
+
+def current_data_version():
+    """
+    Return the current data version, 0 if it has never been bumped
+    """
+    version = db.session.query(DataVersion.version) \
+        .filter(DataVersion.id == DATA_VERSION_ID).scalar()
+    return version or 0
+
+
+def bump_data_version():
+    """
+    Increment the data version, invalidating cached responses
+
+    Call this in the same transaction as a write to release data. It does
+    nothing if the cache is disabled, to save writers contending on the row.
+    """
+    if not enabled():
+        return
+    updated = db.session.query(DataVersion) \
+        .filter(DataVersion.id == DATA_VERSION_ID) \
+        .update({DataVersion.version: DataVersion.version + 1},
+                synchronize_session=False)
+    if not updated:
+        db.session.add(DataVersion(id=DATA_VERSION_ID, version=1))
+
+
+class ResponseCache(object):
+    """
+    Least recently used cache of responses, with hit and miss counters
+    """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        """
+        Return the entry for a key, if it is for this version and not expired
+
+        :param key: Cache key
+        :param int version: The current data version
+        :return: (data, status, mimetype) or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_version, expires, response = entry
+                if entry_version == version and expires > time.time():
+                    # Most recently used go to the end
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return response
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, version, response):
+        """
+        Store a response for a key and version
+
+        :param key: Cache key
+        :param int version: The data version the response was built from
+        :param tuple response: (data, status, mimetype)
+        """
+        expires = time.time() + config.getint('cache', 'ttl')
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, expires, response)
+            while len(self.entries) > config.getint('cache', 'max_size'):
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def to_dict(self):
+        return {
+            'enabled': enabled(),
+            'size': len(self.entries),
+            'max_size': config.getint('cache', 'max_size'),
+            'ttl': config.getint('cache', 'ttl'),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+response_cache = ResponseCache()
+
+
+class StatementCache(object):
+    """
+    Least recently used cache of queries, built and compiled once per shape
+
+    A shape is a key for the SQL a set of steps produces, regardless of the
+    values of its bound parameters. The query, its compiled SQL and loading
+    context are kept in a SQLAlchemy baked query bakery. The hit and miss
+    counts are of the shapes this cache has seen.
+    """
+    def __init__(self, max_size):
+        self.bakery = baked.bakery(size=max_size)
+        self.max_size = max_size
+        self.shapes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def query(self, session, entity, shape, steps, params):
+        """
+        Return the results of a query, built from the steps on a miss
+
+        :param session: Session to run the query in
+        :param entity: The entity to query, e.g. Release
+        :param shape: Hashable key, which must identify the SQL the steps
+            produce
+        :param list steps: Functions which each take and return a Query
+        :param dict params: Values of the bound parameters
+        :return: sqlalchemy.ext.baked.Result
+        """
+        with self.lock:
+            if shape in self.shapes:
+                del self.shapes[shape]
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.shapes[shape] = True
+            while len(self.shapes) > self.max_size:
+                self.shapes.popitem(last=False)
+
+        # The steps are only called when the shape is not in the bakery
+        baked_query = self.bakery(lambda s: s.query(entity), shape)
+        for step in steps:
+            baked_query += step
+        return baked_query(session).params(params)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters
+        """
+        with self.lock:
+            self.bakery.cache.clear()
+            self.shapes.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def to_dict(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.shapes),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else None,
+        }
+
+
+statement_cache = StatementCache(config.getint('cache', 'statements'))
+
+
+class PlatformCache(object):
+    """
+    Ids of platforms by name, and creation of missing platforms
+
+    Platforms are only created, never changed, by orlo, so the id of a
+    committed platform stays valid. Ids learned in a transaction which has
+    created platforms are kept on the session until it commits, so that a
+    rollback can not leave ids in the cache which were never committed. The
+    cache is cleared when the platform table is created or dropped, or a
+    platform is deleted or renamed through the ORM.
+    """
+    # Keys in Session.info
+    CREATED = 'orlo_platforms_created'
+    PENDING = 'orlo_platform_ids'
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_ids(self, session, names, create=False):
+        """
+        Return the ids of the platforms with the given names
+
+        Names which are not cached are looked up in one query.
+
+        :param session: Session to run the queries in
+        :param names: Platform names
+        :param boolean create: Create the platforms which do not exist
+        :return: dict of id by name, without any names which are not platforms
+        """
+        names = set(names)
+        pending = session.info.get(self.PENDING, {})
+        with self.lock:
+            ids = dict((n, self.entries[n]) for n in names
+                       if n in self.entries)
+            ids.update((n, pending[n]) for n in names
+                       if n in pending and n not in ids)
+            self.hits += len(ids)
+            self.misses += len(names) - len(ids)
+
+        missing = names - set(ids)
+        if missing:
+            found = self._select(session, missing)
+            ids.update(found)
+            missing -= set(found)
+        if missing and create:
+            app.logger.info("Creating platforms %s", ', '.join(sorted(missing)))
+            session.info[self.CREATED] = True
+            self._insert_missing(session, missing)
+            ids.update(self._select(session, missing))
+        return ids
+
+    def get_platforms(self, session, names):
+        """
+        Return Platform objects for the given names, creating any which do
+        not exist, without loading them
+
+        :param session: Session to add the platforms to
+        :param list names: Platform names, repeats are returned once
+        :return: list of Platform objects, in the order of the names
+        """
+        ids = self.get_ids(session, names, create=True)
+        platforms = []
+        for name in OrderedDict.fromkeys(names):
+            platform = Platform(name)
+            platform.id = ids[name]
+            make_transient_to_detached(platform)
+            # Or the instance already in the session
+            platforms.append(session.merge(platform, load=False))
+        return platforms
+
+    def _select(self, session, names):
+        """
+        Look up platforms by name, and cache their ids
+        """
+        ids = dict((name, platform_id) for platform_id, name in
+                   session.query(Platform.id, Platform.name)
+                   .filter(Platform.name.in_(list(names))))
+        if session.info.get(self.CREATED):
+            session.info.setdefault(self.PENDING, {}).update(ids)
+        else:
+            with self.lock:
+                self.entries.update(ids)
+        return ids
+
+    @staticmethod
+    def _insert_missing(session, names):
+        """
+        Insert platforms, skipping any which another transaction has inserted
+        since they were looked up
+        """
+        table = Platform.__table__
+        # In order, so that concurrent inserts wait on each other rather
+        # than deadlock
+        rows = [{'id': uuid.uuid4(), 'name': name} for name in sorted(names)]
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            session.execute(postgresql.insert(table)
+                            .on_conflict_do_nothing(index_elements=['name']),
+                            rows)
+        elif dialect == 'sqlite':
+            session.execute(table.insert().prefix_with('OR IGNORE'), rows)
+        elif dialect == 'mysql':
+            session.execute(table.insert().prefix_with('IGNORE'), rows)
+        else:
+            for row in rows:
+                try:
+                    with session.begin_nested():
+                        session.execute(table.insert(), row)
+                except exc.IntegrityError:
+                    pass
+
+    def commit(self, session):
+        """
+        Cache the ids learned in a session's transaction, once it commits
+        """
+        with self.lock:
+            self.entries.update(session.info.get(self.PENDING, {}))
+
+    def end(self, session, nested=False):
+        """
+        Forget what a session's transaction learned, on commit or rollback
+
+        :param boolean nested: Whether the transaction is a savepoint, within
+            a transaction which may still have created platforms
+        """
+        session.info.pop(self.PENDING, None)
+        if not nested:
+            session.info.pop(self.CREATED, None)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def to_dict(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+platform_cache = PlatformCache()
+
+
+@event.listens_for(db.session, 'after_commit')
+def cache_platforms_after_commit(session):
+    # Not a savepoint, which the enclosing transaction could yet roll back
+    if session.transaction.parent is None:
+        platform_cache.commit(session)
+
+
+@event.listens_for(db.session, 'after_transaction_end')
+def forget_platforms_after_transaction(session, transaction):
+    if transaction.parent is None or transaction.nested:
+        platform_cache.end(session, transaction.nested)
+
+
+@event.listens_for(Platform, 'after_update')
+@event.listens_for(Platform, 'after_delete')
+def clear_platforms_after_change(mapper, connection, target):
+    platform_cache.clear()
+
+
+@event.listens_for(Platform.__table__, 'after_create')
+@event.listens_for(Platform.__table__, 'after_drop')
+def clear_platforms_after_ddl(target, connection, **kwargs):
+    platform_cache.clear()
+
+
+def request_key():
+    """
+    Return the cache key for the current request, the path and sorted args
+    """
+    return request.path, tuple(sorted(request.args.items(multi=True)))
+
+
+def cached_response(func):
+    """
+    Decorator which caches the responses of a view, if the cache is enabled
+
+    Only 200 responses are cached.
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if not enabled():
+            return func(*args, **kwargs)
+
+        key = request_key()
+        version = current_data_version()
+        cached = response_cache.get(key, version)
+        if cached is not None:
+            data, status, mimetype = cached
+            return Response(data, status=status, mimetype=mimetype)
+
+        response = app.make_response(func(*args, **kwargs))
+        if response.status_code == 200:
+            response_cache.set(key, version, (
+                response.get_data(), response.status_code, response.mimetype))
+        return response
+    return wrapped
@@ -31,6 +31,8 @@ config.set('main', 'base_url', 'http://localhost:8080')
 config.add_section('gunicorn')
 config.set('gunicorn', 'workers', '2')
 config.set('gunicorn', 'bind', '127.0.0.1:8080')
+config.set('gunicorn', 'worker_class', 'sync')
+config.set('gunicorn', 'timeout', '30')
 
 config.add_section('security')
 config.set('security', 'enabled', 'false')
@@ -64,4 +66,19 @@ config.set('logging', 'directory', defaults['ORLO_LOGDIR'])  # "disabled" for no
 config.add_section('behaviour')
 config.set('behaviour', 'versions_by_release', 'false')
 
+config.add_section('stats')
+config.set('stats', 'rollup', 'false')
+config.set('stats', 'parallel', 'false')
+config.set('stats', 'workers', '4')
+
+config.add_section('cache')
+config.set('cache', 'enabled', 'false')
+config.set('cache', 'ttl', '60')
+config.set('cache', 'max_size', '1000')
+config.set('cache', 'statements', '200')
+
+config.add_section('import')
+config.set('import', 'chunk_size', '1000')
+config.set('import', 'max_errors', '100')
+
 config.read(defaults['ORLO_CONFIG'])
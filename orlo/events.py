@@ -0,0 +1,156 @@
+from __future__ import print_function
+import uuid
+from orlo.app import app
+from orlo.exceptions import OrloError, InvalidUsage
+from orlo.orm import db, Release, Package, ReleaseNote, ReleaseMetadata
+from orlo.rollup import track_releases
+from orlo.util import chunks, is_uuid
+
+__author__ = 'alforbes'
+
+"""
+Workflow events, applied in batches which can span many releases
+
+Each event does what one of the workflow endpoints does, e.g. a package_stop
+event what POST /releases/<id>/packages/<id>/stop does. The releases and
+packages a batch refers to are fetched up front, a few queries for the whole
+batch, and the events then applied to them in order. Whatever they change is
+written by one flush, which runs the usual hooks.
+"""
+
+# Ids per query when fetching the rows a batch refers to
+FETCH_CHUNK_SIZE = 500
+
+
+def _release_start(event, release, package):
+    release.start()
+
+
+def _release_stop(event, release, package):
+    release.stop()
+
+
+def _package_start(event, release, package):
+    package.start()
+
+
+def _package_stop(event, release, package):
+    package.stop(success=event.get('success') in [True, 'True', 'true', '1'])
+
+
+def _release_note(event, release, package):
+    if not event.get('text'):
+        raise InvalidUsage("A release_note event must include text")
+    db.session.add(ReleaseNote(release.id, event['text']))
+
+
+def _release_metadata(event, release, package):
+    if not isinstance(event.get('metadata'), dict) or not event['metadata']:
+        raise InvalidUsage("A release_metadata event must include metadata")
+    for key, value in event['metadata'].items():
+        db.session.add(ReleaseMetadata(release.id, key, value))
+
+
+# Event types, the function applying each, and whether it is of a package
+EVENT_TYPES = {
+    'release_start': (_release_start, False),
+    'release_stop': (_release_stop, False),
+    'package_start': (_package_start, True),
+    'package_stop': (_package_stop, True),
+    'release_note': (_release_note, False),
+    'release_metadata': (_release_metadata, False),
+}
+
+
+def validate_event(event):
+    """
+    Check an event names a type, and the release and package it needs
+
+    :raises InvalidUsage: If it does not
+    """
+    if not isinstance(event, dict):
+        raise InvalidUsage("An event must be a JSON object")
+    if event.get('type') not in EVENT_TYPES:
+        raise InvalidUsage("Invalid event type, {} is not in {}".format(
+            event.get('type'), sorted(EVENT_TYPES)))
+    if not is_uuid(str(event.get('release_id'))):
+        raise InvalidUsage("Event missing a valid release_id")
+    if EVENT_TYPES[event['type']][1] and \
+            not is_uuid(str(event.get('package_id'))):
+        raise InvalidUsage("Event missing a valid package_id")
+
+
+def fetch_all(model, ids):
+    """
+    Fetch the objects with the given ids, a chunk of ids per query
+
+    :return: dict of id to object
+    """
+    objects = {}
+    for chunk in chunks(sorted(set(ids)), FETCH_CHUNK_SIZE):
+        for instance in db.session.query(model).filter(model.id.in_(chunk)):
+            objects[instance.id] = instance
+    return objects
+
+
+def _apply(event, error, releases, packages):
+    """
+    Apply one event of a batch, and return its outcome
+    """
+    try:
+        if error is not None:
+            raise InvalidUsage(error)
+        function, of_package = EVENT_TYPES[event['type']]
+        release = releases.get(uuid.UUID(str(event['release_id'])))
+        if release is None:
+            raise InvalidUsage("Release does not exist")
+        package = None
+        if of_package:
+            package = packages.get(uuid.UUID(str(event['package_id'])))
+            if package is None:
+                raise InvalidUsage("Package does not exist")
+            if package.release_id != release.id:
+                raise InvalidUsage(
+                    "This package does not belong to this release")
+        function(event, release, package)
+    except OrloError as error:
+        return {'ok': False, 'message': error.message}
+    return {'ok': True}
+
+
+def apply_events(events):
+    """
+    Apply a batch of events in order, without committing
+
+    An event which is invalid, refers to a release or package which does not
+    exist, or breaks the workflow, e.g. stopping a package which has not
+    started, is not applied. The events after it still are.
+
+    The rollup is updated for every release the batch refers to.
+
+    :param list events: Event objects, see post_events
+    :return: list of the outcome of each event, in order, with ok whether it
+        was applied, and message why not
+    """
+    errors = {}
+    for index, event in enumerate(events):
+        try:
+            validate_event(event)
+        except InvalidUsage as error:
+            errors[index] = error.message
+    valid = [e for i, e in enumerate(events) if i not in errors]
+    releases = fetch_all(
+        Release, [uuid.UUID(str(e['release_id'])) for e in valid])
+    packages = fetch_all(
+        Package, [uuid.UUID(str(e['package_id'])) for e in valid
+                  if EVENT_TYPES[e['type']][1]])
+
+    outcomes = []
+    with track_releases(*releases):
+        for index, event in enumerate(events):
+            outcomes.append(_apply(event, errors.get(index), releases,
+                                   packages))
+
+    app.logger.info("Applied {} of {} events to {} releases".format(
+        len([o for o in outcomes if o['ok']]), len(outcomes), len(releases)))
+    return outcomes
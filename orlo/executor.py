@@ -0,0 +1,77 @@
+from __future__ import print_function
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from orlo.app import app
+from orlo.config import config
+from orlo.orm import db
+
+__author__ = 'alforbes'
+
+"""
+Concurrent execution of independent read-only queries
+
+Each query runs on its own connection from the engine's pool, outside of the
+session, so it does not see changes the session has not committed. Only use
+this for queries which do not depend on the current transaction.
+"""
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Whether queries are run concurrently
+
+    Never on SQLite, where connections to an in-memory database share one
+    underlying connection.
+    """
+    return config.getboolean('stats', 'parallel') and \
+        db.engine.dialect.name != 'sqlite'
+
+
+def get_executor():
+    """
+    Return the thread pool, creating it on first use, and again if the
+    number of workers configured has changed
+    """
+    global _executor, _executor_workers
+    workers = config.getint('stats', 'workers')
+    with _executor_lock:
+        if _executor is None or workers != _executor_workers:
+            if _executor is not None:
+                # Queries already submitted still run
+                _executor.shutdown(wait=False)
+            app.logger.info("Starting query executor with %s workers",
+                            workers)
+            _executor = ThreadPoolExecutor(max_workers=workers)
+            _executor_workers = workers
+        return _executor
+
+
+def _fetch_all(statement):
+    """
+    Execute a statement on a connection of its own, and return all rows
+    """
+    with db.engine.connect() as connection:
+        return connection.execute(statement).fetchall()
+
+
+def run_queries(queries, concurrent=None):
+    """
+    Run queries and return the rows of each, in the order given
+
+    :param list queries: Query objects
+    :param boolean concurrent: Run the queries on the thread pool. Defaults to
+        enabled()
+    :return: list of lists of rows
+    """
+    if concurrent is None:
+        concurrent = enabled()
+    if not concurrent or len(queries) < 2:
+        return [query.all() for query in queries]
+
+    futures = [get_executor().submit(_fetch_all, query.statement)
+               for query in queries]
+    return [future.result() for future in futures]
@@ -0,0 +1,444 @@
+from __future__ import print_function
+import datetime
+import re
+import uuid
+import arrow
+from sqlalchemy import and_, bindparam, exists, inspect, select, Boolean, \
+    Enum, Interval
+from sqlalchemy_utils.types.arrow import ArrowType
+from sqlalchemy_utils.types.uuid import UUIDType
+from orlo.app import app
+from orlo.cache import platform_cache
+from orlo.exceptions import InvalidUsage
+from orlo.orm import db, Release, Package, ReleaseMetadata, \
+    ReleaseReference, release_platform, value_hash
+
+__author__ = 'alforbes'
+
+"""
+Compile filter arguments, as GET /releases and /packages take, into clauses
+
+An argument names a field, optionally followed by an operator, e.g. user,
+stime_after or package_duration_gt. All the arguments are checked against the
+fields of the object queried before any clause is built.
+
+Filters on rows related to a release are subqueries, never joins, so that a
+release is returned at most once. The package_ filters are merged into one
+subquery, which a single package has to match all of. A subquery is a
+semi-join, release.id IN (...), when it compares an indexed column with a
+value, as that seeks the index. Otherwise it is an EXISTS, correlated with
+the release, which stops at the first matching row.
+"""
+
+OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'gt': lambda column, value: column > value,
+    'lt': lambda column, value: column < value,
+}
+
+# Argument suffixes, and the operator each stands for
+SUFFIXES = {
+    'gt': 'gt',
+    'lt': 'lt',
+    'before': 'lt',
+    'after': 'gt',
+}
+
+NULLS = ('null', 'none')
+
+
+def convert_time(value):
+    """
+    Convert a time argument to an Arrow
+    """
+    try:
+        return arrow.get(value)
+    except (RuntimeError, TypeError, ValueError):
+        # arrow's ParserError is a RuntimeError
+        raise InvalidUsage("Invalid time: {}".format(value))
+
+
+def convert_duration(value):
+    """
+    Convert a duration argument in seconds to a timedelta
+    """
+    if isinstance(value, datetime.timedelta):
+        return value
+    try:
+        return datetime.timedelta(seconds=int(value))
+    except (TypeError, ValueError):
+        raise InvalidUsage(
+            "Invalid duration, expected seconds: {}".format(value))
+
+
+def convert_boolean(value):
+    """
+    Convert a boolean argument, as util.str_to_bool does
+    """
+    if value is True or value is False:
+        return value
+    if str(value).lower() in ('t', 'true', '1'):
+        return True
+    if str(value).lower() in ('f', 'false', '0'):
+        return False
+    raise InvalidUsage("Invalid boolean: {}".format(value))
+
+
+def convert_uuid(value):
+    """
+    Convert a UUID argument
+    """
+    try:
+        return value if isinstance(value, uuid.UUID) else uuid.UUID(value)
+    except (AttributeError, TypeError, ValueError):
+        raise InvalidUsage("Invalid UUID: {}".format(value))
+
+
+def convert_platform(value):
+    """
+    Convert a platform name to its id, so that the filter need not join the
+    platform table
+
+    A name which is not a platform is the nil UUID, which matches nothing.
+    """
+    ids = platform_cache.get_ids(db.session, [value])
+    return ids.get(value, uuid.UUID(int=0))
+
+
+class Relation(object):
+    """
+    Rows related to a release, which filters on them are a subquery of
+
+    :param link: Column of the rows which holds the release id
+    :param select_from: Selectable the rows are in, if not the link's table
+    :param list conditions: Further clauses on the rows, e.g. a metadata key
+    :param boolean null_is_absent: Whether filtering on null matches
+        releases without any rows, rather than rows where the column is null
+    """
+    def __init__(self, link, select_from=None, conditions=None,
+                 null_is_absent=False):
+        self.link = link
+        self.select_from = select_from if select_from is not None \
+            else link.table
+        self.conditions = conditions or []
+        self.null_is_absent = null_is_absent
+
+    def clause(self, predicates, bind):
+        """
+        Return the subquery clause for all the predicates on the relation
+
+        :param list predicates: Predicate objects
+        :param bind: Function returning the clause for a parameter name
+        """
+        absent = self.null_is_absent and \
+            any(p.value is None for p in predicates)
+        conditions = self.conditions + [
+            p.clause(bind) for p in predicates
+            if not (self.null_is_absent and p.value is None)]
+        if not absent and any(p.seeks() for p in predicates):
+            return Release.id.in_(
+                select([self.link]).select_from(self.select_from)
+                .where(and_(*conditions)))
+        clause = exists(
+            select([self.link]).select_from(self.select_from)
+            .where(and_(self.link == Release.id, *conditions)))
+        return ~clause if absent else clause
+
+
+PACKAGES = Relation(Package.release_id)
+PLATFORMS = Relation(release_platform.c.release_id, null_is_absent=True)
+REFERENCES = Relation(ReleaseReference.release_id, null_is_absent=True)
+
+# Release statuses filtered on a flag rather than on Release.status, which
+# match releases with any package in progress, and with all their packages
+# successful, including releases without packages
+RELEASE_STATUS_FLAGS = {
+    'IN_PROGRESS': Release.any_in_progress,
+    'SUCCESSFUL': Release.all_successful,
+}
+
+
+def release_status_clause(status):
+    """
+    Return the clause filtering releases on a status, as the status filter
+    does
+    """
+    if status in RELEASE_STATUS_FLAGS:
+        return RELEASE_STATUS_FLAGS[status] == True
+    return Release.status == status
+
+
+class FilterField(object):
+    """
+    A field which can be filtered on
+
+    :param column: Column compared with the value
+    :param tuple operators: Operators the field takes, keys of OPERATORS
+    :param convert: Function converting an argument to the column's type,
+        which raises InvalidUsage if it can not
+    :param Relation relation: Rows the column is in, or None for the object
+        queried
+    :param boolean indexed: Whether an index leads with the column, or with
+        its hash_column
+    :param dict flags: Boolean column to filter on instead, for values which
+        do not compare with the column
+    :param hash_column: Column holding a hash of the column, which is indexed
+        as values can be too long for an index. Equality is compared on both.
+    :param hash_value: Function returning the hash of a value
+    """
+    def __init__(self, column, operators=('eq',), convert=None,
+                 relation=None, indexed=False, flags=None, hash_column=None,
+                 hash_value=None):
+        self.column = column
+        self.operators = operators
+        self.convert = convert
+        self.relation = relation
+        self.indexed = indexed
+        self.flags = flags or {}
+        self.hash_column = hash_column
+        self.hash_value = hash_value
+
+
+class Predicate(object):
+    """
+    A filter argument, parsed and converted
+    """
+    def __init__(self, argument, field, operator, name, value):
+        self.argument = argument
+        self.field = field
+        self.operator = operator
+        self.name = name
+        self.value = value
+
+    def clause(self, bind):
+        if self.value is None:
+            return self.field.column.is_(None)
+        if self.value in self.field.flags:
+            return self.field.flags[self.value] == True
+        clause = OPERATORS[self.operator](self.field.column, bind(self.name))
+        if self.field.hash_column is not None and self.operator == 'eq':
+            return and_(self.field.hash_column == bind(self.name + '_hash'),
+                        clause)
+        return clause
+
+    def bound(self):
+        """
+        Whether the value is a bound parameter, rather than part of the SQL
+        """
+        return self.value is not None and self.value not in self.field.flags
+
+    def params(self):
+        """
+        Return the values of the bound parameters of the clause
+        """
+        if not self.bound():
+            return {}
+        params = {self.name: self.value}
+        if self.field.hash_column is not None and self.operator == 'eq':
+            params[self.name + '_hash'] = self.field.hash_value(self.value)
+        return params
+
+    def seeks(self):
+        """
+        Whether the predicate can be looked up in an index
+        """
+        return self.operator == 'eq' and self.value is not None and \
+            self.field.indexed
+
+
+def enum_converter(name, enums):
+    """
+    Return a function which checks an argument is one of the values of an enum
+    """
+    def convert(value):
+        if value not in enums:
+            raise InvalidUsage("Invalid {}, {} is not in {}".format(
+                name, value, str(enums)))
+        return value
+    return convert
+
+
+def column_fields(model, relation=None):
+    """
+    Return a FilterField for each column of a model, by attribute name
+    """
+    table = model.__table__
+    leading = set(index.columns.values()[0] for index in table.indexes)
+    fields = {}
+    for attribute in inspect(model).column_attrs:
+        column = attribute.columns[0]
+        column_type = column.type
+        if isinstance(column_type, ArrowType):
+            operators, convert = ('eq', 'gt', 'lt'), convert_time
+        elif isinstance(column_type, Interval):
+            operators, convert = ('eq', 'gt', 'lt'), convert_duration
+        elif isinstance(column_type, Boolean):
+            operators, convert = ('eq',), convert_boolean
+        elif isinstance(column_type, UUIDType):
+            operators, convert = ('eq',), convert_uuid
+        elif isinstance(column_type, Enum):
+            operators, convert = ('eq',), enum_converter(
+                attribute.key, column_type.enums)
+        else:
+            operators, convert = ('eq',), None
+        fields[attribute.key] = FilterField(
+            getattr(model, attribute.key), operators, convert, relation,
+            indexed=column.primary_key or column in leading)
+    return fields
+
+
+def release_fields():
+    """
+    Return the FilterFields of a release, other than those with a prefix
+    """
+    fields = column_fields(Release)
+    fields['rollback'] = fields['has_rollback']
+    fields['status'].flags = RELEASE_STATUS_FLAGS
+    for flag in RELEASE_STATUS_FLAGS.values():
+        del fields[flag.key]
+    fields['platform'] = FilterField(release_platform.c.platform_id,
+                                     convert=convert_platform,
+                                     relation=PLATFORMS, indexed=True)
+    fields['reference'] = FilterField(
+        ReleaseReference.reference, relation=REFERENCES, indexed=True,
+        hash_column=ReleaseReference.reference_hash, hash_value=value_hash)
+    return fields
+
+
+# Filters on each type of object. Fields of a release's packages take a
+# package_ prefix.
+RELEASE_FIELDS = release_fields()
+PACKAGE_FIELDS = column_fields(Package)
+RELEASE_PACKAGE_FIELDS = column_fields(Package, PACKAGES)
+
+
+def metadata_field(key):
+    """
+    Return the FilterField for the value of a metadata key
+    """
+    return FilterField(
+        ReleaseMetadata.value,
+        relation=Relation(ReleaseMetadata.release_id,
+                          conditions=[ReleaseMetadata.key == key],
+                          null_is_absent=True),
+        indexed=True, hash_column=ReleaseMetadata.key_value_hash,
+        hash_value=lambda value: value_hash(key, value))
+
+
+def find_field(argument, fields):
+    """
+    Return the field and operator an argument names, or (None, None)
+    """
+    if argument in fields:
+        return fields[argument], 'eq'
+    base, _, suffix = argument.rpartition('_')
+    if base in fields and suffix in SUFFIXES:
+        return fields[base], SUFFIXES[suffix]
+    return None, None
+
+
+class CompiledFilters(object):
+    """
+    The predicates of a set of filter arguments
+
+    :ivar tuple shape: (argument, whether the value is bound, the value if
+        it is not) of each predicate, which determines the SQL of the clauses
+    :ivar dict params: Value of each bound parameter
+    """
+    def __init__(self, predicates):
+        self.predicates = predicates
+        self.shape = tuple(
+            (p.argument, p.bound(), None if p.bound() else p.value)
+            for p in predicates)
+        self.params = {}
+        for predicate in predicates:
+            self.params.update(predicate.params())
+
+    def clauses(self, bind=None):
+        """
+        Return the clauses to filter a query with
+
+        :param bind: Function returning the clause for a parameter name, e.g.
+            sqlalchemy.bindparam, to supply the values when the query is run.
+            Defaults to parameters holding the values.
+        :return: list of clauses
+        """
+        if bind is None:
+            def bind(name):
+                return bindparam(name, self.params[name], unique=True)
+
+        clauses = []
+        relations = []
+        by_relation = {}
+        for predicate in self.predicates:
+            relation = predicate.field.relation
+            if relation is None:
+                clauses.append(predicate.clause(bind))
+            elif relation in by_relation:
+                by_relation[relation].append(predicate)
+            else:
+                relations.append(relation)
+                by_relation[relation] = [predicate]
+        for relation in relations:
+            clauses.append(relation.clause(by_relation[relation], bind))
+        return clauses
+
+
+def compile_filters(object_type, args, packages_joined=False):
+    """
+    Parse and check filter arguments
+
+    :param object_type: Release or Package, the object queried
+    :param dict args: Filter arguments, e.g. from request.args
+    :param boolean packages_joined: For Release filters on a query of
+        packages joined to their releases. The package_ arguments then filter
+        the packages queried, rather than any package of the release.
+    :return: CompiledFilters
+    """
+    release = object_type is Release
+    if release:
+        package_fields = PACKAGE_FIELDS if packages_joined \
+            else RELEASE_PACKAGE_FIELDS
+    elif any(a.startswith('package_') for a in args):
+        raise InvalidUsage(
+            "'package_' parameters are only valid for Release queries. "
+            "(hint: retry without the package_ prefix)")
+
+    predicates = []
+    for argument in sorted(args):
+        if release and argument == 'latest':  # this is not a comparison
+            continue
+        if release and argument.startswith('metadata_'):
+            field, operator = metadata_field(argument[len('metadata_'):]), \
+                'eq'
+        elif release and argument.startswith('package_'):
+            field, operator = find_field(argument[len('package_'):],
+                                         package_fields)
+        else:
+            field, operator = find_field(
+                argument, RELEASE_FIELDS if release else PACKAGE_FIELDS)
+        if field is None:
+            raise InvalidUsage(
+                "An invalid field for table {} was specified: {}".format(
+                    object_type.__tablename__, argument))
+        if operator not in field.operators:
+            raise InvalidUsage("{} does not take {}".format(
+                argument, argument.rpartition('_')[2]))
+
+        value = args[argument]
+        if hasattr(value, 'lower') and value.lower() in NULLS:
+            value = None
+        if value is None:
+            if operator != 'eq':
+                raise InvalidUsage(
+                    "{} can not be compared with null".format(argument))
+        elif field.convert:
+            value = field.convert(value)
+
+        # Metadata keys can contain anything, which not all drivers accept
+        # in a parameter name
+        name = 'filter_' + argument if re.match(r'^\w+$', argument) \
+            else 'filter_{}'.format(len(predicates))
+        app.logger.debug("Filtering: %s %s %s", argument, operator, value)
+        predicates.append(Predicate(argument, field, operator, name, value))
+    return CompiledFilters(predicates)
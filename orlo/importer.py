@@ -0,0 +1,379 @@
+from __future__ import print_function
+import codecs
+import json
+import re
+import uuid
+from orlo.app import app
+from orlo.cache import platform_cache, bump_data_version
+from orlo.config import config
+from orlo.exceptions import InvalidUsage
+from orlo.orm import db, Release, Package, ReleaseNote, ReleaseReference, \
+    release_platform, release_status, update_current_versions, value_hash
+from orlo.rollup import track_releases
+from orlo.util import chunks, parse_time
+from six import string_types
+
+__author__ = 'alforbes'
+
+"""
+Import of releases in bulk, see POST /releases/import
+
+Releases are written a chunk at a time. The platforms of a chunk are looked
+up together, then each table is written with one INSERT executed with the
+rows of the whole chunk, and the chunk is committed. The inserts bypass the
+ORM, so what its hooks maintain is written explicitly for each chunk: the
+release status with the release rows, then the current versions and rollup.
+"""
+
+STATUSES = Package.status.property.columns[0].type.enums
+
+# Bytes of a streamed JSON array read at a time
+READ_SIZE = 64 * 1024
+# Largest release document in a streamed JSON array, in characters
+MAX_ITEM_SIZE = 4 * 1024 * 1024
+
+
+def _list(value):
+    """
+    Return a list field of a document as a list, a single value being a list
+    of one
+    """
+    if value is None:
+        return []
+    if isinstance(value, string_types):
+        return [value]
+    return list(value)
+
+
+class ReleaseRows(object):
+    """
+    The rows to insert for a release document
+
+    :param dict document: A release, as documented in post_import
+    :raises InvalidUsage: If the document is invalid
+    """
+    def __init__(self, document):
+        if not isinstance(document, dict):
+            raise InvalidUsage("A release must be a JSON object")
+        if not document.get('user'):
+            raise InvalidUsage("Release missing user")
+        if not document.get('platforms'):
+            raise InvalidUsage("Release missing platforms")
+
+        self.id = uuid.uuid4()
+        self.platforms = _list(document['platforms'])
+        if not all(isinstance(p, string_types) for p in self.platforms):
+            raise InvalidUsage("Platforms must be strings")
+        references = _list(document.get('references'))
+        stime = parse_time(document.get('stime'), 'stime')
+        ftime = parse_time(document.get('ftime'), 'ftime')
+
+        self.packages = [self._package(p, stime)
+                         for p in _list(document.get('packages'))]
+        self.references = [
+            {'id': uuid.uuid4(), 'release_id': self.id, 'reference': r,
+             'reference_hash': value_hash(r), 'position': position}
+            for position, r in enumerate(references)]
+        self.notes = [
+            {'id': uuid.uuid4(), 'release_id': self.id, 'content': n}
+            for n in _list(document.get('notes'))]
+
+        statuses = set(p['status'] for p in self.packages)
+        self.release = {
+            'id': self.id,
+            'references': json.dumps(references) if references else None,
+            'stime': stime,
+            'ftime': ftime,
+            'duration': ftime - stime if stime and ftime else None,
+            'user': document['user'],
+            'team': document.get('team'),
+            # As update_release_status would set them
+            'status': release_status(*[s in statuses for s in (
+                'FAILED', 'IN_PROGRESS', 'SUCCESSFUL', 'NOT_STARTED')]),
+            'has_rollback': any(p['rollback'] for p in self.packages),
+            'any_in_progress': 'IN_PROGRESS' in statuses,
+            'all_successful': statuses <= {'SUCCESSFUL'},
+        }
+        self.successful = 'SUCCESSFUL' in statuses
+
+    def _package(self, document, release_stime):
+        if not isinstance(document, dict):
+            raise InvalidUsage("A package must be a JSON object")
+        if document.get('name') is None or document.get('version') is None:
+            raise InvalidUsage("Package missing name / version")
+        status = document.get('status') or 'NOT_STARTED'
+        if status not in STATUSES:
+            raise InvalidUsage("Invalid package status, {} is not in {}".format(
+                status, str(STATUSES)))
+        stime = parse_time(document.get('stime'), 'stime') or release_stime
+        ftime = parse_time(document.get('ftime'), 'ftime')
+        return {
+            'id': uuid.uuid4(),
+            'release_id': self.id,
+            'name': document['name'],
+            'version': document['version'],
+            'diff_url': document.get('diff_url'),
+            'rollback': bool(document.get('rollback')),
+            'status': status,
+            'stime': stime,
+            'ftime': ftime,
+            'duration': ftime - stime if stime and ftime else None,
+        }
+
+
+def insert_releases(releases):
+    """
+    Insert releases, without committing
+
+    :param list releases: ReleaseRows
+    """
+    session = db.session()
+    release_ids = [r.id for r in releases]
+    platform_ids = platform_cache.get_ids(
+        session, set(name for r in releases for name in r.platforms),
+        create=True)
+
+    with track_releases(*release_ids):
+        session.execute(Release.__table__.insert(),
+                        [r.release for r in releases])
+        links = set((r.id, platform_ids[name])
+                    for r in releases for name in r.platforms)
+        session.execute(release_platform.insert(), [
+            {'release_id': release_id, 'platform_id': platform_id}
+            for release_id, platform_id in links])
+        for table, attribute in (
+                (ReleaseReference.__table__, 'references'),
+                (ReleaseNote.__table__, 'notes'),
+                (Package.__table__, 'packages')):
+            rows = [row for r in releases for row in getattr(r, attribute)]
+            if rows:
+                session.execute(table.insert(), rows)
+
+        # The status is inserted as update_release_status would set it, so
+        # only the current versions are left to bring up to date
+        successful_ids = [r.id for r in releases if r.successful]
+        if successful_ids:
+            update_current_versions(session, successful_ids)
+
+
+def import_chunks(documents, chunk_size=None, on_error=None):
+    """
+    Import release documents, committing a chunk of them at a time
+
+    Documents are read from the iterable a chunk at a time, so that only a
+    chunk is held in memory.
+
+    :param documents: Iterable of release documents. An InvalidUsage in
+        place of a document, e.g. from iter_ndjson, is an invalid record.
+    :param int chunk_size: Releases per chunk, defaults to the import
+        chunk_size configured
+    :param on_error: Function called with the index and the error message
+        of each invalid document, which is then skipped. If None, an invalid
+        document stops the import, the chunks before it having been
+        committed.
+    :return: Generator of lists of the ids of the releases imported, one
+        list per chunk
+    :raises InvalidUsage: If a document is invalid, and on_error is None
+    """
+    if chunk_size is None:
+        chunk_size = config.getint('import', 'chunk_size')
+
+    imported = failed = 0
+    for chunk in chunks(enumerate(documents), chunk_size):
+        releases = []
+        for index, document in chunk:
+            try:
+                if isinstance(document, InvalidUsage):
+                    raise document
+                releases.append(ReleaseRows(document))
+            except InvalidUsage as error:
+                if on_error is None:
+                    raise InvalidUsage(
+                        "Release {}: {}".format(index, error.message))
+                on_error(index, error.message)
+                failed += 1
+        if releases:
+            insert_releases(releases)
+            bump_data_version()
+            db.session.commit()
+        imported += len(releases)
+        app.logger.info("Imported {} releases, {} invalid".format(
+            imported, failed))
+        yield [r.id for r in releases]
+
+
+def import_releases(documents, chunk_size=None):
+    """
+    Import a list of release documents, see post_import
+
+    :param list documents: Release documents
+    :param int chunk_size: Releases per chunk
+    :return: list of the ids of the releases imported, in order
+    :raises InvalidUsage: If a document is invalid, the chunks before it
+        having been imported
+    """
+    release_ids = []
+    try:
+        for ids in import_chunks(documents, chunk_size):
+            release_ids.extend(ids)
+    except InvalidUsage as error:
+        raise InvalidUsage(
+            "{}. The {} releases before it were imported".format(
+                error.message, len(release_ids)),
+            payload={'releases': [str(i) for i in release_ids]})
+    return release_ids
+
+
+def stream_import(documents, chunk_size=None, max_errors=None):
+    """
+    Import a stream of release documents, skipping any which are invalid
+
+    Neither the documents nor the ids of the releases imported are kept, so
+    that the memory used does not grow with the number of documents.
+
+    :param documents: Iterable of release documents, e.g. from iter_ndjson
+    :param int chunk_size: Releases per chunk
+    :param int max_errors: Number of invalid documents to describe, defaults
+        to the import max_errors configured. Any more are only counted.
+    :return: dict with the number of releases imported, the number of
+        invalid documents, and the index and message of the first of them
+    """
+    if max_errors is None:
+        max_errors = config.getint('import', 'max_errors')
+    summary = {'imported': 0, 'invalid': 0, 'errors': []}
+
+    def on_error(index, message):
+        summary['invalid'] += 1
+        if len(summary['errors']) < max_errors:
+            summary['errors'].append({'record': index, 'message': message})
+
+    for ids in import_chunks(documents, chunk_size, on_error):
+        summary['imported'] += len(ids)
+    return summary
+
+
+def iter_ndjson(stream):
+    """
+    Yield the documents of newline delimited JSON, a line at a time
+
+    A line which is not JSON is yielded as an InvalidUsage, so that the lines
+    after it are still read. Blank lines are skipped.
+
+    :param stream: File-like object of bytes, e.g. request.stream
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            document = json.loads(line.decode('utf-8'))
+        except ValueError as error:
+            # Including UnicodeDecodeError
+            document = InvalidUsage("Invalid JSON: {}".format(error))
+        yield document
+
+
+class JSONArrayReader(object):
+    """
+    Iterate over the items of a JSON array in a stream, reading it a little
+    at a time
+
+    An item which is not valid JSON can not be skipped, as where the next
+    item starts is unknown. It is yielded as an InvalidUsage, and is the last
+    item.
+
+    :param stream: File-like object of bytes, e.g. request.stream
+    :param int read_size: Bytes to read from the stream at a time
+    :param int max_item_size: Characters an item can have. As an item which
+        does not decode may be incomplete, more of the stream is read, up to
+        this size.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, stream, read_size=READ_SIZE,
+                 max_item_size=MAX_ITEM_SIZE):
+        self.stream = stream
+        self.read_size = read_size
+        self.max_item_size = max_item_size
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read(self):
+        """
+        Read more of the stream into the buffer
+
+        :return: False if the end of the stream had been reached
+        """
+        if self.eof:
+            return False
+        data = self.stream.read(self.read_size)
+        self.eof = not data
+        # Discarding what has been parsed
+        self.buffer = self.buffer[self.position:] + \
+            self.text.decode(data, final=self.eof)
+        self.position = 0
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace, and return the next character, or None at the end
+        """
+        while True:
+            self.position = self.WHITESPACE.match(
+                self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                return None
+
+    def _item(self):
+        """
+        Decode the next item, or return an InvalidUsage if it is invalid
+        """
+        while True:
+            try:
+                item, end = self.decoder.raw_decode(self.buffer,
+                                                    self.position)
+            except ValueError as error:
+                item, end = error, None
+            if end is not None:
+                # The item may continue past the buffer, e.g. a number, unless
+                # it is followed by the end of the item
+                after = self.WHITESPACE.match(self.buffer, end).end()
+                if self.eof or (after < len(self.buffer) and
+                                self.buffer[after] in ',]'):
+                    self.position = end
+                    return item
+            if len(self.buffer) - self.position > self.max_item_size:
+                return InvalidUsage(
+                    "Invalid JSON, or an item larger than {} characters, "
+                    "stopped reading".format(self.max_item_size))
+            if not self._read():
+                return InvalidUsage(
+                    "Invalid JSON, stopped reading: {}".format(item))
+
+    def __iter__(self):
+        if self._peek() != '[':
+            yield InvalidUsage("Expected a JSON array")
+            return
+        self.position += 1
+        if self._peek() == ']':
+            return
+        while True:
+            if self._peek() is None:
+                yield InvalidUsage("Unexpected end of the JSON array")
+                return
+            item = self._item()
+            yield item
+            if isinstance(item, InvalidUsage):
+                return
+            character = self._peek()
+            if character == ']':
+                return
+            if character != ',':
+                yield InvalidUsage(
+                    "Expected , or ] after an item, stopped reading")
+                return
+            self.position += 1
@@ -0,0 +1,29 @@
+"""Add data version
+
+Revision ID: 4b1e2c9a7d30
+Revises: d6e70a17fef2
+Create Date: 2026-10-18 10:02:47.118329
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1e2c9a7d30'
+down_revision = 'd6e70a17fef2'
+branch_labels = ()
+depends_on = None
+
+def upgrade():
+    data_version = op.create_table(
+        'data_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.bulk_insert(data_version, [{'id': 1, 'version': 0}])
+
+
+def downgrade():
+    op.drop_table('data_version')
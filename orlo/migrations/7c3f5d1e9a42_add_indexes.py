@@ -0,0 +1,85 @@
+"""Add indexes for joins and filters
+
+Revision ID: 7c3f5d1e9a42
+Revises: 4b1e2c9a7d30
+Create Date: 2026-10-18 11:24:05.730914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c3f5d1e9a42'
+down_revision = '4b1e2c9a7d30'
+branch_labels = ()
+depends_on = None
+
+INDEXES = [
+    ('ix_package_release_id_status_rollback', 'package',
+     ['release_id', 'status', 'rollback']),
+    ('ix_package_name_status_stime', 'package', ['name', 'status', 'stime']),
+    ('ix_package_result_package_id', 'package_result', ['package_id']),
+    ('ix_release_metadata_release_id', 'release_metadata', ['release_id']),
+    ('ix_release_note_release_id', 'release_note', ['release_id']),
+    ('ix_release_platform_platform_id', 'release_platform', ['platform_id']),
+    ('ix_release_team', 'release', ['team']),
+    ('ix_release_user', 'release', ['user']),
+]
+
+
+def dedupe_release_platform():
+    """
+    Remove rows from release_platform which would violate its primary key
+    """
+    release_platform = sa.table(
+        'release_platform',
+        sa.column('release_id'),
+        sa.column('platform_id'),
+    )
+    op.execute(release_platform.delete().where(sa.or_(
+        release_platform.c.release_id.is_(None),
+        release_platform.c.platform_id.is_(None),
+    )))
+
+    connection = op.get_bind()
+    duplicates = connection.execute(
+        sa.select([release_platform.c.release_id,
+                   release_platform.c.platform_id])
+        .group_by(release_platform.c.release_id,
+                  release_platform.c.platform_id)
+        .having(sa.func.count() > 1)
+    ).fetchall()
+    for release_id, platform_id in duplicates:
+        pair = sa.and_(release_platform.c.release_id == release_id,
+                       release_platform.c.platform_id == platform_id)
+        connection.execute(release_platform.delete().where(pair))
+        connection.execute(release_platform.insert().values(
+            release_id=release_id, platform_id=platform_id))
+
+
+def upgrade():
+    dedupe_release_platform()
+    # existing_type is only needed by MySQL, see HackyUUIDType
+    with op.batch_alter_table('release_platform') as batch_op:
+        batch_op.alter_column('release_id', existing_type=sa.CHAR(32),
+                              nullable=False)
+        batch_op.alter_column('platform_id', existing_type=sa.CHAR(32),
+                              nullable=False)
+        batch_op.create_primary_key('pk_release_platform',
+                                    ['release_id', 'platform_id'])
+
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+
+    with op.batch_alter_table('release_platform') as batch_op:
+        batch_op.drop_constraint('pk_release_platform', type_='primary')
+        batch_op.alter_column('release_id', existing_type=sa.CHAR(32),
+                              nullable=True)
+        batch_op.alter_column('platform_id', existing_type=sa.CHAR(32),
+                              nullable=True)
@@ -0,0 +1,128 @@
+"""Add release status, has_rollback and the status flags
+
+Revision ID: a91c4e2b6f18
+Revises: 7c3f5d1e9a42
+Create Date: 2026-10-18 12:40:19.502661
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91c4e2b6f18'
+down_revision = '7c3f5d1e9a42'
+branch_labels = ()
+depends_on = None
+
+BATCH_SIZE = 1000
+
+STATUSES = ('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED')
+
+
+def status_type():
+    if op.get_bind().dialect.name == 'postgresql':
+        # Already created for package.status
+        return postgresql.ENUM(*STATUSES, name='status_types',
+                               create_type=False)
+    return sa.Enum(*STATUSES, name='status_types')
+
+
+def backfill():
+    """
+    Derive the new columns from the packages, a batch of releases at a time
+    """
+    release = sa.table(
+        'release',
+        sa.column('id'),
+        sa.column('status'),
+        sa.column('has_rollback'),
+        sa.column('any_in_progress'),
+        sa.column('all_successful'),
+    )
+    package = sa.table(
+        'package',
+        sa.column('release_id'),
+        sa.column('status'),
+        sa.column('rollback'),
+    )
+
+    def any_package(condition):
+        return sa.exists().where(sa.and_(
+            package.c.release_id == release.c.id, condition))
+
+    # The same as orlo.orm.release_status
+    status = sa.case([
+        (any_package(package.c.status == 'FAILED'), 'FAILED'),
+        (sa.or_(any_package(package.c.status == 'IN_PROGRESS'),
+                sa.and_(any_package(package.c.status == 'SUCCESSFUL'),
+                        any_package(package.c.status == 'NOT_STARTED'))),
+         'IN_PROGRESS'),
+        (any_package(package.c.status == 'SUCCESSFUL'), 'SUCCESSFUL'),
+    ], else_='NOT_STARTED')
+    has_rollback = sa.case(
+        [(any_package(package.c.rollback == sa.true()), sa.true())],
+        else_=sa.false())
+
+    any_in_progress = sa.case(
+        [(any_package(package.c.status == 'IN_PROGRESS'), sa.true())],
+        else_=sa.false())
+    all_successful = sa.case(
+        [(any_package(package.c.status != 'SUCCESSFUL'), sa.false())],
+        else_=sa.true())
+
+    connection = op.get_bind()
+    last_id = None
+    while True:
+        query = sa.select([release.c.id]).order_by(release.c.id) \
+            .limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(release.c.id > last_id)
+        release_ids = [row[0] for row in connection.execute(query)]
+        if not release_ids:
+            break
+        connection.execute(
+            release.update()
+            .where(release.c.id.in_(release_ids))
+            .values(status=sa.cast(status, status_type()),
+                    has_rollback=has_rollback,
+                    any_in_progress=any_in_progress,
+                    all_successful=all_successful))
+        last_id = release_ids[-1]
+
+
+def upgrade():
+    op.add_column('release', sa.Column(
+        'status', status_type(), nullable=True,
+        server_default='NOT_STARTED'))
+    op.add_column('release', sa.Column(
+        'has_rollback', sa.Boolean(), nullable=True,
+        server_default=sa.false()))
+    op.add_column('release', sa.Column(
+        'any_in_progress', sa.Boolean(), nullable=True,
+        server_default=sa.false()))
+    op.add_column('release', sa.Column(
+        'all_successful', sa.Boolean(), nullable=True,
+        server_default=sa.true()))
+    backfill()
+    op.create_index(op.f('ix_release_status'), 'release', ['status'],
+                    unique=False)
+    op.create_index(op.f('ix_release_has_rollback'), 'release',
+                    ['has_rollback'], unique=False)
+    op.create_index(op.f('ix_release_any_in_progress'), 'release',
+                    ['any_in_progress'], unique=False)
+    op.create_index(op.f('ix_release_all_successful'), 'release',
+                    ['all_successful'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_release_all_successful'), table_name='release')
+    op.drop_index(op.f('ix_release_any_in_progress'), table_name='release')
+    op.drop_index(op.f('ix_release_has_rollback'), table_name='release')
+    op.drop_index(op.f('ix_release_status'), table_name='release')
+    with op.batch_alter_table('release') as batch_op:
+        batch_op.drop_column('all_successful')
+        batch_op.drop_column('any_in_progress')
+        batch_op.drop_column('has_rollback')
+        batch_op.drop_column('status')
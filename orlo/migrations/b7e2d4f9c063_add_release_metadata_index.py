@@ -0,0 +1,83 @@
+"""Add release metadata key and value index
+
+Revision ID: b7e2d4f9c063
+Revises: f3d81c6a5b27
+Create Date: 2026-10-18 18:12:37.540126
+
+"""
+import hashlib
+import json
+
+from alembic import op
+from six import text_type
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d4f9c063'
+down_revision = 'f3d81c6a5b27'
+branch_labels = ()
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def value_hash(*values):
+    """
+    The same as orlo.orm.value_hash
+    """
+    return hashlib.sha1(json.dumps(
+        [text_type(v) for v in values]).encode('utf-8')).hexdigest()
+
+
+def backfill():
+    """
+    Hash the key and value of existing metadata, a batch of rows at a time
+    """
+    release_metadata = sa.table(
+        'release_metadata',
+        sa.column('id'),
+        sa.column('key'),
+        sa.column('value'),
+        sa.column('key_value_hash'),
+    )
+
+    connection = op.get_bind()
+    last_id = None
+    while True:
+        query = sa.select([release_metadata.c.id, release_metadata.c.key,
+                           release_metadata.c.value]) \
+            .order_by(release_metadata.c.id).limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(release_metadata.c.id > last_id)
+        rows = connection.execute(query).fetchall()
+        if not rows:
+            break
+        # The ids are compared as they are stored
+        connection.execute(
+            release_metadata.update()
+            .where(release_metadata.c.id == sa.bindparam('b_id'))
+            .values(key_value_hash=sa.bindparam('b_key_value_hash')),
+            [{'b_id': row_id, 'b_key_value_hash': value_hash(key, value)}
+             for row_id, key, value in rows])
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    op.add_column('release_metadata', sa.Column(
+        'key_value_hash', sa.String(length=40), nullable=True))
+    backfill()
+    with op.batch_alter_table('release_metadata') as batch_op:
+        batch_op.alter_column('key_value_hash', existing_type=sa.String(40),
+                              nullable=False)
+    # On the hash, as a key and value can be too long to index
+    op.create_index('ix_release_metadata_key_value_hash_release_id',
+                    'release_metadata', ['key_value_hash', 'release_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_release_metadata_key_value_hash_release_id',
+                  table_name='release_metadata')
+    with op.batch_alter_table('release_metadata') as batch_op:
+        batch_op.drop_column('key_value_hash')
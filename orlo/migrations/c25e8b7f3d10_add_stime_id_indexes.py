@@ -0,0 +1,33 @@
+"""Index release and package on (stime, id) for keyset pagination
+
+Revision ID: c25e8b7f3d10
+Revises: a91c4e2b6f18
+Create Date: 2026-10-18 14:05:37.184220
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c25e8b7f3d10'
+down_revision = 'a91c4e2b6f18'
+branch_labels = ()
+depends_on = None
+
+TABLES = ['release', 'package']
+
+
+def upgrade():
+    # The (stime, id) indexes cover everything the stime indexes did
+    for table in TABLES:
+        op.create_index('ix_{}_stime_id'.format(table), table,
+                        ['stime', 'id'], unique=False)
+        op.drop_index(op.f('ix_{}_stime'.format(table)), table_name=table)
+
+
+def downgrade():
+    for table in TABLES:
+        op.create_index(op.f('ix_{}_stime'.format(table)), table, ['stime'],
+                        unique=False)
+        op.drop_index('ix_{}_stime_id'.format(table), table_name=table)
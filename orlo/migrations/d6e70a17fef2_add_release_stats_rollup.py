@@ -0,0 +1,46 @@
+"""Add release stats rollup
+
+Revision ID: d6e70a17fef2
+Revises: 0868747e62ff
+Create Date: 2026-10-18 09:12:31.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.arrow import ArrowType
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6e70a17fef2'
+down_revision = '0868747e62ff'
+branch_labels = ()
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'release_stats_rollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key_hash', sa.String(length=40), nullable=False),
+        sa.Column('bucket', ArrowType(), nullable=True),
+        sa.Column('platform', sa.Text(), nullable=True),
+        sa.Column('team', sa.String(), nullable=True),
+        sa.Column('user', sa.String(), nullable=True),
+        sa.Column('package', sa.String(length=120), nullable=True),
+        sa.Column('normal_successful', sa.Integer(), nullable=False),
+        sa.Column('normal_failed', sa.Integer(), nullable=False),
+        sa.Column('rollback_successful', sa.Integer(), nullable=False),
+        sa.Column('rollback_failed', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_release_stats_rollup_bucket'),
+                    'release_stats_rollup', ['bucket'], unique=False)
+    op.create_index(op.f('ix_release_stats_rollup_key_hash'),
+                    'release_stats_rollup', ['key_hash'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_release_stats_rollup_key_hash'),
+                  table_name='release_stats_rollup')
+    op.drop_index(op.f('ix_release_stats_rollup_bucket'),
+                  table_name='release_stats_rollup')
+    op.drop_table('release_stats_rollup')
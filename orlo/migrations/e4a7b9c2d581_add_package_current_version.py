@@ -0,0 +1,96 @@
+"""Add package current version
+
+Revision ID: e4a7b9c2d581
+Revises: c25e8b7f3d10
+Create Date: 2026-10-18 15:32:08.671945
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils.types.arrow import ArrowType
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7b9c2d581'
+down_revision = 'c25e8b7f3d10'
+branch_labels = ()
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def backfill(package_current_version):
+    """
+    Fill the table with the newest successful package on each platform
+    """
+    release = sa.table(
+        'release',
+        sa.column('id', UUIDType()),
+        sa.column('status'),
+    )
+    package = sa.table(
+        'package',
+        sa.column('release_id', UUIDType()),
+        sa.column('name'),
+        sa.column('version'),
+        sa.column('stime', ArrowType()),
+        sa.column('status'),
+    )
+    release_platform = sa.table(
+        'release_platform',
+        sa.column('release_id', UUIDType()),
+        sa.column('platform_id', UUIDType()),
+    )
+    platform = sa.table(
+        'platform',
+        sa.column('id', UUIDType()),
+        sa.column('name'),
+    )
+
+    # Oldest first, so that newer versions replace them
+    rows = op.get_bind().execute(
+        sa.select([platform.c.name, package.c.name, package.c.version,
+                   package.c.stime, release.c.status])
+        .select_from(
+            package
+            .join(release, release.c.id == package.c.release_id)
+            .join(release_platform,
+                  release_platform.c.release_id == release.c.id)
+            .join(platform, platform.c.id == release_platform.c.platform_id))
+        .where(package.c.status == 'SUCCESSFUL')
+        .where(package.c.stime.isnot(None))
+        .order_by(package.c.stime)
+    )
+    versions = {}
+    for platform_name, name, version, stime, release_status in rows:
+        row = versions.setdefault((platform_name, name), {
+            'platform': platform_name, 'package': name,
+            'release_version': None, 'release_stime': None,
+        })
+        row['version'], row['stime'] = version, stime
+        if release_status == 'SUCCESSFUL':
+            row['release_version'], row['release_stime'] = version, stime
+
+    rows = list(versions.values())
+    for offset in range(0, len(rows), BATCH_SIZE):
+        op.bulk_insert(package_current_version,
+                       rows[offset:offset + BATCH_SIZE])
+
+
+def upgrade():
+    package_current_version = op.create_table(
+        'package_current_version',
+        sa.Column('platform', sa.Text(), nullable=False),
+        sa.Column('package', sa.String(length=120), nullable=False),
+        sa.Column('version', sa.String(length=32), nullable=False),
+        sa.Column('stime', ArrowType(), nullable=True),
+        sa.Column('release_version', sa.String(length=32), nullable=True),
+        sa.Column('release_stime', ArrowType(), nullable=True),
+        sa.PrimaryKeyConstraint('platform', 'package'),
+    )
+    backfill(package_current_version)
+
+
+def downgrade():
+    op.drop_table('package_current_version')
@@ -0,0 +1,120 @@
+"""Add release reference
+
+Revision ID: f3d81c6a5b27
+Revises: e4a7b9c2d581
+Create Date: 2026-10-18 17:05:44.218390
+
+"""
+import hashlib
+import json
+import uuid
+
+from alembic import op
+from six import text_type
+import sqlalchemy as sa
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3d81c6a5b27'
+down_revision = 'e4a7b9c2d581'
+branch_labels = ()
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def string_to_list(string):
+    """
+    The same as orlo.orm.string_to_list
+    """
+    if string is None:
+        return []
+    if '[' in string and ']' in string and ('"' in string or "'" in string):
+        return json.loads(string.replace("'", '"'))
+    return [string]
+
+
+def value_hash(*values):
+    """
+    The same as orlo.orm.value_hash
+    """
+    return hashlib.sha1(json.dumps(
+        [text_type(v) for v in values]).encode('utf-8')).hexdigest()
+
+
+def backfill(release_reference):
+    """
+    Parse release.references into rows, a batch of releases at a time
+    """
+    release = sa.table(
+        'release',
+        sa.column('id'),
+        sa.column('references'),
+    )
+
+    connection = op.get_bind()
+    last_id = None
+    while True:
+        query = sa.select([release.c.id, release.c.references]) \
+            .order_by(release.c.id).limit(BATCH_SIZE)
+        if last_id is not None:
+            query = query.where(release.c.id > last_id)
+        releases = connection.execute(query).fetchall()
+        if not releases:
+            break
+        rows = []
+        for release_id, references in releases:
+            try:
+                references = string_to_list(references)
+            except ValueError:
+                # Not a list after all, keep it as the one reference
+                references = [references]
+            rows.extend({'id': uuid.uuid4(), 'release_id': release_id,
+                         'reference': reference,
+                         'reference_hash': value_hash(reference),
+                         'position': position}
+                        for position, reference in enumerate(references)
+                        if reference is not None)
+        if rows:
+            op.bulk_insert(release_reference, rows)
+        last_id = releases[-1][0]
+
+
+def upgrade():
+    op.create_table(
+        'release_reference',
+        sa.Column('id', UUIDType(), nullable=False),
+        sa.Column('release_id', UUIDType(), nullable=False),
+        sa.Column('reference', sa.Text(), nullable=False),
+        sa.Column('reference_hash', sa.String(length=40), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['release_id'], ['release.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('id'),
+    )
+    # Insert through a table with release_id untyped, the ids are copied
+    # from release as they are stored
+    backfill(sa.table(
+        'release_reference',
+        sa.column('id', UUIDType()),
+        sa.column('release_id'),
+        sa.column('reference'),
+        sa.column('reference_hash'),
+        sa.column('position'),
+    ))
+    # After the backfill, which is faster without them
+    op.create_index('ix_release_reference_release_id', 'release_reference',
+                    ['release_id'], unique=False)
+    # On the hash, as a reference can be too long to index
+    op.create_index('ix_release_reference_reference_hash_release_id',
+                    'release_reference', ['reference_hash', 'release_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_release_reference_reference_hash_release_id',
+                  table_name='release_reference')
+    op.drop_index('ix_release_reference_release_id',
+                  table_name='release_reference')
+    op.drop_table('release_reference')
@@ -1,10 +1,18 @@
+from collections import defaultdict
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, event, inspect, literal_column, \
+    or_, text
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy_utils.types.uuid import UUIDType
 from sqlalchemy_utils.types.arrow import ArrowType
+from six import text_type
 
 from orlo.app import app
 from orlo.config import config
 from orlo.exceptions import OrloWorkflowError
+import hashlib
 import pytz
 import uuid
 import arrow
@@ -26,8 +34,11 @@ except pytz.exceptions.UnknownTimeZoneError:
 # Map releases to platforms
 release_platform = db.Table(
     'release_platform', db.Model.metadata,
-    db.Column('release_id', UUIDType, db.ForeignKey('release.id')),
-    db.Column('platform_id', UUIDType, db.ForeignKey('platform.id'))
+    db.Column('release_id', UUIDType, db.ForeignKey('release.id'),
+              primary_key=True),
+    db.Column('platform_id', UUIDType, db.ForeignKey('platform.id'),
+              primary_key=True),
+    db.Index('ix_release_platform_platform_id', 'platform_id'),
 )
 
 
@@ -55,15 +66,36 @@ class Release(db.Model):
     The main Release object
     """
     __tablename__ = 'release'
+    __table_args__ = (
+        # Ordering and keyset pagination in queries.build_query, and filters
+        # on stime
+        db.Index('ix_release_stime_id', 'stime', 'id'),
+    )
 
     id = db.Column(UUIDType, primary_key=True, unique=True, nullable=False)
     platforms = db.relationship('Platform', secondary=release_platform)
     references = db.Column(db.String)
-    stime = db.Column(ArrowType, index=True)
+    stime = db.Column(ArrowType)
     ftime = db.Column(ArrowType)
     duration = db.Column(db.Interval)
-    user = db.Column(db.String, nullable=False)
-    team = db.Column(db.String)
+    user = db.Column(db.String, nullable=False, index=True)
+    team = db.Column(db.String, index=True)
+    # Derived from the packages, see update_release_status
+    status = db.Column(
+        db.Enum('NOT_STARTED', 'IN_PROGRESS', 'SUCCESSFUL', 'FAILED',
+                name='status_types'),
+        default='NOT_STARTED', server_default='NOT_STARTED', index=True)
+    has_rollback = db.Column(db.Boolean(create_constraint=True),
+                             default=False, server_default=db.false(),
+                             index=True)
+    # Whether any package is in progress, and all packages are successful,
+    # for filtering on status, see queries.filter_release_status
+    any_in_progress = db.Column(db.Boolean(create_constraint=True),
+                                default=False, server_default=db.false(),
+                                index=True)
+    all_successful = db.Column(db.Boolean(create_constraint=True),
+                               default=True, server_default=db.true(),
+                               index=True)
     packages = db.relationship("Package", backref=db.backref("release"))
     notes = db.relationship("ReleaseNote", backref=db.backref("release"))
 
@@ -77,6 +109,11 @@ class Release(db.Model):
             self.team = team
         if references:
             self.references = str(references)
+            if not isinstance(references, list):
+                references = string_to_list(references)
+            self.reference_rows = [
+                ReleaseReference(self.id, reference, position)
+                for position, reference in enumerate(references)]
 
         # Assume the release started when it was created
         self.start()
@@ -95,7 +132,7 @@ class Release(db.Model):
             'id': str(self.id),
             'packages': [p.to_dict() for p in self.packages],
             'platforms': [platform.name for platform in self.platforms],
-            'references': string_to_list(self.references),
+            'references': [r.reference for r in self.reference_rows],
             'stime': self.stime.strftime(config.get('main', 'time_format')) if self.stime else None,
             'ftime': self.ftime.strftime(config.get('main', 'time_format')) if self.ftime else None,
             'duration': self.duration.seconds if self.duration else None,
@@ -125,10 +162,20 @@ class Package(db.Model):
     A deployed instance of a package
     """
     __tablename__ = 'package'
+    __table_args__ = (
+        # Joins from release, covering the columns release status and
+        # rollback are derived from
+        db.Index('ix_package_release_id_status_rollback',
+                 'release_id', 'status', 'rollback'),
+        # Current versions, and filters on package name
+        db.Index('ix_package_name_status_stime', 'name', 'status', 'stime'),
+        # Ordering and keyset pagination in queries.build_query
+        db.Index('ix_package_stime_id', 'stime', 'id'),
+    )
 
     id = db.Column(UUIDType, primary_key=True, unique=True, nullable=False)
     name = db.Column(db.String(120), nullable=False)
-    stime = db.Column(ArrowType, index=True)
+    stime = db.Column(ArrowType)
     ftime = db.Column(ArrowType)
     duration = db.Column(db.Interval)
     status = db.Column(
@@ -190,6 +237,406 @@ class Package(db.Model):
         }
 
 
+def release_status(failed, in_progress, successful, not_started):
+    """
+    Work out the status of a release from whether any of its packages has each
+    status
+
+    A release is FAILED if any package failed, otherwise IN_PROGRESS if any
+    package is in progress, or if some packages have finished and others not
+    started. It is SUCCESSFUL if all its packages are, and NOT_STARTED if none
+    of them have started or it has no packages.
+    """
+    if failed:
+        return 'FAILED'
+    if in_progress or (successful and not_started):
+        return 'IN_PROGRESS'
+    if successful:
+        return 'SUCCESSFUL'
+    return 'NOT_STARTED'
+
+
+def update_release_status(session, release_ids):
+    """
+    Recompute Release.status, Release.has_rollback and the flags filtered on,
+    Release.any_in_progress and Release.all_successful, from the packages
+
+    Reads the packages of all the releases in one query, and writes only the
+    releases which changed. Releases loaded in the session are updated
+    without being marked as modified.
+
+    :param session: Session to run the queries in
+    :param release_ids: Releases to update
+    :return: set of the ids of releases which were SUCCESSFUL and no longer
+        are
+    """
+    release_ids = list(set(release_ids))
+    demoted = set()
+    if not release_ids:
+        return demoted
+
+    # Under READ COMMITTED, two transactions changing different packages of
+    # a release would each miss the other's change. Locking the releases
+    # makes the second wait for the first to commit, then read its packages.
+    # In order, so that transactions locking the same releases can not
+    # deadlock.
+    session.query(Release.id) \
+        .filter(Release.id.in_(release_ids)) \
+        .order_by(Release.id) \
+        .with_for_update() \
+        .all()
+
+    def any_package(condition):
+        return db.func.max(db.case([(condition, 1)], else_=0))
+
+    rows = session.query(
+        Package.release_id,
+        any_package(Package.status == 'FAILED'),
+        any_package(Package.status == 'IN_PROGRESS'),
+        any_package(Package.status == 'SUCCESSFUL'),
+        any_package(Package.status == 'NOT_STARTED'),
+        any_package(Package.rollback == True),
+    ) \
+        .filter(Package.release_id.in_(release_ids)) \
+        .group_by(Package.release_id) \
+        .all()
+    values = {}
+    for release_id, failed, in_progress, successful, not_started, \
+            rollback in rows:
+        values[release_id] = (
+            release_status(failed, in_progress, successful, not_started),
+            bool(rollback), bool(in_progress),
+            not (failed or in_progress or not_started))
+
+    # Releases inserted by the flush are not in the identity map until after
+    # it, see update_release_status_after_flush
+    new_releases = dict((instance.id, instance) for instance in session.new
+                        if isinstance(instance, Release))
+    columns = ('status', 'has_rollback', 'any_in_progress', 'all_successful')
+    current = session.query(Release.id, *[getattr(Release, c)
+                                          for c in columns]) \
+        .filter(Release.id.in_(release_ids))
+    updates = []
+    for row in current.all():
+        release_id = row[0]
+        # A release without packages
+        new_values = values.get(
+            release_id, ('NOT_STARTED', False, False, True))
+        if tuple(row[1:]) == new_values:
+            continue
+        if row.status == 'SUCCESSFUL' and new_values[0] != 'SUCCESSFUL':
+            demoted.add(release_id)
+        update = dict(zip(columns, new_values))
+        updates.append(dict(update, key_id=release_id))
+        release = session.identity_map.get(
+            identity_key(Release, release_id)) or \
+            new_releases.get(release_id)
+        if release is not None:
+            for column, value in update.items():
+                set_committed_value(release, column, value)
+
+    # Executed once with all the rows, as a batch of events can change many
+    # releases in one flush
+    if updates:
+        table = Release.__table__
+        session.execute(
+            table.update()
+            .where(table.c.id == bindparam('key_id'))
+            .values(dict((c, bindparam(c)) for c in columns)),
+            updates)
+    return demoted
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_release_status_after_flush(session, flush_context):
+    """
+    Keep the status of releases in step with their packages
+
+    Runs in the same transaction as the flush, for the releases of any
+    packages which were added, changed or deleted.
+    """
+    release_ids = set()
+    successful_release_ids = set()
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, Package):
+            if instance.release_id is not None:
+                release_ids.add(instance.release_id)
+                if instance.status == 'SUCCESSFUL' and \
+                        instance not in session.deleted:
+                    successful_release_ids.add(instance.release_id)
+            # Also the release a package was moved from
+            history = inspect(instance).attrs.release_id.history
+            release_ids.update(r for r in history.deleted if r is not None)
+    update_releases(session, release_ids, successful_release_ids)
+
+
+def update_releases(session, release_ids, successful_release_ids=()):
+    """
+    Update what is derived from the packages of releases: their status and
+    the current versions
+
+    Called after every flush. Statements which write packages without the
+    ORM, e.g. bulk updates, bypass the flush and have to call this
+    themselves, in the same transaction.
+
+    :param session: Session to run the queries in
+    :param release_ids: Releases whose packages were changed
+    :param successful_release_ids: Releases with packages which are now
+        SUCCESSFUL
+    """
+    demoted_release_ids = update_release_status(session, release_ids)
+    # After the status, which the by release versions depend on
+    if successful_release_ids:
+        update_current_versions(session, successful_release_ids)
+    if demoted_release_ids:
+        recompute_current_versions(session, demoted_release_ids)
+
+
+def _newest(current, candidate):
+    """
+    Return whichever of two (version, stime) pairs is newer, None is oldest
+    """
+    if current is None or current[1] is None:
+        return candidate
+    if candidate is None or candidate[1] is None:
+        return current
+    return candidate if candidate[1] > current[1] else current
+
+
+def current_versions(session, condition):
+    """
+    Work out the newest successful versions of packages
+
+    :param session: Session to run the query in
+    :param condition: Filter on the packages to look at, which can refer to
+        Package, Release and Platform
+    :return: dict of (platform, package) to [(version, stime) of the newest
+        successful package, (version, stime) of the newest successful
+        package in a successful release or None]
+    """
+    rows = session.query(
+        Platform.name, Package.name, Package.version, Package.stime,
+        Release.status,
+    ) \
+        .join(Release, Release.id == Package.release_id) \
+        .join(release_platform, release_platform.c.release_id == Release.id) \
+        .join(Platform, Platform.id == release_platform.c.platform_id) \
+        .filter(condition) \
+        .filter(Package.status == 'SUCCESSFUL') \
+        .filter(Package.stime.isnot(None))
+
+    versions = {}
+    for platform, package, version, stime, release_status in rows:
+        newest = versions.setdefault((platform, package), [None, None])
+        newest[0] = _newest(newest[0], (version, stime))
+        if release_status == 'SUCCESSFUL':
+            newest[1] = _newest(newest[1], (version, stime))
+    return versions
+
+
+CURRENT_VERSION_COLUMNS = ('version', 'stime', 'release_version',
+                           'release_stime')
+
+
+def _current_version_assignments(new, merge):
+    """
+    Return the assignments of an update of package_current_version, in
+    order, and the condition for the update, or None
+
+    :param new: Function returning the new value of a column
+    :param boolean merge: Only replace versions which are older, as _newest
+        decides
+    """
+    table = PackageCurrentVersion.__table__
+    if not merge:
+        return [(c, new(c)) for c in CURRENT_VERSION_COLUMNS], None
+
+    assignments = []
+    conditions = []
+    for version, stime in (('version', 'stime'),
+                           ('release_version', 'release_stime')):
+        newer = and_(new(stime).isnot(None),
+                     or_(table.c[stime].is_(None),
+                         new(stime) > table.c[stime]))
+        # The version first, as MySQL assigns in order, and would compare
+        # with the new stime otherwise
+        for column in (version, stime):
+            assignments.append(
+                (column, db.case([(newer, new(column))],
+                                 else_=table.c[column])))
+        conditions.append(newer)
+    return assignments, or_(*conditions)
+
+
+def _sqlite_current_version_upsert(dialect, merge):
+    """
+    Return an INSERT ... ON CONFLICT DO UPDATE of package_current_version for
+    SQLite, which SQLAlchemy has no construct for
+    """
+    table = PackageCurrentVersion.__table__
+    columns = ('platform', 'package') + CURRENT_VERSION_COLUMNS
+    quote = dialect.identifier_preparer.quote
+    assignments, condition = _current_version_assignments(
+        lambda c: literal_column('excluded.' + quote(c)), merge)
+
+    def sql(clause):
+        return str(clause.compile(dialect=dialect))
+
+    return text(
+        "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (platform, package) "
+        "DO UPDATE SET {}{}".format(
+            table.name,
+            ', '.join(quote(c) for c in columns),
+            ', '.join(':' + c for c in columns),
+            ', '.join('{} = {}'.format(quote(c), sql(value))
+                      for c, value in assignments),
+            '' if condition is None else ' WHERE ' + sql(condition))
+    ).bindparams(*[bindparam(c, type_=table.c[c].type) for c in columns])
+
+
+def _write_current_versions(session, versions, merge):
+    """
+    Write versions from current_versions to package_current_version
+
+    The versions are merged with those stored by the database, in one upsert,
+    so that concurrent transactions neither fail on inserting the same key
+    nor replace a newer version with an older one.
+
+    :param session: Session to run the queries in
+    :param dict versions: From current_versions
+    :param boolean merge: Only replace versions which are older. Otherwise
+        the versions given replace those stored.
+    """
+    table = PackageCurrentVersion.__table__
+    rows = []
+    # In order, so that concurrent upserts wait on each other rather than
+    # deadlock
+    for (platform, package), (newest, newest_by_release) in sorted(
+            versions.items(), key=lambda item: item[0]):
+        row = dict(zip(CURRENT_VERSION_COLUMNS,
+                       newest + (newest_by_release or (None, None))))
+        row.update(platform=platform, package=package)
+        rows.append(row)
+
+    dialect = session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        insert = postgresql.insert(table)
+        assignments, condition = _current_version_assignments(
+            lambda c: insert.excluded[c], merge)
+        session.execute(insert.on_conflict_do_update(
+            index_elements=['platform', 'package'],
+            set_=dict(assignments), where=condition), rows)
+    elif dialect.name == 'sqlite' and \
+            dialect.dbapi.sqlite_version_info >= (3, 24):
+        session.execute(_sqlite_current_version_upsert(dialect, merge), rows)
+    elif dialect.name == 'mysql':
+        insert = mysql.insert(table)
+        assignments, _ = _current_version_assignments(
+            lambda c: insert.inserted[c], merge)
+        session.execute(insert.on_duplicate_key_update(assignments), rows)
+    else:
+        # Without an upsert, a key another transaction inserts meanwhile
+        # fails this one on the primary key
+        assignments, condition = _current_version_assignments(
+            lambda c: bindparam('b_' + c, type_=table.c[c].type), merge)
+        update = table.update() \
+            .where(table.c.platform == bindparam('b_platform')) \
+            .where(table.c.package == bindparam('b_package')) \
+            .values(dict(assignments))
+        if condition is not None:
+            update = update.where(condition)
+        existing = set(tuple(row) for row in session.query(
+            table.c.platform, table.c.package)
+            .filter(table.c.platform.in_(set(k[0] for k in versions)))
+            .filter(table.c.package.in_(set(k[1] for k in versions))))
+        updates = [dict(('b_' + c, v) for c, v in row.items())
+                   for row in rows
+                   if (row['platform'], row['package']) in existing]
+        inserts = [row for row in rows
+                   if (row['platform'], row['package']) not in existing]
+        if updates:
+            session.execute(update, updates)
+        if inserts:
+            session.execute(table.insert(), inserts)
+
+
+def update_current_versions(session, release_ids):
+    """
+    Update package_current_version with the packages of the given releases
+
+    Versions only replace those that are older, so releases can be applied
+    in any order.
+
+    :param session: Session to run the queries in
+    :param release_ids: Releases whose successful packages may be current
+    """
+    versions = current_versions(
+        session, Package.release_id.in_(list(release_ids)))
+    if versions:
+        _write_current_versions(session, versions, merge=True)
+
+
+def recompute_current_versions(session, release_ids):
+    """
+    Recompute the current versions of the packages of the given releases
+
+    For releases which are no longer successful, whose packages may no longer
+    be the current version by release. Reads the whole history of the
+    packages on the releases' platforms.
+
+    :param session: Session to run the queries in
+    :param release_ids: Releases whose packages to recompute
+    """
+    keys = set(current_versions(
+        session, Package.release_id.in_(list(release_ids))))
+    if not keys:
+        return
+    versions = current_versions(session, and_(
+        Package.name.in_(set(k[1] for k in keys)),
+        Platform.name.in_(set(k[0] for k in keys)),
+    ))
+    _write_current_versions(
+        session, dict((k, versions[k]) for k in keys), merge=False)
+
+
+def rebuild_current_versions(batch_size=1000):
+    """
+    Rebuild package_current_version from the release and package tables
+
+    :param int batch_size: Number of releases to read at a time
+    :return: The number of rows written
+    """
+    app.logger.info("Rebuilding package current versions")
+    db.session.query(PackageCurrentVersion).delete(synchronize_session=False)
+
+    versions = {}
+    last_id = None
+    while True:
+        query = db.session.query(Release.id).order_by(Release.id)
+        if last_id is not None:
+            query = query.filter(Release.id > last_id)
+        release_ids = [r[0] for r in query.limit(batch_size)]
+        if not release_ids:
+            break
+        for key, (newest, newest_by_release) in current_versions(
+                db.session, Package.release_id.in_(release_ids)).items():
+            current = versions.setdefault(key, [None, None])
+            current[0] = _newest(current[0], newest)
+            current[1] = _newest(current[1], newest_by_release)
+        last_id = release_ids[-1]
+
+    rows = []
+    for (platform, package), (newest, newest_by_release) in versions.items():
+        row = dict(zip(CURRENT_VERSION_COLUMNS,
+                       newest + (newest_by_release or (None, None))))
+        row.update(platform=platform, package=package)
+        rows.append(row)
+    db.session.bulk_insert_mappings(PackageCurrentVersion, rows)
+    db.session.commit()
+    app.logger.info("Rebuilt package current versions, %s rows", len(rows))
+    return len(rows)
+
+
 class PackageResult(db.Model):
     """
     The results of a package
@@ -199,7 +646,7 @@ class PackageResult(db.Model):
     id = db.Column(UUIDType, primary_key=True, unique=True)
     content = db.Column(db.Text)
 
-    package_id = db.Column(UUIDType, db.ForeignKey("package.id"))
+    package_id = db.Column(UUIDType, db.ForeignKey("package.id"), index=True)
     package = db.relationship("Package", backref=db.backref('results',
                                                             order_by=id))
 
@@ -217,7 +664,7 @@ class ReleaseNote(db.Model):
 
     id = db.Column(UUIDType, primary_key=True, unique=True)
     content = db.Column(db.Text, nullable=False)
-    release_id = db.Column(UUIDType, db.ForeignKey("release.id"))
+    release_id = db.Column(UUIDType, db.ForeignKey("release.id"), index=True)
 
     def __init__(self, release_id, content):
         self.id = uuid.uuid4()
@@ -225,24 +672,74 @@ class ReleaseNote(db.Model):
         self.content = content
 
 
+def value_hash(*values):
+    """
+    Return the digest of text values, which is indexed in place of values that
+    can be too long for an index
+    """
+    return hashlib.sha1(json.dumps(
+        [text_type(v) for v in values]).encode('utf-8')).hexdigest()
+
+
+class ReleaseReference(db.Model):
+    """
+    An external reference of a release, e.g. a ticket
+
+    Release.references holds the same list as a string, which is kept for
+    compatibility. These rows are what the reference filter and to_dict use.
+    """
+    __tablename__ = 'release_reference'
+    __table_args__ = (
+        # Releases by reference, see orlo.filters
+        db.Index('ix_release_reference_reference_hash_release_id',
+                 'reference_hash', 'release_id'),
+    )
+
+    id = db.Column(UUIDType, primary_key=True, unique=True)
+    release_id = db.Column(UUIDType, db.ForeignKey("release.id"), index=True,
+                           nullable=False)
+    release = db.relationship("Release", backref=db.backref(
+        'reference_rows', order_by='ReleaseReference.position'))
+    reference = db.Column(db.Text, nullable=False)
+    # value_hash of the reference
+    reference_hash = db.Column(db.String(40), nullable=False)
+    # Order of the reference in the list it was given in
+    position = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, release_id, reference, position=0):
+        self.id = uuid.uuid4()
+        self.release_id = release_id
+        self.reference = reference
+        self.reference_hash = value_hash(reference)
+        self.position = position
+
+
 class ReleaseMetadata(db.Model):
     """
     Metadata added to a release
     """
     __tablename__ = 'release_metadata'
+    __table_args__ = (
+        # Releases by metadata, see orlo.filters
+        db.Index('ix_release_metadata_key_value_hash_release_id',
+                 'key_value_hash', 'release_id'),
+    )
 
     id = db.Column(UUIDType, primary_key=True, unique=True)
 
-    release_id = db.Column(UUIDType, db.ForeignKey("release.id"))
+    release_id = db.Column(UUIDType, db.ForeignKey("release.id"), index=True)
     release = db.relationship("Release", backref=db.backref('metadata', order_by=id))
     key = db.Column(db.Text, nullable=False)
     value = db.Column(db.Text, nullable=False)
+    # value_hash of the key and value
+    key_value_hash = db.Column(db.String(40), nullable=False)
 
     def __init__(self, release_id, key, value):
         self.id = uuid.uuid4()
         self.release_id = release_id
         self.key = key
         self.value = value
+        self.key_value_hash = value_hash(key, value)
 
     def getKey(self):
         return str(self.key)
@@ -263,3 +760,134 @@ class Platform(db.Model):
     def __init__(self, name):
         self.id = uuid.uuid4()
         self.name = name
+
+
+def load_release_relationships(releases):
+    """
+    Load the relationships Release.to_dict uses for many releases at once
+
+    Lazy loading queries each relationship once per release. This runs one
+    query per relationship for all of the releases given, and sets the
+    results as if they had been loaded. Relationships which are already
+    loaded are left alone.
+
+    :param list releases: Release objects
+    """
+    def unloaded(attribute):
+        return dict((release.id, release) for release in releases
+                    if attribute in inspect(release).unloaded)
+
+    def set_loaded(attribute, releases_by_id, rows):
+        loaded = defaultdict(list)
+        for release_id, value in rows:
+            loaded[release_id].append(value)
+        for release_id, release in releases_by_id.items():
+            set_committed_value(release, attribute, loaded[release_id])
+
+    by_id = unloaded('packages')
+    if by_id:
+        set_loaded('packages', by_id, (
+            (package.release_id, package) for package in
+            db.session.query(Package)
+            .filter(Package.release_id.in_(list(by_id)))))
+
+    by_id = unloaded('platforms')
+    if by_id:
+        set_loaded('platforms', by_id, db.session.query(
+            release_platform.c.release_id, Platform)
+            .join(Platform, Platform.id == release_platform.c.platform_id)
+            .filter(release_platform.c.release_id.in_(list(by_id))))
+
+    by_id = unloaded('notes')
+    if by_id:
+        set_loaded('notes', by_id, (
+            (note.release_id, note) for note in
+            db.session.query(ReleaseNote)
+            .filter(ReleaseNote.release_id.in_(list(by_id)))))
+
+    by_id = unloaded('reference_rows')
+    if by_id:
+        set_loaded('reference_rows', by_id, (
+            (reference.release_id, reference) for reference in
+            db.session.query(ReleaseReference)
+            .filter(ReleaseReference.release_id.in_(list(by_id)))
+            .order_by(ReleaseReference.position)))
+
+    by_id = unloaded('metadata')
+    if by_id:
+        set_loaded('metadata', by_id, (
+            (metadata.release_id, metadata) for metadata in
+            db.session.query(ReleaseMetadata)
+            .filter(ReleaseMetadata.release_id.in_(list(by_id)))
+            .order_by(ReleaseMetadata.id)))
+
+
+class ReleaseStatsRollup(db.Model):
+    """
+    Release counts by hour, maintained as releases change
+
+    A release is counted once in the row where platform and package are both
+    null, once per platform where only package is null, once per package where
+    only platform is null, and once per platform and package combination. This
+    lets a stats query read one level without counting a release twice.
+
+    There is one row per key, bucket, platform, team, user and package. As a
+    unique constraint treats nulls as distinct, and most keys have some,
+    key_hash, a digest of the key, is what is unique (see rollup.key_hash).
+    """
+    __tablename__ = 'release_stats_rollup'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key_hash = db.Column(db.String(40), nullable=False, unique=True,
+                         index=True)
+    bucket = db.Column(ArrowType, index=True)
+    platform = db.Column(db.Text)
+    team = db.Column(db.String)
+    user = db.Column(db.String)
+    package = db.Column(db.String(120))
+    normal_successful = db.Column(db.Integer, nullable=False, default=0)
+    normal_failed = db.Column(db.Integer, nullable=False, default=0)
+    rollback_successful = db.Column(db.Integer, nullable=False, default=0)
+    rollback_failed = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PackageCurrentVersion(db.Model):
+    """
+    The current version of each package on each platform
+
+    The newest successful version, and the newest successful version in a
+    successful release, as queries.package_versions returns with by_release
+    false and true. Maintained by update_current_versions as packages
+    succeed.
+    """
+    __tablename__ = 'package_current_version'
+
+    platform = db.Column(db.Text, primary_key=True)
+    package = db.Column(db.String(120), primary_key=True)
+    version = db.Column(db.String(32), nullable=False)
+    stime = db.Column(ArrowType)
+    release_version = db.Column(db.String(32))
+    release_stime = db.Column(ArrowType)
+
+
+class DataVersion(db.Model):
+    """
+    A counter which is incremented whenever release data is written
+
+    There is a single row, with id 1. The response cache stores the version
+    with each response, and treats it as stale once the version has moved on,
+    which works across processes as they all read the same row.
+    """
+    __tablename__ = 'data_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+@event.listens_for(DataVersion.__table__, 'after_create')
+def insert_data_version(table, connection, **kwargs):
+    """
+    Insert the row of the data version along with its table, as its migration
+    does, so that writers only ever update it rather than race to insert it
+    """
+    connection.execute(table.insert(), {'id': 1, 'version': 0})
@@ -1,10 +1,16 @@
 from __future__ import print_function
-import datetime
+import base64
+import json
+import uuid
 import arrow
+from orlo import filters
 from orlo.app import app
-from orlo.orm import db, Release, Platform, Package, release_platform
+from orlo.cache import statement_cache
+from orlo.orm import db, Release, Platform, Package, PackageCurrentVersion, \
+    release_platform
 from orlo.exceptions import OrloError, InvalidUsage
-from sqlalchemy import and_, exc
+from sqlalchemy import and_, or_, exc, bindparam, tuple_, type_coerce, \
+    Integer
 
 __author__ = 'alforbes'
 
@@ -33,158 +39,79 @@ def get_package(package_id):
     return db.session.query(Package).filter(Package.id == package_id)
 
 
+def validate_release_status(status):
+    """
+    Raise InvalidUsage if status is not a valid release status
+
+    :param status:
+    """
+    enums = Release.status.property.columns[0].type.enums
+    if status not in enums:
+        raise InvalidUsage("Invalid package status, {} is not in {}".format(
+            status, str(enums)))
+
+
+def validate_release_rollback(rollback):
+    """
+    Raise TypeError if rollback is not a boolean
+
+    :param rollback:
+    """
+    if rollback is not True and rollback is not False:
+        # What the hell did you pass?
+        raise TypeError(
+            "Bad rollback parameter: '{}', type {}. Boolean expected.".format(
+                rollback, type(rollback)))
+
+
 def filter_release_status(query, status):
     """
     Filter the given query by the given release status
 
     Release status is special, because it's actually determined by the
-    package status
+    package status. A release is FAILED or IN_PROGRESS if any of its packages
+    is, and SUCCESSFUL or NOT_STARTED if all of them are. This is kept up to
+    date in columns of the release as packages change, see
+    filters.release_status_clause.
 
     :param query: Query object
     :param status: The status to filter on
     :return:
     """
-    app.logger.info("Filtering release status on {}".format(status))
-    enums = Package.status.property.columns[0].type.enums
-    if status not in enums:
-        raise InvalidUsage("Invalid package status, {} is not in {}".format(
-            status, str(enums)))
-    if status in ["SUCCESSFUL", "NOT_STARTED"]:
-        # ALL packages must match this status for it to apply to the release
-        # Query logic translates to "Releases which do not have any packages
-        # which satisfy
-        # the condition 'Package.status != status'". I.E, all match.
-        query = query.filter(
-            ~Release.packages.any(
-                Package.status != status
-            ))
-    elif status in ["FAILED", "IN_PROGRESS"]:
-        # ANY package can match for this status to apply to the release
-        query = query.filter(Release.packages.any(Package.status == status))
-    else:
-        app.logger.debug("Not filtering query on release status")
-    return query
+    app.logger.info("Filtering release status on %s", status)
+    validate_release_status(status)
+    return query.filter(filters.release_status_clause(status))
 
 
 def filter_release_rollback(query, rollback):
     """
     Filter the given query by whether the releases are rollbacks or not
 
+    A release is a rollback if any of its packages is, see
+    Release.has_rollback.
+
     :param query: Query object
     :param boolean rollback:
     :return:
     """
-    if rollback is True:
-        # Only count releases which have a rollback package
-        query = query.filter(
-            Release.packages.any(Package.rollback == True)
-        )
-    elif rollback is False:
-        # Only count releases which do not have any rollback packages
-        query = query.filter(
-            ~Release.packages.any(Package.rollback == True)
-        )
-    else:  # What the hell did you pass?
-        raise TypeError(
-            "Bad rollback parameter: '{}', type {}. Boolean expected.".format(
-                rollback, type(rollback)))
-    return query
+    validate_release_rollback(rollback)
+    return query.filter(Release.has_rollback == rollback)
 
 
-def apply_filters(query, args):
+def apply_filters(query, args, packages=False):
     """
     Apply filters to a query
 
     :param query: Query object to apply filters to
     :param args: Dictionary of arguments, usually request.args
+    :param boolean packages: Whether the query is of packages joined to their
+        releases, in which case package_ arguments filter the packages
+        queried. Otherwise they filter releases by any of their packages.
 
     :return: filtered query object
     """
-
-    for field, value in args.items():
-        if field == 'latest':  # this is not a comparison
-            continue
-
-        # special logic for these ones, as they are release attributes that
-        # are JIT calculated from package attributes
-        if field == 'status':
-            query = filter_release_status(query, value)
-            continue
-        if field == 'rollback':
-            query = filter_release_rollback(query, value)
-            continue
-
-        if field.startswith('package_'):
-            # Package attribute. Ensure source query does a join on Package.
-            db_table = Package
-            field = '_'.join(field.split('_')[1:])
-        else:
-            db_table = Release
-
-        comparison = '=='
-        time_absolute = False
-        time_delta = False
-        strip_last = False
-        sub_field = None
-
-        if field.endswith('_gt'):
-            strip_last = True
-            comparison = '>'
-        if field.endswith('_lt'):
-            strip_last = True
-            comparison = '<'
-        if field.endswith('_before'):
-            strip_last = True
-            comparison = '<'
-            time_absolute = True
-        if field.endswith('_after'):
-            strip_last = True
-            comparison = '>'
-            time_absolute = True
-        if 'duration' in field.split('_'):
-            time_delta = True
-        if field == 'platform':
-            field = 'platforms'
-            comparison = 'any'
-            sub_field = Platform.name
-        if field == 'reference':
-            field = 'references'
-            comparison = 'like'
-            value = '%{}%'.format(value)
-
-        if strip_last:
-            # Strip anything after the last underscore inclusive
-            field = '_'.join(field.split('_')[:-1])
-
-        filter_field = getattr(db_table, field)
-
-        # Booleans
-        if value in ('True', 'true'):
-            value = True
-        if value in ('False', 'false'):
-            value = False
-
-        # Time related
-        if time_delta:
-            value = datetime.timedelta(seconds=int(value))
-        if time_absolute:
-            value = arrow.get(value)
-
-        # Do comparisons
-        app.logger.debug(
-            "Filtering: {} {} {}".format(filter_field, comparison, value))
-        if comparison == '==':
-            query = query.filter(filter_field == value)
-        if comparison == '<':
-            query = query.filter(filter_field < value)
-        if comparison == '>':
-            query = query.filter(filter_field > value)
-        if comparison == 'any':
-            query = query.filter(filter_field.any(sub_field == value))
-        if comparison == 'like':
-            query = query.filter(filter_field.like(value))
-
-    return query
+    compiled = filters.compile_filters(Release, args, packages_joined=packages)
+    return query.filter(*compiled.clauses())
 
 
 def apply_package_filters(query, args):
@@ -195,128 +122,202 @@ def apply_package_filters(query, args):
     :param args:
     :return:
     """
-    for field, value in args.items():
-        comparison = '=='
-        time_absolute = False
-        time_delta = False
-        strip_last = False
-
-        if field.endswith('_gt'):
-            strip_last = True
-            comparison = '>'
-        if field.endswith('_lt'):
-            strip_last = True
-            comparison = '<'
-        if field.endswith('_before'):
-            strip_last = True
-            comparison = '<'
-            time_absolute = True
-        if field.endswith('_after'):
-            strip_last = True
-            comparison = '>'
-            time_absolute = True
-        if 'duration' in field.split('_'):
-            time_delta = True
-
-        if strip_last:
-            # Strip anything after the last underscore inclusive
-            field = '_'.join(field.split('_')[:-1])
-
-        filter_field = getattr(Package, field)
-
-        # Booleans
-        if value in ('True', 'true'):
-            value = True
-        if value in ('False', 'false'):
-            value = False
-
-        # Time related
-        if time_delta:
-            value = datetime.timedelta(seconds=int(value))
-        if time_absolute:
-            value = arrow.get(value)
-
-        # Do comparisons
-        app.logger.debug(
-            "Filtering: {} {} {}".format(filter_field, comparison, value))
-        if comparison == '==':
-            query = query.filter(filter_field == value)
-        if comparison == '<':
-            query = query.filter(filter_field < value)
-        if comparison == '>':
-            query = query.filter(filter_field > value)
+    return query.filter(*filters.compile_filters(Package, args).clauses())
 
-    return query
 
+def parse_int(name, value):
+    """
+    Parse an integer request argument
 
-def build_query(object_type, limit=None, offset=None, asc=None, **kwargs):
+    :param string name: Name of the argument, for the error message
+    :param value: The value to parse
+    :return: int
     """
-    Return whole releases, based on filters
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidUsage("{} must be a valid integer value".format(name))
 
-    :param object_type: Object type to query, Release or Package
-    :param limit: Max number of results to return
-    :param offset: Offset results. Provides pagination when combined with limit.
-    :param asc: Sort ascending instead of the default descending order
-    :param kwargs: Request arguments
-    :return:
+
+def encode_cursor(item):
+    """
+    Return an opaque cursor for the position after an item
+
+    :param item: Release or Package
+    :return: string
+    """
+    stime = item.stime.isoformat() if item.stime else None
+    data = json.dumps([stime, item.id.hex]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return the (stime, id) position of a cursor from encode_cursor
+
+    :param string cursor:
+    :return: (Arrow or None, UUID)
+    """
+    try:
+        cursor = str(cursor)
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        stime, item_id = json.loads(data.decode('utf-8'))
+        return (arrow.get(stime) if stime else None), uuid.UUID(item_id)
+    except (TypeError, ValueError, UnicodeError, arrow.parser.ParserError):
+        raise InvalidUsage("Invalid cursor: {}".format(cursor))
+
+
+def apply_cursor(query, object_type, stime, item_id, asc=False):
     """
-    if object_type is Release:
-        filter_function = apply_filters
-    elif object_type is Package:
-        filter_function = apply_package_filters
+    Filter a query to the items after a cursor position, in (stime, id) order
+
+    Null start times sort after all others ascending, and before all others
+    descending, as in build_query.
+
+    :param query: Query object
+    :param object_type: Release or Package
+    :param stime: Start time of the cursor, may be a bound parameter
+    :param item_id: Id of the cursor, may be a bound parameter
+    :param boolean asc: Whether the query is in ascending order
+    :return: Query
+    """
+    stime_null = object_type.stime.is_(None)
+
+    if stime is None:
+        if asc:
+            after = and_(stime_null, object_type.id > item_id)
+        else:
+            after = and_(stime_null, object_type.id < item_id)
     else:
+        position = tuple_(object_type.stime, object_type.id)
+        # Typed explicitly, as binds in a tuple are not typed from the columns
+        cursor_position = tuple_(
+            type_coerce(stime, object_type.stime.type),
+            type_coerce(item_id, object_type.id.type))
+        if asc:
+            after = position > cursor_position
+        else:
+            after = position < cursor_position
+
+    # The rest of the null or non-null start times, then all of the others if
+    # they come next. A union rather than an OR, so that each half is a range
+    # scan of the (stime, id) index.
+    if asc and stime is not None:
+        return query.filter(after).union_all(query.filter(stime_null))
+    if not asc and stime is None:
+        return query.filter(after).union_all(
+            query.filter(object_type.stime.isnot(None)))
+    return query.filter(after)
+
+
+def query_steps(object_type, limit=None, offset=None, asc=None, cursor=None,
+                **kwargs):
+    """
+    Work out how to build the query for a set of build_query arguments
+
+    The steps build the query with bound parameters in place of the values of
+    the arguments, so the SQL they produce depends only on the shape of the
+    arguments: which were given, and which were null. That is summarised as a
+    hashable key.
+
+    :return: (shape key, list of functions of a Query which return a Query,
+        dict of bound parameter values)
+    """
+    if object_type not in (Release, Package):
         raise OrloError("build_query does not support object {}".format(
             object_type
         ))
 
-    if any(field.startswith('package_') for field in kwargs.keys()) \
-            or ("status" in kwargs.keys() and object_type is Release):
-        if object_type is not Release:
-            raise InvalidUsage(
-                "'package_' parameters are only valid for Release queries. "
-                "(hint: retry without the package_ prefix)")
+    shape = [object_type.__name__]
+    steps = []
+    params = {}
+
+    compiled = filters.compile_filters(object_type, kwargs)
+    shape.extend(compiled.shape)
+    params.update(compiled.params)
+    if compiled.predicates:
+        steps.append(lambda q: q.filter(*compiled.clauses(bindparam)))
+
+    asc = bool(asc)
+    if cursor:
+        if offset:
+            raise InvalidUsage("cursor and offset can not be used together")
+        stime, item_id = decode_cursor(cursor)
+        stime_null = stime is None
+        shape.append(('cursor', stime_null))
+        params['cursor_id'] = item_id
+        if stime_null:
+            steps.append(lambda q: apply_cursor(
+                q, object_type, None, bindparam('cursor_id'), asc))
         else:
-            # Package attributes need the join, as does status as it's really a
-            # package attribute
-            query = db.session.query(object_type).join(Package)
+            params['cursor_stime'] = stime
+            steps.append(lambda q: apply_cursor(
+                q, object_type, bindparam('cursor_stime'),
+                bindparam('cursor_id'), asc))
+
+    # Explicit about nulls so that the order is the same on all databases,
+    # and matches apply_cursor
+    shape.append(('asc', asc))
+    if asc:
+        steps.append(lambda q: q.order_by(object_type.stime.asc().nullslast(),
+                                          object_type.id.asc()))
     else:
-        # No need to join on package if none of our params need it
-        query = db.session.query(object_type)
+        steps.append(lambda q: q.order_by(
+            object_type.stime.desc().nullsfirst(), object_type.id.desc()))
 
-    for key in kwargs.keys():
-        if isinstance(kwargs[key], bool):
-            continue
-        if kwargs[key].lower() in ['null', 'none']:
-            kwargs[key] = None
+    if limit:
+        shape.append('limit')
+        params['limit'] = parse_int('limit', limit)
+        steps.append(lambda q: q.limit(bindparam('limit', type_=Integer)))
+    if offset:
+        shape.append('offset')
+        params['offset'] = parse_int('offset', offset)
+        steps.append(lambda q: q.offset(bindparam('offset', type_=Integer)))
 
-    try:
-        query = filter_function(query, kwargs)
-    except AttributeError as e:
-        raise InvalidUsage(
-            "An invalid field for table {} was specified: {}".format(
-                object_type.__tablename__, e.args[0]))
+    return tuple(shape), steps, params
 
-    if asc:
-        stime_field = object_type.stime.asc
-    else:
-        stime_field = object_type.stime.desc
 
-    query = query.order_by(stime_field())
+def build_query(object_type, limit=None, offset=None, asc=None, cursor=None,
+                **kwargs):
+    """
+    Return whole releases, based on filters
 
-    if limit:
-        try:
-            limit = int(limit)
-        except ValueError:
-            raise InvalidUsage("limit must be a valid integer value")
-        query = query.limit(limit)
-    if offset:
-        try:
-            offset = int(offset)
-        except ValueError:
-            raise InvalidUsage("offset must be a valid integer value")
-        query = query.offset(offset)
+    Results are ordered by stime, then id. For pagination, a cursor from the
+    last item of a page fetches the next one at the same cost as the first,
+    unlike an offset, which the database must scan through.
+
+    :param object_type: Object type to query, Release or Package
+    :param limit: Max number of results to return
+    :param offset: Offset results. Provides pagination when combined with limit.
+    :param asc: Sort ascending instead of the default descending order
+    :param cursor: Only return results after this cursor, see encode_cursor
+    :param kwargs: Request arguments
+    :return:
+    """
+    shape, steps, params = query_steps(
+        object_type, limit=limit, offset=offset, asc=asc, cursor=cursor,
+        **kwargs)
+    query = db.session.query(object_type)
+    for step in steps:
+        query = step(query)
+    return query.params(params)
+
+
+def build_cached_query(object_type, **kwargs):
+    """
+    As build_query, but built and compiled once for each shape of arguments
+
+    The result can be iterated like a Query, but is not one. See
+    cache.StatementCache.
+
+    :param object_type: Object type to query, Release or Package
+    :param kwargs: Arguments as for build_query
+    :return: sqlalchemy.ext.baked.Result
+    """
+    shape, steps, params = query_steps(object_type, **kwargs)
+    return statement_cache.query(db.session(), object_type, shape, steps,
+                                 params)
 
-    return query
 
 def packages():
     pass
@@ -466,7 +467,9 @@ def package_versions(platform=None, by_release=False):
 
     It is not sufficient to just return the highest version of each successful
     package, as they can be rolled back, so we determine the version by last
-    release time
+    release time. The current version on each platform is kept in
+    package_current_version as packages succeed, see
+    orm.update_current_versions.
 
     :param platform: Platform to filter on
     :param bool by_release: If true, a package, that is part of a release which
@@ -475,35 +478,31 @@ def package_versions(platform=None, by_release=False):
         current version as long as its own status is SUCCESSFUL.
         Default: False.
     """
-
-    # Sub query gets a list of successful packages by last successful release
-    # time
-    sub_q = db.session.query(
-            Package.name.label('name'),
-            db.func.max(Package.stime).label('max_stime')) \
-        .filter(Package.status == 'SUCCESSFUL')
-
-    if platform or by_release:
-        # Need to join on Release
-        sub_q = sub_q.join(Release)
-    if platform:  # filter by platform
-        sub_q = sub_q.filter(Release.platforms.any(Platform.name == platform))
     if by_release:
-        # Filter out packages which are part of a release in progress,
-        # see issue#52
-        sub_q = filter_release_status(sub_q, status="SUCCESSFUL")
+        version = PackageCurrentVersion.release_version
+        stime = PackageCurrentVersion.release_stime
+    else:
+        version = PackageCurrentVersion.version
+        stime = PackageCurrentVersion.stime
 
-    sub_q = sub_q \
-        .group_by(Package.name) \
+    if platform:
+        # One platform is a range of the primary key
+        return db.session.query(PackageCurrentVersion.package, version) \
+            .filter(PackageCurrentVersion.platform == platform) \
+            .filter(version.isnot(None))
+
+    # Otherwise the newest version across the platforms
+    sub_q = db.session.query(
+            PackageCurrentVersion.package.label('name'),
+            db.func.max(stime).label('max_stime')) \
+        .filter(version.isnot(None)) \
+        .group_by(PackageCurrentVersion.package) \
         .subquery()
 
-    # q inner-joins Package table with sub_q to get the version
-    q = db.session.query(
-            Package.name,
-            Package.version) \
-        .join(sub_q, and_(sub_q.c.max_stime == Package.stime,
-                          sub_q.c.name == Package.name)) \
-        .group_by(Package.name, Package.version)
+    q = db.session.query(PackageCurrentVersion.package, version) \
+        .join(sub_q, and_(sub_q.c.max_stime == stime,
+                          sub_q.c.name == PackageCurrentVersion.package)) \
+        .group_by(PackageCurrentVersion.package, version)
 
     return q
 
@@ -525,25 +524,24 @@ def count_releases(user=None, package=None, team=None, platform=None,
     :return: Query
 
     Note that rollback and status are special fields when applied to a
-    release, as they are Package attributes.
+    release, as they are derived from Package attributes.
 
-    A "successful" or "in progress" release is defined as a release where all
-    packages match the status. Conversely, a "failed" or "not started" release
-    is defined as a release where any package matches.
+    A "failed" release is one where any package failed. Otherwise it is "in
+    progress" if any package is in progress, or some packages have finished
+    and others have not started. A "successful" release is one where all
+    packages were successful, and a "not started" release one where none
+    have started.
 
     For rollbacks, if any package is a rollback the release is included,
     otherwise if all packages are not rollbacks the release obviously isn't
     either.
-
-    Implication of this is that a release can be both "failed" and "in
-    progress".
     """
 
     args = {
         'user': user, 'package': package, 'team': team, 'platform': platform,
         'status': status, 'rollback': rollback, 'stime': stime, 'ftime': ftime,
     }
-    app.logger.debug("Entered count_releases with args: {}".format(str(args)))
+    app.logger.debug("Entered count_releases with args: %s", args)
 
     query = db.session.query(db.func.count(Release.id.distinct())).join(Package)
 
@@ -569,6 +567,170 @@ def count_releases(user=None, package=None, team=None, platform=None,
     return query
 
 
+def add_release_category(query):
+    """
+    Add the stats category of each release to a query on releases or packages
+
+    Adds two columns, rollback_category ("normal" or "rollback") and
+    status_category ("successful" or "failed"), the same categories as
+    filtering with filter_release_rollback and filter_release_status.
+    Releases which are neither successful nor failed, i.e. in progress, are
+    filtered out.
+
+    :param query: Query object which selects from or joins Release
+    :return: Query object
+    """
+    rollback_category = db.case(
+        [(Release.has_rollback == True, 'rollback')], else_='normal')
+    status_category = db.case(
+        [(Release.status == 'FAILED', 'failed')], else_='successful')
+
+    return query \
+        .filter(Release.status.in_(['SUCCESSFUL', 'FAILED'])) \
+        .add_columns(rollback_category.label('rollback_category'),
+                     status_category.label('status_category'))
+
+
+# Fields release_stats can group by, and the column that holds their value
+STATS_FIELDS = {
+    'user': Release.user,
+    'team': Release.team,
+    'platform': Platform.name,
+    'package': Package.name,
+}
+
+
+def release_stats(field=None, values=None, platform=None, stime=None,
+                  ftime=None):
+    """
+    Count releases by rollback and status, grouped by a field
+
+    This computes the same numbers as calling count_releases with each
+    combination of rollback=True/False and status=SUCCESSFUL/FAILED, for
+    every value of the field, but in one grouped query using conditional
+    aggregates.
+
+    :param string field: Field to group by, one of STATS_FIELDS. If None the
+        whole data set is counted as one row
+    :param list values: Only return these values of the field. None for all
+    :param string platform: Filter by platform
+    :param stime: Filter by releases that started after
+    :param ftime: Filter by releases that started before
+    :return: Query returning rows of ([value,] normal_successful,
+        normal_failed, rollback_successful, rollback_failed)
+    """
+    app.logger.debug(
+        "Entered release_stats, field %s, platform %s, stime %s, ftime %s",
+        field, platform, stime, ftime)
+
+    successful = Release.status == 'SUCCESSFUL'
+    failed = Release.status == 'FAILED'
+    normal = Release.has_rollback == False
+    rollback = Release.has_rollback == True
+
+    def count(*conditions):
+        counted = db.case([(and_(*conditions), Release.id)])
+        if field == 'package':
+            # A release can contain the same package more than once
+            counted = counted.distinct()
+        return db.func.count(counted)
+
+    columns = [
+        count(normal, successful),
+        count(normal, failed),
+        count(rollback, successful),
+        count(rollback, failed),
+    ]
+
+    if field is not None:
+        try:
+            group_column = STATS_FIELDS[field]
+        except KeyError:
+            raise InvalidUsage("Can not build stats for field {}".format(field))
+        columns.insert(0, group_column)
+
+    # Releases in progress are in neither category
+    query = db.session.query(*columns) \
+        .select_from(Release) \
+        .filter(Release.status.in_(['SUCCESSFUL', 'FAILED']))
+
+    if field == 'platform':
+        query = query.join(Release.platforms)
+    elif field == 'package':
+        query = query.join(Package, Package.release_id == Release.id)
+
+    # When grouping by platform, the group is the platform filter
+    if platform and field != 'platform':
+        query = query.filter(Release.platforms.any(Platform.name == platform))
+    if stime:
+        query = query.filter(Release.stime >= stime)
+    if ftime:
+        query = query.filter(Release.stime <= ftime)
+
+    if field is not None:
+        if values is not None:
+            in_values = group_column.in_([v for v in values if v is not None])
+            if None in values:
+                in_values = or_(in_values, group_column.is_(None))
+            query = query.filter(in_values)
+        query = query.group_by(group_column)
+
+    return query
+
+
+def restore_incidents(stime=None, ftime=None):
+    """
+    Find failed deploys of a package to a platform, and when they were fixed
+
+    An incident starts with a FAILED package, and ends with the next
+    SUCCESSFUL package of the same name on the same platform. Consecutive
+    failures belong to the same incident. A running count of successes over
+    each package and platform, less the success of the row itself, numbers
+    the incidents, so they are found in one pass with a window function.
+
+    :param stime: Only consider packages which started after
+    :param ftime: Only consider packages which started before
+    :return: Query returning rows of (package, platform, team, failed time,
+        restored time), where restored time is None if the incident is still
+        open. Team is that of the first failed release.
+    """
+    successful = Package.status == 'SUCCESSFUL'
+    failed = Package.status == 'FAILED'
+    is_success = db.case([(successful, 1)], else_=0)
+    finished = db.func.coalesce(Package.ftime, Package.stime)
+
+    query = db.session.query(
+        Package.name.label('package'),
+        Platform.name.label('platform'),
+        Release.team.label('team'),
+        db.case([(failed, finished)]).label('failed_time'),
+        db.case([(successful, finished)]).label('restored_time'),
+        (db.func.sum(is_success).over(
+            partition_by=(Package.name, Platform.name),
+            order_by=(Package.stime, Package.id)) - is_success
+         ).label('incident'),
+    ) \
+        .join(Release, Release.id == Package.release_id) \
+        .join(Release.platforms) \
+        .filter(or_(successful, failed))
+    if stime:
+        query = query.filter(Package.stime >= stime)
+    if ftime:
+        query = query.filter(Package.stime <= ftime)
+    runs = query.subquery()
+
+    failed_time = db.func.min(runs.c.failed_time)
+    return db.session.query(
+        runs.c.package,
+        runs.c.platform,
+        db.func.min(db.case([(runs.c.failed_time.isnot(None), runs.c.team)])),
+        failed_time,
+        db.func.min(runs.c.restored_time),
+    ) \
+        .group_by(runs.c.package, runs.c.platform, runs.c.incident) \
+        .having(failed_time.isnot(None))
+
+
 def count_packages(user=None, team=None, platform=None, status=None,
                    rollback=None):
     """
@@ -0,0 +1,408 @@
+from __future__ import print_function
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+from operator import itemgetter
+import arrow
+from sqlalchemy import bindparam, or_, text
+from sqlalchemy.dialects import mysql, postgresql
+from orlo.app import app
+from orlo.config import config
+from orlo.orm import db, Release, Package, Platform, ReleaseStatsRollup, \
+    release_platform
+from orlo.util import chunks
+import orlo.queries as queries
+from orlo import executor
+
+__author__ = 'alforbes'
+
+"""
+Maintenance of, and queries against, the release stats rollup table
+
+The rollup holds the same counts as queries.release_stats, but per hour, so
+that stats requests read a number of rows proportional to the time range
+rather than to the number of releases in it.
+"""
+
+COUNT_COLUMNS = (
+    'normal_successful', 'normal_failed',
+    'rollback_successful', 'rollback_failed',
+)
+
+KEY_COLUMNS = ('bucket', 'platform', 'team', 'user', 'package')
+
+ONE_HOUR = datetime.timedelta(hours=1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def enabled():
+    """
+    Whether the rollup is maintained and used for stats
+    """
+    return config.getboolean('stats', 'rollup')
+
+
+def _release_category(status, rollback):
+    """
+    Return the index in COUNT_COLUMNS a release is counted under, or None
+
+    Releases which are neither successful nor failed, i.e. in progress, are
+    not counted.
+    """
+    if status == 'FAILED':
+        category = 1
+    elif status == 'SUCCESSFUL':
+        category = 0
+    else:
+        return None
+    return category + 2 if rollback else category
+
+
+def release_contributions(release_ids):
+    """
+    Work out what the given releases currently add to the rollup
+
+    :param list release_ids: Releases to look at
+    :return: dict of (bucket, platform, team, user, package) to a list of
+        counts, in the order of COUNT_COLUMNS
+    """
+    release_ids = list(release_ids)
+    contributions = defaultdict(lambda: [0] * len(COUNT_COLUMNS))
+    if not release_ids:
+        return contributions
+
+    releases = db.session.query(
+        Release.id, Release.stime, Release.team, Release.user,
+        Release.status, Release.has_rollback) \
+        .filter(Release.id.in_(release_ids))
+
+    platforms = defaultdict(set)
+    for release_id, name in db.session.query(
+            release_platform.c.release_id, Platform.name) \
+            .join(Platform, Platform.id == release_platform.c.platform_id) \
+            .filter(release_platform.c.release_id.in_(release_ids)):
+        platforms[release_id].add(name)
+
+    packages = defaultdict(set)
+    for release_id, name in db.session.query(Package.release_id, Package.name) \
+            .filter(Package.release_id.in_(release_ids)):
+        packages[release_id].add(name)
+
+    for release_id, stime, team, user, status, rollback in releases:
+        category = _release_category(status, rollback)
+        if category is None:
+            continue
+        bucket = stime.to('UTC').floor('hour') if stime else None
+
+        # Null means "all", see ReleaseStatsRollup
+        release_platforms = [None] + list(platforms[release_id])
+        release_packages = [None] + list(packages[release_id])
+        for platform in release_platforms:
+            for package in release_packages:
+                key = (bucket, platform, team, user, package)
+                contributions[key][category] += 1
+
+    return contributions
+
+
+def key_hash(key):
+    """
+    Return the digest of a rollup key, which is unique in the rollup
+
+    :param tuple key: bucket, platform, team, user and package, as in
+        release_contributions
+    """
+    bucket = key[0]
+    values = [bucket.to('UTC').isoformat() if bucket is not None else None]
+    values.extend(key[1:])
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def _rows(contributions):
+    """
+    Return rollup rows for contributions, as dicts of column values
+
+    :param contributions: Iterable of (key, counts)
+    """
+    return [
+        dict(zip(KEY_COLUMNS, key), key_hash=key_hash(key),
+             **dict(zip(COUNT_COLUMNS, counts)))
+        for key, counts in contributions
+    ]
+
+
+def _sqlite_upsert():
+    """
+    Return an INSERT ... ON CONFLICT DO UPDATE for SQLite, which SQLAlchemy
+    has no construct for
+    """
+    table = ReleaseStatsRollup.__table__
+    columns = ('key_hash',) + KEY_COLUMNS + COUNT_COLUMNS
+    quote = db.engine.dialect.identifier_preparer.quote
+    return text(
+        "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (key_hash) "
+        "DO UPDATE SET {}".format(
+            table.name,
+            ', '.join(quote(c) for c in columns),
+            ', '.join(':' + c for c in columns),
+            ', '.join('{0} = {0} + excluded.{0}'.format(c)
+                      for c in COUNT_COLUMNS))
+    ).bindparams(*[bindparam(c, type_=table.c[c].type) for c in columns])
+
+
+def _upsert(rows):
+    """
+    Add the counts of rollup rows to those of their keys, inserting the keys
+    which are not in the rollup
+
+    :param list rows: Return value of _rows
+    """
+    table = ReleaseStatsRollup.__table__
+    # In order, so that concurrent upserts wait on each other rather than
+    # deadlock
+    rows = sorted(rows, key=itemgetter('key_hash'))
+    dialect = db.engine.dialect
+    if dialect.name == 'postgresql':
+        insert = postgresql.insert(table)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=['key_hash'],
+            set_=dict((c, table.c[c] + insert.excluded[c])
+                      for c in COUNT_COLUMNS)), rows)
+    elif dialect.name == 'sqlite' and \
+            dialect.dbapi.sqlite_version_info >= (3, 24):
+        db.session.execute(_sqlite_upsert(), rows)
+    elif dialect.name == 'mysql':
+        insert = mysql.insert(table)
+        db.session.execute(insert.on_duplicate_key_update(**dict(
+            (c, table.c[c] + insert.inserted[c]) for c in COUNT_COLUMNS)),
+            rows)
+    else:
+        # Without an upsert, a key another transaction inserts meanwhile
+        # fails this one on the unique key_hash
+        existing = set()
+        for chunk in chunks([r['key_hash'] for r in rows], 500):
+            existing.update(h for h, in db.session.query(
+                ReleaseStatsRollup.key_hash)
+                .filter(ReleaseStatsRollup.key_hash.in_(chunk)))
+        updates = [
+            dict(('b_' + c, r[c]) for c in ('key_hash',) + COUNT_COLUMNS)
+            for r in rows if r['key_hash'] in existing]
+        inserts = [r for r in rows if r['key_hash'] not in existing]
+        if updates:
+            db.session.execute(
+                table.update()
+                .where(table.c.key_hash == bindparam('b_key_hash'))
+                .values(dict((c, table.c[c] + bindparam('b_' + c))
+                             for c in COUNT_COLUMNS)),
+                updates)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+
+
+def apply_contributions(before, after):
+    """
+    Add the difference between two sets of contributions to the rollup
+
+    The differences of all the keys are written together, see _upsert.
+
+    :param dict before: Return value of release_contributions before a change
+    :param dict after: Return value of release_contributions after it
+    """
+    deltas = []
+    for key in set(before) | set(after):
+        delta = [a - b for a, b in zip(
+            after.get(key, [0] * len(COUNT_COLUMNS)),
+            before.get(key, [0] * len(COUNT_COLUMNS)))]
+        if any(delta):
+            deltas.append((key, delta))
+    if deltas:
+        _upsert(_rows(deltas))
+
+
+class track_releases(object):
+    """
+    Context manager which applies changes made to releases to the rollup
+
+    Snapshots what the releases contribute on entry, and on a clean exit
+    flushes the session and adds the difference. Nothing is committed, so the
+    rollup changes in the same transaction as the releases.
+    """
+    def __init__(self, *release_ids):
+        self.release_ids = release_ids
+        self.before = None
+
+    def __enter__(self):
+        if enabled():
+            self.before = release_contributions(self.release_ids)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self.before is not None:
+            db.session.flush()
+            apply_contributions(
+                self.before, release_contributions(self.release_ids))
+
+
+def rebuild(batch_size=1000):
+    """
+    Rebuild the rollup from the release and package tables
+
+    :param int batch_size: Number of releases to read at a time
+    :return: The number of rollup rows written
+    """
+    app.logger.info("Rebuilding release stats rollup")
+    db.session.query(ReleaseStatsRollup).delete(synchronize_session=False)
+
+    totals = defaultdict(lambda: [0] * len(COUNT_COLUMNS))
+    last_id = None
+    while True:
+        query = db.session.query(Release.id).order_by(Release.id)
+        if last_id is not None:
+            query = query.filter(Release.id > last_id)
+        release_ids = [r[0] for r in query.limit(batch_size)]
+        if not release_ids:
+            break
+        for key, counts in release_contributions(release_ids).items():
+            totals[key] = [t + c for t, c in zip(totals[key], counts)]
+        last_id = release_ids[-1]
+
+    db.session.bulk_insert_mappings(ReleaseStatsRollup,
+                                    _rows(totals.items()))
+    db.session.commit()
+    app.logger.info("Rebuilt release stats rollup, %s rows", len(totals))
+    return len(totals)
+
+
+def _split_time_range(stime, ftime):
+    """
+    Split a time range into whole hour buckets and partial hours at the ends
+
+    :return: first and last bucket to read from the rollup (either may be
+        None for an open range, and first may be after last if there are no
+        whole buckets), and a list of (stime, ftime) ranges to count from the
+        raw tables
+    """
+    first = last = None
+    edges = []
+    if stime is not None:
+        stime = arrow.get(stime).to('UTC')
+        first = stime.floor('hour')
+        if first != stime:
+            first += ONE_HOUR
+            edges.append((stime, first - ONE_MICROSECOND))
+    if ftime is not None:
+        ftime = arrow.get(ftime).to('UTC')
+        last = ftime.floor('hour')
+        if ftime != ftime.ceil('hour'):
+            edges.append((last, ftime))
+            last -= ONE_HOUR
+    if first is not None and last is not None and first > last:
+        # No whole hours in range, the edges may overlap
+        return first, last, [(stime, ftime)]
+    return first, last, edges
+
+
+def _rollup_query(field, values, platform, first, last):
+    """
+    Query the rollup in the same shape as queries.release_stats
+    """
+    columns = [
+        db.func.coalesce(db.func.sum(getattr(ReleaseStatsRollup, c)), 0)
+        for c in COUNT_COLUMNS
+    ]
+    group_column = None
+    if field is not None:
+        group_column = getattr(ReleaseStatsRollup, field)
+        columns.insert(0, group_column)
+
+    query = db.session.query(*columns)
+
+    if field == 'platform':
+        query = query.filter(ReleaseStatsRollup.platform.isnot(None))
+    elif platform:
+        query = query.filter(ReleaseStatsRollup.platform == platform)
+    else:
+        query = query.filter(ReleaseStatsRollup.platform.is_(None))
+
+    if field == 'package':
+        query = query.filter(ReleaseStatsRollup.package.isnot(None))
+    else:
+        query = query.filter(ReleaseStatsRollup.package.is_(None))
+
+    if first is not None:
+        query = query.filter(ReleaseStatsRollup.bucket >= first)
+    if last is not None:
+        query = query.filter(ReleaseStatsRollup.bucket <= last)
+
+    if group_column is not None:
+        if values is not None:
+            in_values = group_column.in_([v for v in values if v is not None])
+            if None in values:
+                in_values = or_(in_values, group_column.is_(None))
+            query = query.filter(in_values)
+        query = query.group_by(group_column)
+
+    return query
+
+
+def release_stats_queries(field=None, values=None, platform=None,
+                          stime=None, ftime=None):
+    """
+    Return the queries release_stats runs, which are independent of each other
+
+    Whole hours are read from the rollup, and any partial hours at the ends of
+    the time range are counted from the raw tables.
+
+    :return: list of Query objects, see merge_release_stats
+    """
+    if field is not None and field not in queries.STATS_FIELDS:
+        # Let release_stats raise the error
+        queries.release_stats(field)
+
+    first, last, edges = _split_time_range(stime, ftime)
+
+    stats_queries = [
+        queries.release_stats(field, values, platform, edge_stime, edge_ftime)
+        for edge_stime, edge_ftime in edges
+    ]
+    if first is None or last is None or first <= last:
+        stats_queries.append(
+            _rollup_query(field, values, platform, first, last))
+    return stats_queries
+
+
+def merge_release_stats(field, results):
+    """
+    Add up the rows of the queries from release_stats_queries
+
+    :param string field: The field given to release_stats_queries
+    :param list results: list of the rows of each query
+    :return: list of rows
+    """
+    totals = defaultdict(lambda: [0] * len(COUNT_COLUMNS))
+    for rows in results:
+        for row in rows:
+            if field is None:
+                key, counts = None, row
+            else:
+                key, counts = row[0], row[1:]
+            totals[key] = [t + int(c) for t, c in zip(totals[key], counts)]
+
+    if field is None:
+        return [tuple(totals[None])]
+    return [(key,) + tuple(counts) for key, counts in totals.items()]
+
+
+def release_stats(field=None, values=None, platform=None, stime=None,
+                  ftime=None):
+    """
+    Count releases by rollback and status from the rollup
+
+    Takes the same arguments and returns the same rows as
+    queries.release_stats. The result is exact, see release_stats_queries.
+
+    :return: list of rows
+    """
+    return merge_release_stats(field, executor.run_queries(
+        release_stats_queries(field, values, platform, stime, ftime)))
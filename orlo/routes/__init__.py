@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import orlo.routes.base
+import orlo.routes.events
 import orlo.routes.import_
 import orlo.routes.info
 import orlo.routes.internal
@@ -10,15 +10,28 @@ Base application routes and general functions
 """
 
 
+def unlogged_body(function):
+    """
+    Decorator for views whose request body is not to be logged, as it is read
+    from the stream rather than held in memory
+    """
+    function.log_body = False
+    return function
+
+
 @app.before_request
 def log_post_data():
     """
     Before each request, log any POST data, without newlines
     """
     s = "{m} {u}".format(m=request.method, u=request.url)
-    data = request.get_data(as_text=True)
-    if data:
-        s += " POST data: {}".format(data.replace('\n', ''))
+    view = app.view_functions.get(request.endpoint)
+    if getattr(view, 'log_body', True):
+        data = request.get_data(as_text=True)
+        if data:
+            s += " POST data: {}".format(data.replace('\n', ''))
+    elif request.content_length:
+        s += " POST data: {} bytes".format(request.content_length)
     app.logger.info(s)
 
 
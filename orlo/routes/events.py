@@ -0,0 +1,62 @@
+from __future__ import print_function
+from flask import jsonify, request
+from orlo.app import app
+from orlo.cache import bump_data_version
+from orlo.events import apply_events
+from orlo.exceptions import InvalidUsage
+from orlo.orm import db
+from orlo.user_auth import conditional_auth, token_auth
+from orlo.util import validate_request_json
+
+__author__ = 'alforbes'
+
+
+@app.route('/events', methods=['POST'])
+@conditional_auth(token_auth.token_required)
+def post_events():
+    """
+    Apply a batch of workflow events, across any number of releases
+
+    Each event does what the workflow endpoint of the same name does, in the
+    order given, and all of them are committed together. The releases and
+    packages referred to are fetched in bulk, rather than per event. An event
+    which can not be applied, e.g. stopping a package which has not started,
+    is reported in its outcome, and the rest still are.
+
+    :<json array events: Events, each with a type, a release_id, and:
+
+        - release_start, release_stop: nothing else
+        - package_start: package_id
+        - package_stop: package_id, and success, whether it succeeded
+        - release_note: text
+        - release_metadata: metadata, an object of keys and values
+
+    :>json array events: Outcome of each event, in the order given, with ok
+        whether it was applied, and message why not
+    :reqheader Content-Type: Must be application/json
+    :status 200: The batch was processed
+    :status 400: Invalid request
+
+    **Example curl**:
+
+    .. sourcecode:: shell
+
+        curl -H "Content-Type: application/json" \\
+        -X POST http://127.0.0.1/events \\
+        -d '{"events": [
+        {"type": "package_start", "release_id": "'${RELEASE_ID}'",
+         "package_id": "'${PACKAGE_ID}'"},
+        {"type": "package_stop", "release_id": "'${RELEASE_ID}'",
+         "package_id": "'${PACKAGE_ID}'", "success": true},
+        {"type": "release_stop", "release_id": "'${RELEASE_ID}'"}]}'
+    """
+    validate_request_json(request)
+    events = request.json.get('events')
+    if not isinstance(events, list):
+        raise InvalidUsage("JSON doc missing events list")
+
+    outcomes = apply_events(events)
+
+    bump_data_version()
+    db.session.commit()
+    return jsonify(events=outcomes)
@@ -1,11 +1,11 @@
-import arrow
-import json
 from flask import jsonify, request
 from orlo.app import app
-from orlo.orm import db, Package, Release, PackageResult, ReleaseNote, Platform
+from orlo.exceptions import InvalidUsage
+from orlo.importer import import_releases, stream_import, iter_ndjson, \
+    JSONArrayReader
+from orlo.routes.base import unlogged_body
 from orlo.util import validate_request_json
 from orlo.user_auth import token_auth
-from sqlalchemy.orm import exc
 
 __author__ = 'alforbes'
 
@@ -82,67 +82,66 @@ def post_import():
         curl -v -X POST -d @releases.json 'http://127.0.0.1:5000/releases/import' -H \
         "Content-Type: application/json"
 
+    Releases are written and committed in chunks, see the import chunk_size
+    option. If a release is invalid, the import stops with a 400, and the
+    chunks before it are kept. The response then lists their ids under
+    "releases".
+
     :status 200: The document was accepted
+    :status 400: A release is invalid
     """
 
     validate_request_json(request)
+    if not isinstance(request.json, list):
+        raise InvalidUsage("The document must be a list of releases")
+
+    release_ids = import_releases(request.json)
+
+    return jsonify({'releases': [str(x) for x in release_ids]}), 200
+
+
+@app.route('/releases/import/stream', methods=['POST'])
+@unlogged_body
+def post_import_stream():
+    """
+    Import releases, reading them from the request as it is received
+
+    For imports too large for POST /releases/import, which reads the whole
+    document before importing any of it. The releases are the same as for
+    POST /releases/import, as newline delimited JSON, one release per line,
+    or with a Content-Type of application/json, a JSON array. They are
+    imported and committed in chunks, see the import chunk_size option, so
+    that the memory used does not depend on the size of the upload. Progress
+    is logged after each chunk.
+
+    Invalid releases are skipped and reported, the rest are imported. In a
+    JSON array, an item which is not valid JSON stops the import, as the
+    next item can not be found.
 
-    releases = []
-    for r in request.json:
-        # Get the platform, create if it doesn't exist
-        platforms = []
-        for p in r['platforms']:
-            try:
-                query = db.session.query(Platform).filter(Platform.name == p)
-                platform = query.one()
-            except exc.NoResultFound:
-                app.logger.info("Creating platform {}".format(p))
-                platform = Platform(p)
-                db.session.add(platform)
-            platforms.append(platform)
-
-        release = Release(
-                platforms=platforms,
-                user=r['user'],
-                team=r.get('team'),
-                references=json.dumps(r.get('references')),
-        )
-
-        release.stime = arrow.get(r['stime']) if r.get('stime') else None
-        release.ftime = arrow.get(r['ftime']) if r.get('ftime') else None
-        if release.ftime and release.stime:
-            release.duration = release.ftime - release.stime
-
-        notes = r.get('notes')
-        if notes:
-            for n in notes:
-                note = ReleaseNote(release.id, n)
-                db.session.add(note)
-
-        for p in r['packages']:
-            package = Package(
-                    release_id=release.id,
-                    name=p['name'],
-                    version=p['version'],
-            )
-
-            package.rollback = p.get('rollback')
-            package.status = p.get('status')
-            package.diff_url = p.get('diff_url')
-
-            if p.get('stime'):
-                package.stime = arrow.get(p['stime'])
-            else:
-                package.stime = arrow.get(r['stime'])
-            package.ftime = arrow.get(p['ftime']) if p.get('ftime') else None
-            if package.stime and package.ftime:
-                package.duration = package.ftime - package.stime
-
-            db.session.add(package)
-
-        db.session.add(release)
-        db.session.commit()
-
-        releases.append(release.id)
-
-    return jsonify({'releases': [str(x) for x in releases]}), 200
+    The import is still one request, for as long as the upload and import
+    take. Under gunicorn, a sync worker is killed after its timeout, see
+    "Large imports" in the installation docs for the settings to use.
+
+    **Example curl**:
+
+    .. sourcecode:: shell
+
+        curl -X POST --data-binary @releases.ndjson \\
+        'http://127.0.0.1:5000/releases/import/stream' \\
+        -H "Content-Type: application/x-ndjson"
+
+    :>json int imported: Number of releases imported
+    :>json int invalid: Number of invalid releases
+    :>json array errors: The record number, counting from 0, and message of
+        the first invalid releases, see the import max_errors option
+    :status 200: The upload was read
+    """
+    if request.mimetype == 'application/json':
+        documents = JSONArrayReader(request.stream)
+    else:
+        documents = iter_ndjson(request.stream)
+
+    summary = stream_import(documents)
+    app.logger.info("Import finished, {} releases imported, {} invalid".format(
+        summary['imported'], summary['invalid']))
+    return jsonify(summary), 200
@@ -1,6 +1,7 @@
 from __future__ import print_function
 from flask import request, jsonify, url_for
 from orlo.app import app
+from orlo.cache import cached_response
 from orlo.util import str_to_bool
 from orlo.config import config
 import orlo.queries as queries
@@ -76,6 +77,7 @@ def info_platforms(platform=None):
 
 @app.route('/info/packages', methods=['GET'])
 @app.route('/info/packages/<package>', methods=['GET'])
+@cached_response
 def info_packages(package=None):
     """
     Summary of packages
@@ -114,6 +116,7 @@ def info_package_list():
 
 
 @app.route('/info/packages/versions', methods=['GET'])
+@cached_response
 def info_package_versions():
     """
     Return current version of all packages
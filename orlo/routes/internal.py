@@ -2,6 +2,7 @@ from __future__ import print_function
 from flask import jsonify
 from orlo.app import app
 from orlo import __version__
+from orlo.cache import response_cache, statement_cache, platform_cache
 
 __author__ = 'alforbes'
 
@@ -13,3 +14,30 @@ def internal_version():
     :return:
     """
     return jsonify({'version': __version__})
+
+
+@app.route('/internal/cache', methods=['GET'])
+def internal_cache():
+    """
+    Get the size and hit and miss counts of this process's response cache
+    :return:
+    """
+    return jsonify(response_cache.to_dict())
+
+
+@app.route('/internal/statement_cache', methods=['GET'])
+def internal_statement_cache():
+    """
+    Get the size and hit and miss counts of this process's statement cache
+    :return:
+    """
+    return jsonify(statement_cache.to_dict())
+
+
+@app.route('/internal/platform_cache', methods=['GET'])
+def internal_platform_cache():
+    """
+    Get the size and hit and miss counts of this process's platform cache
+    :return:
+    """
+    return jsonify(platform_cache.to_dict())
@@ -1,5 +1,5 @@
 from __future__ import print_function
-from flask import jsonify, request, Response, json, g
+from flask import jsonify, request, Response, json, g, stream_with_context
 from orlo.app import app
 from orlo import queries
 from orlo.exceptions import InvalidUsage
@@ -8,7 +8,8 @@ from orlo.orm import db, Release, Package, PackageResult, ReleaseNote, \
     ReleaseMetadata, Platform
 from orlo.util import validate_request_json, create_release, \
     validate_release_input, validate_package_input, fetch_release, \
-    create_package, fetch_package, stream_json_list, str_to_bool, is_uuid
+    create_package, fetch_package, stream_json_list, str_to_bool, is_uuid, \
+    peek
 from orlo.user_auth import conditional_auth
 
 __author__ = 'alforbes'
@@ -27,12 +28,16 @@ def get_packages(package_id=None):
     """
     Return a list of packages to the client
 
+    Takes limit, offset, asc and cursor arguments as for /releases, and the
+    package fields as filters.
+
     :param package_id:
     :return:
     """
 
     booleans = ('rollback', )
 
+    page_size = None
     if package_id:  # Simple, just fetch one package
         if not is_uuid(package_id):
             raise InvalidUsage("Package ID given is not a valid UUID")
@@ -48,15 +53,19 @@ def get_packages(package_id=None):
                 args[k] = str_to_bool(request.args.get(k))
             else:
                 args[k] = request.args.get(k)
-        query = queries.build_query(Package, **args)
-
-    # Execute eagerly to avoid confusing stack traces within the Response on
-    # error
-    db.session.execute(query)
+        page_size = queries.parse_int('limit', args['limit'])
+        if page_size:
+            # One extra, to find out whether there is a next page
+            args['limit'] = page_size + 1
+        query = queries.build_cached_query(Package, **args)
 
-    if query.count() == 0:
+    # Run the query once, eagerly to avoid confusing stack traces within the
+    # Response on error, and peek at the first result to see if there are any
+    first, results = peek(query)
+    if first is None:
         response = jsonify(message="No packages found", packages=[])
         return response, 404
 
-    return Response(stream_json_list('packages', query),
-                    content_type='application/json')
+    return Response(
+        stream_with_context(stream_json_list('packages', results, page_size)),
+        content_type='application/json')
@@ -1,5 +1,7 @@
-from flask import jsonify, request, Response, json, g
+from flask import jsonify, request, Response, json, g, stream_with_context
+from six import string_types
 from orlo.app import app
+from orlo.cache import bump_data_version
 from orlo import queries
 from orlo.config import config
 from orlo.exceptions import InvalidUsage
@@ -8,8 +10,12 @@ from orlo.orm import db, Release, Package, PackageResult, ReleaseNote, \
     ReleaseMetadata, Platform
 from orlo.util import validate_request_json, create_release, \
     validate_release_input, validate_package_input, fetch_release, \
-    create_package, fetch_package, stream_json_list, str_to_bool, is_uuid
+    create_package, fetch_package, stream_json_list, str_to_bool, is_uuid, \
+    peek, validate_release_document, create_package_from_document, \
+    parse_time, validate_package_batch_input, create_packages, \
+    start_packages, stop_packages
 from orlo.user_auth import conditional_auth
+from orlo.rollup import track_releases
 
 security_enabled = config.getboolean('security', 'enabled')
 
@@ -60,11 +66,99 @@ def post_releases():
     release.start()
 
     db.session.add(release)
+    bump_data_version()
     db.session.commit()
 
     return jsonify(id=release.id)
 
 
+@app.route('/releases/document', methods=['POST'])
+@conditional_auth(token_auth.token_required)
+def post_releases_document():
+    """
+    Create a release, with its packages, notes and metadata, in one request
+
+    The whole document is validated, then written in one transaction, so that
+    a release is recorded complete or not at all. This replaces calling
+    POST /releases, then POST /releases/<id>/packages and the start and stop
+    of each package, then the stop of the release.
+
+    :<json string user: User that is performing the release
+    :<json string team: The development team responsible for this release
+    :<json array platforms: List of platforms receiving the release
+    :<json array references: List of external references, e.g. Jira ticket
+    :<json string note: A note, as for POST /releases
+    :<json array notes: Notes
+    :<json object metadata: Metadata keys and values
+    :<json string stime: When the release started (default: now)
+    :<json string ftime: When the release finished. Defaults to the last
+        package ftime if every package has finished, otherwise the release is
+        left unfinished
+    :<json array packages: Packages, each with name and version, and
+        optionally diff_url, rollback, status, stime and ftime. Status is one
+        of NOT_STARTED (the default), IN_PROGRESS, SUCCESSFUL or FAILED. A
+        started package without an stime started with the release, a
+        finished package without an ftime finished now.
+    :>json string id: UUID of the created release
+    :>json array packages: UUIDs of the created packages, in the order given
+    :reqheader Content-Type: Must be application/json
+    :status 200: Release was created successfully
+    :status 400: Invalid request, nothing was created
+
+    Timestamps can be any format understood by Arrow.
+
+    **Example curl**:
+
+    .. sourcecode:: shell
+
+        curl -H "Content-Type: application/json" \\
+        -X POST \\
+        http://127.0.0.1/releases/document \\
+        -d '{"platforms": ["site1"], "user": "aforbes", "packages": [
+        {"name": "test-package", "version": "1.0.1", "status": "SUCCESSFUL"}
+        ]}'
+    """
+    validate_release_document(request)
+    document = request.json
+    release = create_release(request)
+
+    with track_releases(release.id):
+        if document.get('stime'):
+            release.stime = parse_time(document['stime'])
+
+        notes = document.get('notes') or []
+        if document.get('note'):
+            notes = [document['note']] + notes
+        for note in notes:
+            db.session.add(ReleaseNote(release.id, note))
+
+        for key, value in (document.get('metadata') or {}).items():
+            db.session.add(ReleaseMetadata(release.id, key, value))
+
+        packages = [
+            create_package_from_document(release.id, p, release.stime)
+            for p in document.get('packages') or []]
+        db.session.add_all(packages)
+
+        if document.get('ftime'):
+            release.ftime = parse_time(document['ftime'])
+        elif packages and all(p.ftime for p in packages):
+            release.ftime = max(p.ftime for p in packages)
+        if release.ftime:
+            release.duration = release.ftime - release.stime
+
+        db.session.add(release)
+
+    app.logger.info(
+        'Create release {} from document, packages: {}, platforms: {}'.format(
+            release.id, len(packages),
+            [platform.name for platform in release.platforms]))
+    bump_data_version()
+    db.session.commit()
+
+    return jsonify(id=release.id, packages=[p.id for p in packages])
+
+
 @app.route('/releases/<release_id>/packages', methods=['POST'])
 @conditional_auth(token_auth.token_required)
 def post_packages(release_id):
@@ -97,7 +191,9 @@ def post_packages(release_id):
             package.id, release.id, request.json['name'],
             request.json['version']))
 
-    db.session.add(package)
+    with track_releases(release.id):
+        db.session.add(package)
+    bump_data_version()
     db.session.commit()
 
     return jsonify(id=package.id)
@@ -119,6 +215,7 @@ def post_results(release_id, package_id):
     app.logger.info("Post results, release {}, package {}".format(
         release_id, package_id))
     db.session.add(results)
+    bump_data_version()
     db.session.commit()
     return '', 204
 
@@ -134,9 +231,11 @@ def post_releases_start(release_id):
     """
     release = fetch_release(release_id)
     app.logger.info("Release start, release {}".format(release_id))
-    release.start()
+    with track_releases(release.id):
+        release.start()
 
     db.session.add(release)
+    bump_data_version()
     db.session.commit()
     return '', 204
 
@@ -165,6 +264,7 @@ def post_releases_stop(release_id):
     release.stop()
 
     db.session.add(release)
+    bump_data_version()
     db.session.commit()
     return '', 204
 
@@ -190,9 +290,11 @@ def post_packages_start(release_id, package_id):
     package = fetch_package(release_id, package_id)
     app.logger.info("Package start, release {}, package {}".format(
         release_id, package_id))
-    package.start()
+    with track_releases(package.release_id):
+        package.start()
 
     db.session.add(package)
+    bump_data_version()
     db.session.commit()
     return '', 204
 
@@ -222,13 +324,136 @@ def post_packages_stop(release_id, package_id):
     package = fetch_package(release_id, package_id)
     app.logger.info("Package stop, release {}, package {}, success {}".format(
         release_id, package_id, success))
-    package.stop(success=success)
+    with track_releases(package.release_id):
+        package.stop(success=success)
 
     db.session.add(package)
+    bump_data_version()
     db.session.commit()
     return '', 204
 
 
+@app.route('/releases/<release_id>/packages/batch', methods=['POST'])
+@conditional_auth(token_auth.token_required)
+def post_packages_batch(release_id):
+    """
+    Add several packages to a release
+
+    The packages are created in one statement and one transaction. Invalid
+    packages are reported in the results, the rest are created.
+
+    :param string release_id: UUID of the release to add the packages to
+    :<json array packages: Packages, as for POST /releases/<id>/packages
+    :>json array packages: Result of each package, in the order given. id is
+        the UUID of the created package, ok whether it was created, and
+        message why not.
+    :reqheader Content-Type: Must be application/json
+    :status 200: The batch was processed
+    :status 400: Invalid request, or the release does not exist
+
+    **Example curl**:
+
+    .. sourcecode:: shell
+
+        curl -H "Content-Type: application/json" \\
+        -X POST http://127.0.0.1/releases/${RELEASE_ID}/packages/batch \\
+        -d '{"packages": [{"name": "test-package", "version": "1.0.1"},
+        {"name": "other-package", "version": "2.1.0"}]}'
+    """
+    documents = validate_package_batch_input(request)
+    release = fetch_release(release_id)
+
+    with track_releases(release.id):
+        results = create_packages(release.id, documents)
+
+    app.logger.info('Create packages, release {}, {} of {} created'.format(
+        release.id, len([r for r in results if r['ok']]), len(results)))
+    bump_data_version()
+    db.session.commit()
+
+    return jsonify(packages=results)
+
+
+@app.route('/releases/<release_id>/packages/start', methods=['POST'])
+@conditional_auth(token_auth.token_required)
+def post_packages_batch_start(release_id):
+    """
+    Indicate that several packages of a release have started deploying
+
+    :param string release_id: Release UUID
+    :<json array packages: UUIDs of the packages
+    :>json array packages: Result of each package, in the order given, with
+        its id, ok whether it was started, and message why not
+    :status 200: The batch was processed
+    :status 400: Invalid request, or the release does not exist
+
+    **Example curl**:
+
+    .. sourcecode:: shell
+
+        curl -H "Content-Type: application/json" \\
+        -X POST http://127.0.0.1/releases/${RELEASE_ID}/packages/start \\
+        -d '{"packages": ["'${PACKAGE_ID}'", "'${OTHER_PACKAGE_ID}'"]}'
+    """
+    package_ids = validate_package_batch_input(request)
+    if not all(isinstance(p, string_types) for p in package_ids):
+        raise InvalidUsage("packages must be a list of package UUIDs")
+    release = fetch_release(release_id)
+
+    with track_releases(release.id):
+        results = start_packages(release.id, package_ids)
+
+    app.logger.info("Packages start, release {}, {} of {} started".format(
+        release.id, len([r for r in results if r['ok']]), len(results)))
+    bump_data_version()
+    db.session.commit()
+
+    return jsonify(packages=results)
+
+
+@app.route('/releases/<release_id>/packages/stop', methods=['POST'])
+@conditional_auth(token_auth.token_required)
+def post_packages_batch_stop(release_id):
+    """
+    Indicate that several packages of a release have finished deploying
+
+    :param string release_id: Release UUID
+    :<json array packages: Objects with the id of a package, and success,
+        whether it deployed successfully
+    :>json array packages: Result of each package, in the order given, with
+        its id, ok whether it was stopped, and message why not
+    :status 200: The batch was processed
+    :status 400: Invalid request, or the release does not exist
+
+    **Example curl**:
+
+    .. sourcecode:: shell
+
+        curl -H "Content-Type: application/json" \\
+        -X POST http://127.0.0.1/releases/${RELEASE_ID}/packages/stop \\
+        -d '{"packages": [{"id": "'${PACKAGE_ID}'", "success": true}]}'
+    """
+    items = validate_package_batch_input(request)
+    if not all(isinstance(i, dict) and isinstance(i.get('id'), string_types)
+               and 'success' in i for i in items):
+        raise InvalidUsage(
+            "packages must be a list of objects with id and success")
+    items = [{'id': i['id'],
+              'success': i['success'] in [True, 'True', 'true', '1']}
+             for i in items]
+    release = fetch_release(release_id)
+
+    with track_releases(release.id):
+        results = stop_packages(release.id, items)
+
+    app.logger.info("Packages stop, release {}, {} of {} stopped".format(
+        release.id, len([r for r in results if r['ok']]), len(results)))
+    bump_data_version()
+    db.session.commit()
+
+    return jsonify(packages=results)
+
+
 @app.route('/releases/<release_id>/notes', methods=['POST'])
 @conditional_auth(token_auth.token_required)
 def post_releases_notes(release_id):
@@ -247,6 +472,7 @@ def post_releases_notes(release_id):
     note = ReleaseNote(release_id, text)
     app.logger.info("Adding note to release {}".format(release_id))
     db.session.add(note)
+    bump_data_version()
     db.session.commit()
     return '', 204
 
@@ -273,6 +499,7 @@ def post_releases_metadata(release_id):
         metadata = ReleaseMetadata(release_id, key, value)
         db.session.add(metadata)
 
+    bump_data_version()
     db.session.commit()
     return '', 204
 
@@ -290,8 +517,13 @@ def get_releases(release_id=None):
         ascending
     :query int limit: Limit the results by int (default 100)
     :query int offset: Offset the results by int
+    :query string cursor: Fetch the page after this cursor, from the "next"
+        field of the previous page. Unlike offset, deep pages are as fast as
+        the first. Can not be used with offset.
     :query string user: Filter releases by user the that performed the release
     :query string platform: Filter releases by platform
+    :query string reference: Filter releases by an external reference, e.g. \
+        a ticket. Must match one of the release's references exactly
     :query string stime_before: Only include releases that started before \
         timestamp given
     :query string stime_after: Only include releases that started after \
@@ -315,6 +547,14 @@ def get_releases(release_id=None):
     :query int package_duration_lt: Filter by packages of duration less than
     :query string package_status: Filter by package status. Valid statuses are:\
          "NOT_STARTED", "IN_PROGRESS", "SUCCESSFUL", "FAILED"
+    :query string metadata_<key>: Filter by the value of a metadata key, e.g. \
+        metadata_build=1234. A value of null matches releases without the key
+
+    **Note on pagination**:
+        When there are more releases than the limit, the document has a
+        "next" field, a cursor to pass as the cursor argument with the same
+        filters to fetch the next page. Releases with the same stime are
+        ordered by id.
 
     **Note for time arguments**:
         The timestamp format you must use is specified in /etc/orlo/orlo.ini.
@@ -331,6 +571,7 @@ def get_releases(release_id=None):
 
     booleans = ('rollback', 'package_rollback',)
 
+    page_size = None
     if release_id:  # Simple, just fetch one release
         if not is_uuid(release_id):
             raise InvalidUsage("Release ID given is not a valid UUID")
@@ -347,15 +588,19 @@ def get_releases(release_id=None):
                 args[k] = str_to_bool(request.args.get(k))
             else:
                 args[k] = request.args.get(k)
-        query = queries.build_query(Release, **args)
-
-    # Execute eagerly to avoid confusing stack traces within the Response on
-    # error
-    db.session.execute(query)
-
-    if query.count() == 0:
+        page_size = queries.parse_int('limit', args['limit'])
+        if page_size:
+            # One extra, to find out whether there is a next page
+            args['limit'] = page_size + 1
+        query = queries.build_cached_query(Release, **args)
+
+    # Run the query once, eagerly to avoid confusing stack traces within the
+    # Response on error, and peek at the first result to see if there are any
+    first, results = peek(query)
+    if first is None:
         response = jsonify(message="No releases found", releases=[])
         return response, 404
 
-    return Response(stream_json_list('releases', query),
-                    content_type='application/json')
+    return Response(
+        stream_with_context(stream_json_list('releases', results, page_size)),
+        content_type='application/json')
@@ -1,8 +1,10 @@
 import arrow
+import pytz
 from flask import request, jsonify
 
 from orlo import stats
 from orlo.app import app
+from orlo.cache import cached_response
 from orlo.exceptions import InvalidUsage
 import orlo.queries as queries
 
@@ -14,6 +16,37 @@ broken down a different way
 """
 
 
+# Above this many values it is cheaper to count every group and discard the
+# ones we don't want than to send the values to the database in an IN clause
+STATS_VALUES_LIMIT = 100
+
+
+def releases_stats_dict(normal_successful=0, normal_failed=0,
+                        rollback_successful=0, rollback_failed=0):
+    """
+    Build the stats dictionary for one set of release counts
+
+    A release is always either normal or a rollback, so the totals are the sum
+    of the two.
+    """
+    return {
+        'releases': {
+            'normal': {
+                'successful': normal_successful,
+                'failed': normal_failed,
+            },
+            'rollback': {
+                'successful': rollback_successful,
+                'failed': rollback_failed,
+            },
+            'total': {
+                'successful': normal_successful + rollback_successful,
+                'failed': normal_failed + rollback_failed,
+            },
+        }
+    }
+
+
 def build_stats_dict(field, value_list, platform=None, stime=None, ftime=None):
     """
     Build a dictionary of our stats
@@ -22,54 +55,26 @@ def build_stats_dict(field, value_list, platform=None, stime=None, ftime=None):
         platform
     :param value_list: The list of values for the field
     :param platform: Filter by platform
-    :param datetime ftime: Passed to count_releases
-    :param datetime stime: Passed to count_releases
+    :param datetime ftime: Passed to stats.release_stats
+    :param datetime stime: Passed to stats.release_stats
     :return:
     """
 
     app.logger.debug("Entered build_stats_dict")
 
-    d_stats = {}
-    count_releases_args = {
-        'stime': stime,
-        'ftime': ftime,
-        'platform': platform,  # platform can also be the field in the loop below
-    }
+    if len(value_list) > STATS_VALUES_LIMIT:
+        values = None
+    else:
+        values = value_list
+
+    rows = stats.release_stats(
+        field, values=values, platform=platform, stime=stime, ftime=ftime)
+    counts = dict((row[0], row[1:]) for row in rows)
 
+    d_stats = {}
     for field_value in value_list:
-        app.logger.debug("Getting stats for {} {}".format(field, field_value))
-
-        count_releases_args[field] = field_value  # e.g. need to pass user=username
-
-        c_total_successful = queries.count_releases(
-                status='SUCCESSFUL', **count_releases_args).all()[0][0]
-        c_total_failed = queries.count_releases(
-                status='FAILED', **count_releases_args).all()[0][0]
-        c_normal_successful = queries.count_releases(
-                rollback=False, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-        c_normal_failed = queries.count_releases(
-                rollback=False, status='FAILED', **count_releases_args).all()[0][0]
-        c_rollback_successful = queries.count_releases(
-                rollback=True, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-        c_rollback_failed = queries.count_releases(
-                rollback=True, status='FAILED', **count_releases_args).all()[0][0]
-
-        d_stats[field_value] = {
-            'releases': {
-                'normal': {
-                    'successful': c_normal_successful,
-                    'failed': c_normal_failed,
-                },
-                'rollback': {
-                    'successful': c_rollback_successful,
-                    'failed': c_rollback_failed,
-                },
-                'total': {
-                    'successful': c_total_successful,
-                    'failed': c_total_failed,
-                },
-            }
-        }
+        # Values with no releases in range have no group, so count zero
+        d_stats[field_value] = releases_stats_dict(*counts.get(field_value, ()))
 
     return d_stats
 
@@ -78,57 +83,41 @@ def build_all_stats_dict(stime=None, ftime=None):
     """
     Build a dictionary of our stats
 
-    :param datetime ftime: Passed to count_releases
-    :param datetime stime: Passed to count_releases
+    :param datetime ftime: Passed to stats.release_stats
+    :param datetime stime: Passed to stats.release_stats
 
     :return:
     """
 
-    app.logger.debug("Entered build_all_stats_dict")
-
-    count_releases_args = {
-        'stime': stime,
-        'ftime': ftime,
-    }
-
     app.logger.debug("Getting global stats")
 
-    c_total_successful = queries.count_releases(
-            status='SUCCESSFUL', **count_releases_args).all()[0][0]
-    c_total_failed = queries.count_releases(
-            status='FAILED', **count_releases_args).all()[0][0]
-    c_normal_successful = queries.count_releases(
-            rollback=False, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-    c_normal_failed = queries.count_releases(
-            rollback=False, status='FAILED', **count_releases_args).all()[0][0]
-    c_rollback_successful = queries.count_releases(
-            rollback=True, status='SUCCESSFUL', **count_releases_args).all()[0][0]
-    c_rollback_failed = queries.count_releases(
-            rollback=True, status='FAILED', **count_releases_args).all()[0][0]
+    counts = stats.release_stats(stime=stime, ftime=ftime)[0]
 
     d_stats = {
-        'global': {
-            'releases': {
-                'normal': {
-                    'successful': c_normal_successful,
-                    'failed': c_normal_failed,
-                },
-                'rollback': {
-                    'successful': c_rollback_successful,
-                    'failed': c_rollback_failed,
-                },
-                'total': {
-                    'successful': c_total_successful,
-                    'failed': c_total_failed,
-                },
-            }
-        }
+        'global': releases_stats_dict(*counts)
     }
 
     return d_stats
 
 
+def pop_tz(filters):
+    """
+    Remove the tz argument from a dict of filters, and validate it
+
+    :param dict filters: Request arguments
+    :return: The time zone name, or None
+    """
+    tz = filters.pop('tz', None)
+    if tz:
+        try:
+            tz = pytz.timezone(tz).zone
+        except pytz.exceptions.UnknownTimeZoneError:
+            raise InvalidUsage('Unknown time zone "{}"'.format(tz))
+    return tz
+
+
 @app.route('/stats')
+@cached_response
 def stats_():
     """
     Return dictionary of global stats
@@ -156,6 +145,7 @@ def stats_():
 
 @app.route('/stats/user')
 @app.route('/stats/user/<username>')
+@cached_response
 def stats_user(username=None):
     """
     Return a dictionary of statistics for a username (optional), or all users
@@ -195,6 +185,7 @@ def stats_user(username=None):
 
 @app.route('/stats/team')
 @app.route('/stats/team/<team>')
+@cached_response
 def stats_team(team=None):
     """
     Return a dictionary of statistics for a team (optional), or all teams
@@ -225,12 +216,16 @@ def stats_team(team=None):
         team_list = [u[0] for u in team_result]
 
     team_stats = build_stats_dict('team', team_list, stime=stime, ftime=ftime)
+    if None in team_stats:
+        # Releases without a team, which jsonify can not sort among the names
+        team_stats['null'] = team_stats.pop(None)
 
     return jsonify(team_stats)
 
 
 @app.route('/stats/platform')
 @app.route('/stats/platform/<platform>')
+@cached_response
 def stats_platform(platform=None):
     """
     Return a dictionary of statistics for a platform name (optional), or all platforms
@@ -268,6 +263,7 @@ def stats_platform(platform=None):
 
 @app.route('/stats/package')
 @app.route('/stats/package/<package>')
+@cached_response
 def stats_package(package=None):
     """
     Return a dictionary of statistics for a package name (optional), or all packages
@@ -304,6 +300,7 @@ def stats_package(package=None):
 
 
 @app.route('/stats/by_date/<subject>')
+@cached_response
 def stats_by_date(subject='release'):
     """
     Return stats by date
@@ -311,6 +308,7 @@ def stats_by_date(subject='release'):
     :param subject: Release or Package (default: release)
     :query string unit: Unit to group by, i.e. year, month, week, day, hour
     :query boolean summarize_by_unit: Don't build hierarchy, just summarize by the unit
+    :query string tz: Time zone to break down by, e.g. Europe/London (default: UTC)
     :return:
 
     This endpoint also allows filtering on the same fields as GET /releases, e.g stime_gt. See
@@ -326,14 +324,80 @@ def stats_by_date(subject='release'):
     else:
         summarize_by_unit = False
 
+    tz = pop_tz(filters)
+
     # Returns releases and their time by rollback and status
     if subject == 'release':
-        release_stats = stats.releases_by_time(unit, summarize_by_unit, **filters)
+        release_stats = stats.releases_by_time(unit, summarize_by_unit, tz,
+                                               **filters)
     elif subject == 'package':
-        release_stats = stats.packages_by_time(unit, summarize_by_unit, **filters)
+        release_stats = stats.packages_by_time(unit, summarize_by_unit, tz,
+                                               **filters)
     else:
         raise InvalidUsage("subject must release or package, not '{}'".format())
 
     return jsonify(release_stats)
 
 
+@app.route('/stats/durations')
+@app.route('/stats/durations/<subject>')
+@cached_response
+def stats_durations(subject='release'):
+    """
+    Return percentiles of duration, in seconds
+
+    :param subject: Release or Package (default: release)
+    :query string group_by: Group by package, platform, team, user or time
+        (default: no grouping)
+    :query string unit: Unit to group by when grouping by time, i.e. year,
+        month, week, day, hour
+    :query boolean summarize_by_unit: Don't build hierarchy, just summarize by the unit
+    :query string tz: Time zone to group by, e.g. Europe/London (default: UTC)
+    :return:
+
+    Returns the count, p50, p90, p95 and p99 of each group.
+
+    This endpoint also allows filtering on the same fields as GET /releases, e.g stime_gt. See
+    that endpoint for documentation.
+    """
+    filters = dict((k, v) for k, v in request.args.items())
+    group_by = filters.pop('group_by', None)
+    unit = filters.pop('unit', 'month')
+    if filters.pop('summarize_by_unit', False):
+        summarize_by_unit = True
+    else:
+        summarize_by_unit = False
+    tz = pop_tz(filters)
+
+    durations = stats.duration_percentiles(
+        subject, group_by, unit, summarize_by_unit, tz, **filters)
+
+    return jsonify(durations)
+
+
+@app.route('/stats/dora')
+@cached_response
+def stats_dora():
+    """
+    Return DORA metrics: deployment frequency, change failure rate and mean
+    time to restore
+
+    :query int window: Number of days up to now to compute the metrics over
+        (default: 90)
+    :query string group_by: Group by package, platform or team (default: no
+        grouping). Releases without a team are grouped under null.
+    :return:
+
+    deployment_frequency is in deployments per day, and mean_time_to_restore
+    in seconds. A restore is the time from a failed deploy of a package to a
+    platform to the next successful deploy of it.
+    """
+    try:
+        window = int(request.args.get('window', 90))
+    except ValueError:
+        raise InvalidUsage("window must be a number of days")
+    if window < 1:
+        raise InvalidUsage("window must be at least one day")
+    group_by = request.args.get('group_by')
+
+    return jsonify(stats.dora_metrics(window, group_by))
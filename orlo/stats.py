@@ -1,8 +1,11 @@
 from __future__ import print_function
+import datetime
 from collections import OrderedDict
-from orlo.queries import apply_filters, filter_release_rollback, filter_release_status
+import arrow
+from orlo.queries import apply_filters
 from orlo.app import app
-from orlo.orm import db, Release, Package
+from orlo import executor, queries, rollup
+from orlo.orm import db, Release, Package, Platform
 from orlo.exceptions import InvalidUsage
 
 __author__ = 'alforbes'
@@ -12,161 +15,493 @@ Functions related to building statistics
 """
 
 
-def releases_by_time(unit, summarize_by_unit=False, **kwargs):
+def release_stats_queries(field=None, values=None, platform=None, stime=None,
+                          ftime=None):
+    """
+    Return the queries which release_stats runs, and a function to merge them
+
+    The queries are independent of each other, so can be run concurrently
+    along with others, see executor.run_queries.
+
+    :return: list of Query objects, and a function which takes a list of the
+        rows of each and returns the rows release_stats would
+    """
+    if rollup.enabled():
+        return (rollup.release_stats_queries(field, values, platform, stime,
+                                             ftime),
+                lambda results: rollup.merge_release_stats(field, results))
+    return ([queries.release_stats(field, values, platform, stime, ftime)],
+            lambda results: [tuple(row) for row in results[0]])
+
+
+def release_stats(field=None, values=None, platform=None, stime=None,
+                  ftime=None):
+    """
+    Count releases by rollback and status, from the rollup if it is enabled
+
+    :return: list of rows, see queries.release_stats
+    """
+    stats_queries, merge = release_stats_queries(
+        field, values, platform, stime, ftime)
+    return merge(executor.run_queries(stats_queries))
+
+
+def releases_by_time(unit, summarize_by_unit=False, tz=None, **kwargs):
     """
     Return stats by time from the given arguments
 
     :param summarize_by_unit: Passed to add_release_by_time_to_dict()
     :param unit: Passed to add_release_by_time_to_dict()
+    :param tz: Passed to add_release_by_time_to_dict()
     """
 
-    query = db.session.query(Release.id, Release.stime)\
-        .join(Package)\
-        .group_by(Release)
+    query = db.session.query(Release.id, Release.stime)
     query = apply_filters(query, kwargs)
 
-    return get_dict_of_objects_by_time(query, unit, summarize_by_unit)
+    return get_dict_of_objects_by_time(query, unit, summarize_by_unit, tz)
 
 
-def packages_by_time(unit, summarize_by_unit=False, **kwargs):
+def packages_by_time(unit, summarize_by_unit=False, tz=None, **kwargs):
     """
     Count packages by time from the filters given
 
     :param summarize_by_unit: Passed to add_release_by_time_to_dict()
     :param unit: Passed to add_release_by_time_to_dict()
+    :param tz: Passed to add_release_by_time_to_dict()
     """
 
     query = db.session.query(Package.id, Package.name, Package.stime)\
         .join(Release)
-    query = apply_filters(query, kwargs)
+    query = apply_filters(query, kwargs, packages=True)
 
-    return get_dict_of_objects_by_time(query, unit, summarize_by_unit)
+    return get_dict_of_objects_by_time(query, unit, summarize_by_unit, tz)
 
 
 # TODO add stats_user_time and stats_team_time
 # or generalise a stats_time function
 
 
-def get_dict_of_objects_by_time(query, unit, summarize_by_unit=False):
+def get_dict_of_objects_by_time(query, unit, summarize_by_unit=False,
+                                tz=None):
     """
     Build a dictionary which summarises the objects in the query given
 
     :param query:
     :param unit:
     :param summarize_by_unit:
+    :param tz:
     :return:
     """
 
-    # Build queries for the individual stats
-    q_normal_successful = filter_release_status(
-        filter_release_rollback(query, rollback=False), 'SUCCESSFUL'
-    )
-    q_normal_failed = filter_release_status(
-        filter_release_rollback(query, rollback=False), 'FAILED'
-    )
-    q_rollback_successful = filter_release_status(
-        filter_release_rollback(query, rollback=True), 'SUCCESSFUL'
-    )
-    q_rollback_failed = filter_release_status(
-        filter_release_rollback(query, rollback=True), 'FAILED'
-    )
+    # One query, which returns the category of each object with it
+    query = queries.add_release_category(query)
 
     output_dict = OrderedDict()
-
-    add_objects_by_time_to_dict(
-        q_normal_successful, output_dict, ('normal', 'successful'), unit,
-        summarize_by_unit)
-    add_objects_by_time_to_dict(
-        q_normal_failed, output_dict, ('normal', 'failed'), unit,
-        summarize_by_unit)
-    add_objects_by_time_to_dict(
-        q_rollback_successful, output_dict, ('rollback', 'successful'), unit,
-        summarize_by_unit)
-    add_objects_by_time_to_dict(
-        q_rollback_failed, output_dict, ('rollback', 'failed'), unit,
-        summarize_by_unit)
+    add_objects_by_time_to_dict(query, output_dict, (), unit,
+                                summarize_by_unit, tz)
 
     return output_dict
 
 
+# The parts of the time an object is placed under for each unit, e.g. month
+# places objects under their year, then month
+TIME_UNIT_PARTS = {
+    'year': ('year',),
+    'month': ('year', 'month'),
+    'week': ('isoyear', 'week'),
+    'iso': ('isoyear', 'week', 'isoweekday'),
+    'day': ('year', 'month', 'day'),
+    'hour': ('year', 'month', 'day', 'hour'),
+}
+
+# The units which can be summarized, and their part
+SUMMARIZE_UNIT_PARTS = {
+    'year': ('year',),
+    'month': ('month',),
+    'week': ('week',),
+    'day': ('day',),
+    'hour': ('hour',),
+}
+
+# Arguments to EXTRACT on PostgreSQL for each part
+POSTGRES_TIME_PARTS = {
+    'year': 'year',
+    'month': 'month',
+    'day': 'day',
+    'hour': 'hour',
+    'isoyear': 'isoyear',
+    'week': 'week',
+    'isoweekday': 'isodow',
+}
+
+# strftime formats on SQLite for each part. SQLite has no ISO week formats.
+SQLITE_TIME_PARTS = {
+    'year': '%Y',
+    'month': '%m',
+    'day': '%d',
+    'hour': '%H',
+}
+
+
+def time_parts(unit, summarize_by_unit=False):
+    """
+    Return the parts of the time to place objects under for a unit
+
+    :param string unit: See add_objects_by_time_to_dict
+    :param boolean summarize_by_unit: See add_objects_by_time_to_dict
+    """
+    parts = SUMMARIZE_UNIT_PARTS if summarize_by_unit else TIME_UNIT_PARTS
+    try:
+        return parts[unit]
+    except KeyError:
+        raise InvalidUsage(
+            'Invalid unit "{}" specified for release breakdown'.format(unit))
+
+
+def _time_part_values(year, month, day, hour, parts):
+    """
+    Pick the given parts, which may be ISO calendar parts, from a time
+    """
+    isoyear, week, isoweekday = datetime.date(year, month, day).isocalendar()
+    values = {
+        'year': year, 'month': month, 'day': day, 'hour': hour,
+        'isoyear': isoyear, 'week': week, 'isoweekday': isoweekday,
+    }
+    return [values[p] for p in parts]
+
+
+def db_time_parts(column, parts, tz=None):
+    """
+    Build expressions which extract the parts of a time column in the database
+
+    :param column: Time column, stored in UTC
+    :param parts: The parts to extract, from TIME_UNIT_PARTS
+    :param string tz: Time zone to extract the parts in, a valid pytz name
+    :return: A list of columns, and a function which turns the values of the
+        columns into a list of the parts. None if the database can not do it.
+    """
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        if tz:
+            # Literal, so that GROUP BY sees the same expression as SELECT
+            tz_literal = db.literal_column("'{}'".format(tz.replace("'", "")))
+            column = db.func.timezone(
+                tz_literal, db.func.timezone(db.literal_column("'UTC'"), column))
+        columns = [db.extract(POSTGRES_TIME_PARTS[p], column) for p in parts]
+        return columns, lambda values: [int(v) for v in values]
+
+    if dialect == 'sqlite' and tz in (None, 'UTC'):
+        def strftime(part):
+            format_ = db.literal_column("'{}'".format(SQLITE_TIME_PARTS[part]))
+            return db.cast(db.func.strftime(format_, column), db.Integer)
+
+        if all(p in SQLITE_TIME_PARTS for p in parts):
+            return [strftime(p) for p in parts], list
+        # Count by day, and work out the ISO week of each day afterwards
+        columns = [strftime(p) for p in ('year', 'month', 'day')]
+        return columns, lambda values: _time_part_values(
+            values[0], values[1], values[2], None, parts)
+
+    return None
+
+
+def python_time_parts(stime, parts, tz=None):
+    """
+    Return the parts of an arrow time, in the same way as db_time_parts
+    """
+    if tz:
+        stime = stime.to(tz)
+    return _time_part_values(stime.year, stime.month, stime.day, stime.hour,
+                             parts)
+
+
 def add_objects_by_time_to_dict(query, releases_dict, t_category, unit='month',
-                                summarize_by_unit=False):
+                                summarize_by_unit=False, tz=None):
     """
     Take a query and add its objects to a dictionary, broken down by time
 
     If the query given has a 'name' column, that will be included in the
-    dictionary path above the categories (t_category).
+    dictionary path above the categories. The categories are taken from the
+    rollback_category and status_category columns if the query has them (see
+    queries.add_release_category), followed by t_category.
+
+    Where the database supports it, the objects are counted by time in the
+    database, so only one row per time, name and category is fetched rather
+    than one row per object.
 
     :param dict releases_dict: Dict to add to
     :param tuple t_category: tuple of headings, i.e. (<normal|rollback>,
-        <successful|failed>)
+        <successful|failed>), or () if the query has category columns
     :param query query: Query object to retrieve releases from
     :param string unit: Can be 'iso', 'hour', 'day', 'week', 'month', 'year',
     :param boolean summarize_by_unit: Only break down releases by the given
         unit, i.e. only one layer deep. For example, if "year" is the unit, we
         group all releases under the year and do not add month etc underneath.
+    :param string tz: Time zone to break down by, a valid pytz name. Default
+        UTC
     :return:
 
     **Note**: this can also be use for packages
     """
     app.logger.debug("Entered add_objects_by_time_to_dict")
+    parts = time_parts(unit, summarize_by_unit)
+
+    subquery = query.subquery()
+    db_parts = db_time_parts(subquery.c.stime, parts, tz)
+
+    # Columns which are added to the path after the time
+    path_names = [c for c in ('name', 'rollback_category', 'status_category')
+                  if c in subquery.c]
+
+    if db_parts:
+        columns, to_parts = db_parts
+        n_time_columns = len(columns)
+        columns = columns + [subquery.c[c] for c in path_names]
+        count_query = db.session.query(*(columns + [db.func.count()])) \
+            .group_by(*columns)
+        for row in count_query:
+            tree_args = [str(v) for v in to_parts(row[:n_time_columns])]
+            tree_args += row[n_time_columns:-1]
+            tree_args += t_category
+            append_tree(releases_dict, tree_args, count=row[-1])
+        return
+
     for object_ in query:
-        if summarize_by_unit:
-            tree_args = [str(getattr(object_.stime, unit))]
-        else:
-            if unit == 'year':
-                tree_args = [str(object_.stime.year)]
-            elif unit == 'month':
-                tree_args = [str(object_.stime.year), str(object_.stime.month)]
-            elif unit == 'week':
-                # First two args of isocalendar(), year and week
-                tree_args = [str(i) for i in object_.stime.isocalendar()][0:2]
-            elif unit == 'iso':
-                tree_args = [str(i) for i in object_.stime.isocalendar()]
-            elif unit == 'day':
-                tree_args = [str(object_.stime.year), str(object_.stime.month),
-                             str(object_.stime.day)]
-            elif unit == 'hour':
-                tree_args = [str(object_.stime.year), str(object_.stime.month),
-                             str(object_.stime.day), str(object_.stime.hour)]
-            else:
-                raise InvalidUsage(
-                    'Invalid unit "{}" specified for release breakdown'.format(
-                        unit))
-        if hasattr(object_, 'name'):
-            tree_args.append(object_.name)
+        tree_args = [str(v) for v in python_time_parts(object_.stime, parts, tz)]
+        tree_args += [getattr(object_, c) for c in path_names]
         # Append categories
         tree_args += t_category
-        append_tree_recursive(releases_dict, tree_args[0], tree_args)
+        append_tree(releases_dict, tree_args)
 
 
-def append_tree_recursive(tree, parent, nodes, node_index=0):
+def append_tree(tree, nodes, count=1):
     """
-    Recursively place the nodes under each other
+    Place the nodes under each other in the tree, adding count to the leaf
+
+    e.g. append_tree({}, ['2016', '1', 'normal', 'successful']) gives
+    {'2016': {'1': {'normal': {'successful': 1}}}}
+
+    :param dict tree: The dictionary we are operating on
+    :param nodes: The list of nodes, the last of which is the leaf
+    :param int count: The amount to add to the leaf
+    :return: The tree
+    """
+    branch = tree
+    for node in nodes[:-1]:
+        try:
+            branch = branch[node]
+        except KeyError:
+            branch[node] = branch = {}
+    leaf = nodes[-1]
+    branch[leaf] = branch.get(leaf, 0) + count
+    return tree
+
+
+def append_tree_recursive(tree, parent, nodes, node_index=0, count=1):
+    """
+    Place the nodes under each other, starting from node_index
+
+    Kept for compatibility, see append_tree.
 
     :param dict tree: The dictionary we are operating on
-    :param parent: The parent for this node
+    :param parent: The parent for this node, must be nodes[node_index]
     :param nodes: The list of nodes
     :param node_index: The position in the list list we are up to
+    :param int count: The amount to add to the leaf
     :return:
     """
-    app.logger.debug('Called recursive function with args:\n{}, {}, {}'.format(
-        str(tree), str(parent), str(nodes)))
+    return append_tree(tree, nodes[node_index:], count)
 
-    child_index = node_index + 1
-    try:
-        # Get the child, one after the parent
-        child = nodes[child_index]
-    except IndexError:
-        # Must be at end
-        if parent in tree:
-            tree[parent] += 1
+
+# Percentiles of duration returned by duration_percentiles
+DURATION_PERCENTILES = (50, 90, 95, 99)
+
+# Fields duration_percentiles can group by, other than time
+DURATION_GROUP_FIELDS = ('package', 'platform', 'team', 'user')
+
+
+def _percentile(values, percentile):
+    """
+    Linearly interpolated percentile of a sorted list, as percentile_cont
+
+    :param list values: Sorted values
+    :param percentile: Percentile, from 0 to 100
+    """
+    if not values:
+        return None
+    position = (len(values) - 1) * percentile / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _percentiles_dict(count, values):
+    d = {'count': count}
+    for percentile, value in zip(DURATION_PERCENTILES, values):
+        d['p{}'.format(percentile)] = \
+            float(value) if value is not None else None
+    return d
+
+
+def duration_percentiles(subject='release', group_by=None, unit='month',
+                         summarize_by_unit=False, tz=None, **kwargs):
+    """
+    Return percentiles of release or package duration, in seconds
+
+    On PostgreSQL the percentiles are computed by percentile_cont. Elsewhere,
+    durations are fetched in order and the percentiles interpolated the same
+    way.
+
+    :param string subject: "release" or "package"
+    :param string group_by: None, "time", or one of DURATION_GROUP_FIELDS
+    :param string unit: Time unit when grouping by time, see
+        add_objects_by_time_to_dict
+    :param boolean summarize_by_unit: See add_objects_by_time_to_dict
+    :param string tz: Time zone when grouping by time, a valid pytz name
+    :param kwargs: Filters, see apply_filters
+    :return: dict of count, and p50, p90 etc, nested under the group if there
+        is one
+    """
+    if subject == 'release':
+        table = Release
+        query = apply_filters(db.session.query(Release.duration), kwargs)
+    elif subject == 'package':
+        table = Package
+        query = apply_filters(
+            db.session.query(Package.duration).join(Release), kwargs,
+            packages=True)
+    else:
+        raise InvalidUsage(
+            "subject must be release or package, not '{}'".format(subject))
+    query = query.filter(table.duration.isnot(None))
+
+    parts = None
+    if group_by is None:
+        group_columns = []
+    elif group_by == 'time':
+        parts = time_parts(unit, summarize_by_unit)
+        group_columns = [table.stime]
+    elif group_by in DURATION_GROUP_FIELDS:
+        if group_by == 'package':
+            if subject == 'release':
+                query = query.join(Package)
+            group_columns = [Package.name]
+        elif group_by == 'platform':
+            query = query.join(Release.platforms)
+            group_columns = [Platform.name]
+        else:
+            group_columns = [getattr(Release, group_by)]
+    else:
+        raise InvalidUsage("Can not group durations by {}".format(group_by))
+
+    if db.engine.dialect.name == 'postgresql':
+        if parts:
+            group_columns, to_parts = db_time_parts(table.stime, parts, tz)
         else:
-            tree[parent] = 1
-        return tree
-
-    # Otherwise recurse again
-    if parent not in tree:
-        tree[parent] = {}
-    # Child becomes the parent
-    append_tree_recursive(tree[parent], child, nodes, node_index=child_index)
+            to_parts = list
+        seconds = db.extract('epoch', table.duration)
+        query = query.with_entities(*(group_columns + [db.func.count()] + [
+            db.func.percentile_cont(p / 100.0).within_group(seconds)
+            for p in DURATION_PERCENTILES
+        ])).group_by(*group_columns)
+        rows = [(to_parts(row[:len(group_columns)]), row[len(group_columns)],
+                 row[len(group_columns) + 1:]) for row in query]
+    else:
+        # Ordered scan, so that each group's durations arrive sorted
+        query = query.with_entities(*(group_columns + [table.duration])) \
+            .order_by(table.duration)
+        groups = OrderedDict()
+        for row in query:
+            key = tuple(row[:-1])
+            if parts:
+                key = tuple(python_time_parts(key[0], parts, tz))
+            groups.setdefault(key, []).append(row[-1].total_seconds())
+        rows = [(key, len(values),
+                 [_percentile(values, p) for p in DURATION_PERCENTILES])
+                for key, values in groups.items()]
+
+    if group_by is None:
+        count, values = rows[0][1:] if rows else \
+            (0, [None] * len(DURATION_PERCENTILES))
+        return _percentiles_dict(count, values)
+
+    output_dict = OrderedDict()
+    for key, count, values in rows:
+        branch = output_dict
+        for node in [str(k) for k in key]:
+            branch = branch.setdefault(node, OrderedDict())
+        branch.update(_percentiles_dict(count, values))
+    return output_dict
+
+
+# Fields dora_metrics can group by
+DORA_GROUP_FIELDS = ('package', 'platform', 'team')
+
+
+def dora_metrics(window=90, group_by=None):
+    """
+    Return DORA metrics over the last window days
+
+    Deployment frequency and change failure rate are derived from
+    release_stats, so are read from the rollup if it is enabled. Every
+    finished release is a deployment, and a failed release is a change
+    failure. Mean time to restore is the mean time from a failed deploy of a
+    package to a platform to the next successful one, see
+    queries.restore_incidents.
+
+    :param int window: Number of days up to now to compute the metrics over
+    :param string group_by: None, or one of DORA_GROUP_FIELDS
+    :return: dict of metrics, nested under the group if there is one
+    """
+    if group_by is not None and group_by not in DORA_GROUP_FIELDS:
+        raise InvalidUsage("Can not build DORA metrics by {}".format(group_by))
+
+    ftime = arrow.utcnow()
+    stime = ftime.replace(days=-window)
+
+    stats_queries, merge = release_stats_queries(
+        group_by, stime=stime, ftime=ftime)
+    results = executor.run_queries(
+        stats_queries + [queries.restore_incidents(stime, ftime)])
+
+    deployments = {}
+    for row in merge(results[:-1]):
+        key, counts = (row[0], row[1:]) if group_by else (None, row)
+        normal_successful, normal_failed, rollback_successful, \
+            rollback_failed = counts
+        deployments[key] = (sum(counts), normal_failed + rollback_failed)
+
+    restores = {}
+    for package, platform, team, failed_time, restored_time in results[-1]:
+        if restored_time is None:
+            continue
+        key = {'package': package, 'platform': platform,
+               'team': team}.get(group_by)
+        restores.setdefault(key, []).append(
+            (restored_time - failed_time).total_seconds())
+
+    def metrics(key):
+        total, failures = deployments.get(key, (0, 0))
+        restore_times = restores.get(key, [])
+        return OrderedDict([
+            ('deployments', total),
+            ('deployment_frequency', float(total) / window),
+            ('change_failures', failures),
+            ('change_failure_rate',
+             float(failures) / total if total else None),
+            ('restores', len(restore_times)),
+            ('mean_time_to_restore',
+             sum(restore_times) / len(restore_times)
+             if restore_times else None),
+        ])
+
+    if group_by is None:
+        output_dict = metrics(None)
+    else:
+        output_dict = OrderedDict()
+        for key in sorted(set(deployments) | set(restores),
+                          key=lambda k: (k is None, k)):
+            # Releases without a team under null, as in /stats/team
+            output_dict['null' if key is None else str(key)] = metrics(key)
+    return output_dict
@@ -1,14 +1,23 @@
 from __future__ import print_function, unicode_literals
 from flask import json
 from orlo.app import app
-from orlo.orm import db, Release, Package, Platform
+from orlo.cache import platform_cache
+from orlo.config import config
+from orlo.orm import db, Release, Package, \
+    load_release_relationships, update_releases
+from orlo.queries import encode_cursor
 from orlo.exceptions import InvalidUsage
-from sqlalchemy.orm import exc
+from sqlalchemy import bindparam
 from six import string_types
+import arrow
+import itertools
 import uuid
 
 __author__ = 'alforbes'
 
+# Items serialized together by stream_json_list
+STREAM_CHUNK_SIZE = 100
+
 
 def append_or_create_platforms(request_platforms):
     """
@@ -17,18 +26,7 @@ def append_or_create_platforms(request_platforms):
 
     :param list request_platforms: List of strings denoting platform names
     """
-    platforms = []
-    for p in request_platforms:
-        try:
-            query = db.session.query(Platform).filter(Platform.name == p)
-            platform = query.one()
-            # app.logger.debug("Found platform {}".format(platform.name))
-        except exc.NoResultFound:
-            app.logger.info("Creating platform {}".format(p))
-            platform = Platform(p)
-            db.session.add(platform)
-        platforms.append(platform)
-    return platforms
+    return platform_cache.get_platforms(db.session, request_platforms)
 
 
 def create_release(request):
@@ -73,6 +71,35 @@ def create_package(release_id, request):
     )
 
 
+def create_package_from_document(release_id, document, default_stime):
+    """
+    Create a package object from a release document, with its status and
+    timings
+
+    A package which has started but has no stime is taken to have started
+    with the release. A finished package with no ftime finished now.
+
+    :param release_id: Release the package is for
+    :param dict document: The package, validated by validate_release_document
+    :param default_stime: Arrow
+    """
+    package = Package(
+        release_id,
+        document['name'],
+        document['version'],
+        diff_url=document.get('diff_url'),
+        rollback=bool(document.get('rollback', False)),
+    )
+    package.status = document.get('status', 'NOT_STARTED')
+    if package.status != 'NOT_STARTED':
+        package.stime = parse_time(document.get('stime')) or default_stime
+    if package.status in ('SUCCESSFUL', 'FAILED'):
+        package.ftime = parse_time(document.get('ftime')) or \
+            arrow.now(config.get('main', 'time_zone'))
+        package.duration = package.ftime - package.stime
+    return package
+
+
 def fetch_release(release_id):
     """
     Fetch a release by ID
@@ -102,6 +129,156 @@ def fetch_package(release_id, package_id):
     return package
 
 
+def _batch_result(package_id, message=None):
+    """
+    Return the result of one item of a batch of packages
+    """
+    result = {'id': package_id, 'ok': message is None}
+    if message is not None:
+        result['message'] = message
+    return result
+
+
+def _batch_package_ids(release_id, items):
+    """
+    Look up the packages of a release named in a batch, in one query
+
+    :param release_id: Release UUID
+    :param list items: Package UUID strings, as given
+    :return: dict of UUID string to package stime, for the packages which
+        exist in the release, and dict of UUID string to the message for
+        those which do not
+    """
+    ids = {}
+    errors = {}
+    for item in items:
+        if not is_uuid(item):
+            errors[item] = "Invalid UUID"
+        else:
+            ids[item] = uuid.UUID(item)
+    rows = db.session.query(Package.id, Package.stime) \
+        .filter(Package.release_id == release_id) \
+        .filter(Package.id.in_(list(set(ids.values())))) if ids else []
+    found = dict((package_id, stime) for package_id, stime in rows)
+    stimes = {}
+    for item, package_id in ids.items():
+        if package_id in found:
+            stimes[item] = found[package_id]
+        else:
+            errors[item] = "Package does not exist in this release"
+    return stimes, errors
+
+
+def create_packages(release_id, documents):
+    """
+    Add packages to a release, in one INSERT
+
+    Packages which are invalid are reported rather than created, the rest are
+    created regardless.
+
+    :param release_id: UUID of the release, which must exist
+    :param list documents: Packages as posted to /releases/<id>/packages
+    :return: list of results, in the order given, each with the id of the
+        package created, or a message saying why it was not
+    """
+    results = []
+    rows = []
+    for document in documents:
+        try:
+            validate_package_document(document)
+        except InvalidUsage as error:
+            results.append(_batch_result(None, error.message))
+            continue
+        package = Package(
+            release_id,
+            document['name'],
+            document['version'],
+            diff_url=document.get('diff_url'),
+            rollback=bool(document.get('rollback', False)),
+        )
+        package.status = 'NOT_STARTED'
+        rows.append(dict(
+            (column.key, getattr(package, column.key))
+            for column in Package.__table__.columns))
+        results.append(_batch_result(package.id))
+
+    if rows:
+        db.session.execute(Package.__table__.insert(), rows)
+        # A bulk statement does not flush, so does not run its hooks
+        update_releases(db.session, [release_id])
+    return results
+
+
+def start_packages(release_id, package_ids):
+    """
+    Mark packages of a release as started, in one UPDATE
+
+    :param release_id: UUID of the release, which must exist
+    :param list package_ids: UUID strings of the packages
+    :return: list of results, in the order given
+    """
+    stimes, errors = _batch_package_ids(release_id, package_ids)
+    if stimes:
+        table = Package.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id.in_([uuid.UUID(p) for p in stimes]))
+            .values(stime=arrow.now(config.get('main', 'time_zone')),
+                    status='IN_PROGRESS'))
+        update_releases(db.session, [release_id])
+    return [_batch_result(p, errors.get(p)) for p in package_ids]
+
+
+def stop_packages(release_id, items):
+    """
+    Mark packages of a release as finished, in one UPDATE executed with the
+    values of each
+
+    Packages which have not started are not stopped, as Package.stop refuses
+    to.
+
+    :param release_id: UUID of the release, which must exist
+    :param list items: dicts with the id of a package, and whether it
+        succeeded
+    :return: list of results, in the order given
+    """
+    stimes, errors = _batch_package_ids(release_id,
+                                        [item['id'] for item in items])
+    ftime = arrow.now(config.get('main', 'time_zone'))
+    rows = []
+    stopped = set()
+    for item in items:
+        package_id = item['id']
+        if package_id in errors:
+            continue
+        if stimes[package_id] is None:
+            errors[package_id] = \
+                "Can not stop a package which has not been started"
+            continue
+        rows.append({
+            'package_id': uuid.UUID(package_id),
+            'ftime': ftime,
+            'duration': ftime - stimes[package_id],
+            'status': 'SUCCESSFUL' if item['success'] else 'FAILED',
+        })
+        stopped.add(package_id)
+
+    if rows:
+        table = Package.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('package_id'))
+            .values(ftime=bindparam('ftime'),
+                    duration=bindparam('duration'),
+                    status=bindparam('status')),
+            rows)
+        successful = [release_id] if any(
+            row['status'] == 'SUCCESSFUL' for row in rows) else []
+        update_releases(db.session, [release_id], successful)
+    return [_batch_result(item['id'], errors.get(item['id']))
+            for item in items]
+
+
 def validate_request_json(request):
     try:
         request.json
@@ -123,14 +300,105 @@ def validate_release_input(request):
 
 def validate_package_input(request, release_id):
     validate_request_json(request)
-
-    if not 'name' in request.json or not 'version' in request.json:
-        raise InvalidUsage("Missing name / version in request body.")
+    validate_package_document(request.json)
     app.logger.debug(
         "Package request validated, release_id {}".format(release_id))
     return True
 
 
+def validate_package_document(document):
+    """
+    Validate a package, as posted to /releases/<id>/packages or within a
+    release document
+
+    :param dict document:
+    """
+    if not isinstance(document, dict):
+        raise InvalidUsage("A package must be a JSON object")
+    if not 'name' in document or not 'version' in document:
+        raise InvalidUsage("Missing name / version in request body.")
+
+
+def validate_package_batch_input(request):
+    """
+    Validate a batch of packages, and return the list of them
+
+    The items themselves are checked one by one, so that each gets a result.
+    """
+    validate_request_json(request)
+    packages = request.json.get('packages')
+    if not isinstance(packages, list):
+        raise InvalidUsage("JSON doc missing packages list")
+    return packages
+
+
+def validate_release_document(request):
+    """
+    Validate a whole release document, see post_releases_document
+
+    Timestamps and statuses are checked here, so that a bad document is
+    rejected before anything is written.
+    """
+    validate_release_input(request)
+    document = request.json
+    if not document.get('user'):
+        raise InvalidUsage("JSON doc missing user field")
+    if not isinstance(document.get('notes') or [], list):
+        raise InvalidUsage("notes must be a list")
+    if not isinstance(document.get('metadata') or {}, dict):
+        raise InvalidUsage("metadata must be an object")
+    packages = document.get('packages') or []
+    if not isinstance(packages, list):
+        raise InvalidUsage("packages must be a list")
+
+    release_stime = parse_time(document.get('stime'), 'stime')
+    release_ftime = parse_time(document.get('ftime'), 'ftime')
+    if release_ftime and not release_stime:
+        raise InvalidUsage("The release has an ftime but no stime")
+    if release_stime and release_ftime and release_ftime < release_stime:
+        raise InvalidUsage("The release finished before it started")
+    statuses = Package.status.property.columns[0].type.enums
+    for package in packages:
+        validate_package_document(package)
+        status = package.get('status', 'NOT_STARTED')
+        if status not in statuses:
+            raise InvalidUsage("Invalid package status, {} is not in {}".format(
+                status, str(statuses)))
+        stime = parse_time(package.get('stime'), 'stime') or release_stime
+        ftime = parse_time(package.get('ftime'), 'ftime')
+        if ftime and status not in ('SUCCESSFUL', 'FAILED'):
+            raise InvalidUsage(
+                "Package {} has an ftime but has not finished".format(
+                    package['name']))
+        if ftime and not stime:
+            # It would start with the release, now, after it finished
+            raise InvalidUsage(
+                "Package {} has an ftime, but neither it nor the release "
+                "has an stime".format(package['name']))
+        if stime and ftime and ftime < stime:
+            raise InvalidUsage(
+                "Package {} finished before it started".format(
+                    package['name']))
+    return True
+
+
+def parse_time(value, name='time'):
+    """
+    Parse an optional timestamp from a document
+
+    :param value: Any format understood by Arrow, or None
+    :param string name: Name of the field, for the error message
+    :return: Arrow or None
+    """
+    if value is None:
+        return None
+    try:
+        return arrow.get(value)
+    except (RuntimeError, TypeError, ValueError):
+        # arrow's ParserError is a RuntimeError
+        raise InvalidUsage("Invalid {}: {}".format(name, value))
+
+
 def _validate_package_stop_input(request):
     validate_request_json(request)
     if 'success' not in request.json:
@@ -150,37 +418,78 @@ def list_to_string(array):
     return '["' + '", "'.join(array) + '"]'
 
 
-def stream_json_list(heading, iterator):
+def chunks(iterable, size):
     """
-    A lagging generator to stream JSON so we don't have to hold everything in
-    memory
+    Yield lists of up to size items from an iterable
 
-    This is a little tricky, as we need to omit the last comma to make valid
-    JSON, thus we use a lagging generator, similar to
-    http://stackoverflow.com/questions/1630320/
+    :param iterable:
+    :param int size:
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    :param heading: The title of the set, e.g. "releases"
-    :param iterator: Any object with __iter__(), e.g. SQLAlchemy Query
+
+def peek(iterable):
+    """
+    Return the first item of an iterable, and an iterator over all its items
+
+    :param iterable: Any object with __iter__(), e.g. SQLAlchemy Query
+    :return: (first item, iterator), or (None, empty iterator) if there are
+        no items
     """
-    iterator = iterator.__iter__()
+    iterator = iter(iterable)
     try:
-        prev_release = next(iterator)  # get first result
+        first = next(iterator)
     except StopIteration:
-        # StopIteration here means the length was zero, so yield a valid
-        # releases doc and stop
-        yield '{{"{}": []}}'.format(heading)
-        raise StopIteration
+        return None, iter([])
+    return first, itertools.chain([first], iterator)
 
-    # We have some releases. First, yield the opening json
-    yield '{{"{}": ['.format(heading)
 
-    # Iterate over the releases
-    for item in iterator:
-        yield json.dumps(prev_release.to_dict()) + ', '
-        prev_release = item
+def stream_json_list(heading, iterator, page_size=None):
+    """
+    A generator to stream JSON so we don't have to hold everything in memory
+
+    Items are serialized a chunk at a time, and for releases the
+    relationships of each chunk are loaded together, rather than one release
+    at a time as to_dict accesses them.
+
+    :param heading: The title of the set, e.g. "releases"
+    :param iterator: Any object with __iter__(), e.g. SQLAlchemy Query
+    :param int page_size: Number of items in a page. If the iterator yields
+        more than this, the rest are not returned, and a "next" cursor to
+        fetch them is added to the document. Query one more than the page
+        size to find out whether there is a next page.
+    """
+    yield '{{"{}": ['.format(heading)
 
-    # Now yield the last iteration without comma but with the closing brackets
-    yield json.dumps(prev_release.to_dict()) + ']}'
+    count = 0
+    last = None
+    next_page = False
+    for chunk in chunks(iterator, STREAM_CHUNK_SIZE):
+        if page_size and count + len(chunk) > page_size:
+            # The items after the page only tell us there is a next one
+            chunk = chunk[:page_size - count]
+            next_page = True
+        if chunk and isinstance(chunk[0], Release):
+            load_release_relationships(chunk)
+        for item in chunk:
+            # Comma separated, so no comma before the first
+            yield (', ' if count else '') + json.dumps(item.to_dict())
+            count += 1
+            last = item
+        if next_page:
+            break
+
+    yield ']'
+    if next_page:
+        yield ', "next": {}'.format(json.dumps(encode_cursor(last)))
+    yield '}'
 
     # Must close the db session here to avoid leaking connections,
     # flask-sqlalchemy doesn't do it for us
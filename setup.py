@@ -25,6 +25,7 @@ install_requires = [
     'Flask-Script >= 2.0.5',
     'Flask-TokenAuth',
     'arrow',
+    'futures; python_version < "3"',
     'gunicorn',
     'orloclient>=0.4.5',
     'psycopg2',
@@ -43,6 +44,7 @@ rtd_requires = [
     'Flask-Script >= 2.0.5',
     'Flask-TokenAuth',
     'arrow',
+    'futures; python_version < "3"',
     'orloclient>=0.2.0',
     'pytz',
     'sqlalchemy-utils',
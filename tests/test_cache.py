@@ -0,0 +1,298 @@
+from __future__ import print_function, unicode_literals
+from sqlalchemy import event
+from orlo.cache import response_cache, statement_cache, platform_cache, \
+    current_data_version
+from orlo.orm import db, DataVersion, Platform
+from orlo.util import append_or_create_platforms
+from test_base import ConfigChange
+from test_route_base import OrloHttpTest
+
+__author__ = 'alforbes'
+
+
+class TestResponseCache(OrloHttpTest):
+    """
+    Test responses are cached, and invalidated by writes
+    """
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.config_change = ConfigChange('cache', 'enabled', 'true')
+        self.config_change.__enter__()
+        response_cache.clear()
+        self._create_finished_release()
+
+    def tearDown(self):
+        self.config_change.__exit__(None, None, None)
+        response_cache.clear()
+        super(TestResponseCache, self).tearDown()
+
+    def _total_successful(self):
+        response = self.client.get('/stats')
+        self.assert200(response)
+        return response.json['global']['releases']['total']['successful']
+
+    def test_cache_hit(self):
+        """
+        Test a repeated request is served from the cache
+        """
+        first = self.client.get('/stats/user')
+        second = self.client.get('/stats/user')
+        self.assertEqual(first.json, second.json)
+        self.assertEqual(1, response_cache.hits)
+        self.assertEqual(1, response_cache.misses)
+
+    def test_cache_key_includes_args(self):
+        """
+        Test requests with different args are cached separately
+        """
+        self.client.get('/info/packages/versions?platform=test_platform')
+        self.client.get('/info/packages/versions?platform=other_platform')
+        self.assertEqual(0, response_cache.hits)
+        self.assertEqual(2, response_cache.misses)
+
+    def test_write_invalidates(self):
+        """
+        Test a write causes the next request to miss the cache
+        """
+        version = current_data_version()
+        self.assertEqual(1, self._total_successful())
+        self._create_finished_release()
+        self.assertGreater(current_data_version(), version)
+        self.assertEqual(2, self._total_successful())
+        self.assertEqual(0, response_cache.hits)
+
+    def test_ttl(self):
+        """
+        Test entries expire after the ttl
+        """
+        with ConfigChange('cache', 'ttl', '0'):
+            self.client.get('/stats')
+            self.client.get('/stats')
+        self.assertEqual(0, response_cache.hits)
+
+    def test_max_size(self):
+        """
+        Test the least recently used entry is evicted
+        """
+        with ConfigChange('cache', 'max_size', '1'):
+            self.client.get('/stats')
+            self.client.get('/info/packages')
+            self.client.get('/stats')
+        self.assertEqual(0, response_cache.hits)
+        self.assertEqual(1, len(response_cache.entries))
+
+    def test_disabled(self):
+        """
+        Test nothing is cached when the cache is disabled
+        """
+        with ConfigChange('cache', 'enabled', 'false'):
+            self.client.get('/stats')
+            self.client.get('/stats')
+        self.assertEqual(0, response_cache.hits + response_cache.misses)
+
+    def test_internal_cache(self):
+        """
+        Test /internal/cache returns the counters
+        """
+        self.client.get('/stats')
+        self.client.get('/stats')
+        response = self.client.get('/internal/cache')
+        self.assert200(response)
+        self.assertEqual(1, response.json['hits'])
+        self.assertEqual(1, response.json['misses'])
+        self.assertEqual(1, response.json['size'])
+
+
+class TestDataVersion(OrloHttpTest):
+    """
+    Test the data version row
+    """
+    def test_created_with_table(self):
+        """
+        Test the row exists with the tables, so that a write only updates it
+        """
+        self.assertEqual(
+            [(0,)], db.session.query(DataVersion.version).all())
+        inserts = []
+
+        def record(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO data_version'):
+                inserts.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with ConfigChange('cache', 'enabled', 'true'):
+                self._create_finished_release()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual([], inserts)
+        self.assertGreater(current_data_version(), 0)
+
+
+class TestStatementCache(OrloHttpTest):
+    """
+    Test /releases and /packages queries are cached by the shape of their
+    arguments
+    """
+    def setUp(self):
+        super(TestStatementCache, self).setUp()
+        statement_cache.clear()
+
+    def _user_ids(self, user, *filters):
+        response = self.client.get('/releases?{}'.format(
+            '&'.join(('user={}'.format(user),) + filters)))
+        if response.status_code == 404:
+            return []
+        self.assert200(response)
+        return [r['id'] for r in response.json['releases']]
+
+    def test_values_are_bound(self):
+        """
+        Test a cached query returns the results for the values given
+        """
+        first = self._create_release(user='first')
+        second = self._create_release(user='second')
+        self.assertEqual([first], self._user_ids('first'))
+        self.assertEqual([second], self._user_ids('second'))
+        self.assertEqual([], self._user_ids('third'))
+        self.assertEqual(2, statement_cache.hits)
+        self.assertEqual(1, statement_cache.misses)
+
+    def test_shapes(self):
+        """
+        Test different arguments are cached separately
+        """
+        self._create_release()
+        self.client.get('/releases?user=testuser')
+        self.client.get('/releases?team=test%20team')
+        self.client.get('/releases?user=testuser&team=test%20team')
+        self.client.get('/releases?team=test%20team&user=testuser')
+        self.client.get('/packages?name=test-package')
+        self.assertEqual(1, statement_cache.hits)
+        self.assertEqual(4, statement_cache.misses)
+
+    def test_null_shape(self):
+        """
+        Test a null filter is not served a query comparing with a parameter
+        """
+        release_id = self._create_release()
+        self._create_release()
+        self.client.post('/releases/{}/stop'.format(release_id))
+        response = self.client.get('/releases?ftime_after=2000-01-01T00:00:00Z')
+        self.assertEqual([release_id],
+                         [r['id'] for r in response.json['releases']])
+        self.assertEqual(1, len(self.client.get(
+            '/releases?ftime=null').json['releases']))
+
+    def test_cursor_union(self):
+        """
+        Test filters and a cursor over both null and non-null start times
+        """
+        release_id = self._create_release()
+        package_ids = [self._create_package(release_id, name='package')
+                       for _ in range(0, 3)]
+        self._create_package(release_id, name='other')
+        self._start_package(release_id, package_ids[0])
+        for asc in ('true', 'false'):
+            ids, cursor = [], ''
+            while cursor is not None:
+                response = self.client.get(
+                    '/packages?name=package&limit=1&asc={}{}'.format(
+                        asc, cursor and '&cursor=' + cursor))
+                self.assert200(response)
+                ids.extend(p['id'] for p in response.json['packages'])
+                cursor = response.json.get('next')
+            self.assertEqual(sorted(package_ids), sorted(ids))
+
+    def test_internal_statement_cache(self):
+        """
+        Test /internal/statement_cache returns the counters
+        """
+        self._create_release()
+        self._user_ids('testuser')
+        self._user_ids('testuser')
+        response = self.client.get('/internal/statement_cache')
+        self.assert200(response)
+        self.assertEqual(1, response.json['hits'])
+        self.assertEqual(1, response.json['misses'])
+        self.assertEqual(0.5, response.json['hit_rate'])
+        self.assertEqual(1, response.json['size'])
+
+
+class TestPlatformCache(OrloHttpTest):
+    """
+    Test platform ids are cached, and missing platforms created
+    """
+    def setUp(self):
+        super(TestPlatformCache, self).setUp()
+        # End the savepoint OrloTest begins, so that commits are of the
+        # transaction, after which ids are cached
+        db.session.commit()
+        platform_cache.clear()
+
+    def _platform_queries(self, func):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if 'platform' in statement and 'release_platform' not in statement:
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return statements
+
+    def test_one_query_per_release(self):
+        """
+        Test several platforms are looked up together, then from the cache
+        """
+        self._create_release(platforms=['a', 'b'])
+        self.assertEqual(
+            [], self._platform_queries(
+                lambda: self._create_release(platforms=['a', 'b'])))
+        # Look up c and d together, insert both, then read their ids
+        self.assertEqual(3, len(self._platform_queries(
+            lambda: self._create_release(platforms=['a', 'c', 'd']))))
+
+    def test_order_and_repeats(self):
+        """
+        Test platforms are returned once each, in the order given
+        """
+        platforms = append_or_create_platforms(['b', 'a', 'b'])
+        self.assertEqual(['b', 'a'], [p.name for p in platforms])
+        again = append_or_create_platforms(['a'])
+        self.assertIs(platforms[1], again[0])
+
+    def test_created_concurrently(self):
+        """
+        Test a platform inserted after it was looked up is not inserted again
+        """
+        session = db.session()
+        platform_cache._insert_missing(session, {'a'})
+        platform_cache._insert_missing(session, {'a', 'b'})
+        self.assertEqual(2, db.session.query(Platform).count())
+        ids = platform_cache.get_ids(session, ['a', 'b'], create=True)
+        self.assertEqual(set(['a', 'b']), set(ids))
+
+    def test_rollback(self):
+        """
+        Test the ids of platforms created in a transaction which rolls back
+        are not kept
+        """
+        platform_cache.get_ids(db.session, ['a'], create=True)
+        db.session.rollback()
+        self.assertEqual({}, platform_cache.entries)
+        self.assertEqual({}, platform_cache.get_ids(db.session, ['a']))
+
+    def test_platform_filter(self):
+        """
+        Test filtering on a platform does not read the platform table
+        """
+        release_id = self._create_release(platforms=['a'])
+        self._create_release(platforms=['b'])
+        response = []
+        self.assertEqual([], self._platform_queries(
+            lambda: response.append(self.client.get('/releases?platform=a'))))
+        self.assertEqual([release_id],
+                         [r['id'] for r in response[0].json['releases']])
+        self.assert404(self.client.get('/releases?platform=c'))
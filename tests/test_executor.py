@@ -0,0 +1,61 @@
+from __future__ import print_function, unicode_literals
+import arrow
+import orlo.executor
+import orlo.queries
+import orlo.stats
+from orlo.orm import db
+from test_base import ConfigChange
+from test_orm import OrloDbTest
+
+__author__ = 'alforbes'
+
+
+class TestExecutor(OrloDbTest):
+    """
+    Test running queries on the executor gives the same rows as sequentially
+    """
+    def setUp(self):
+        super(TestExecutor, self).setUp()
+        for _ in range(0, 3):
+            self._create_finished_release()
+        self._create_finished_release(success=False)
+
+    def test_enabled_never_on_sqlite(self):
+        """
+        Test queries are not run concurrently on SQLite
+        """
+        with ConfigChange('stats', 'parallel', 'true'):
+            self.assertEqual(db.engine.dialect.name != 'sqlite',
+                             orlo.executor.enabled())
+
+    def test_executor_workers_configured(self):
+        """
+        Test the thread pool is recreated when the workers configured change
+        """
+        with ConfigChange('stats', 'workers', '1'):
+            executor = orlo.executor.get_executor()
+            self.assertIs(executor, orlo.executor.get_executor())
+            self.assertEqual(1, executor._max_workers)
+        with ConfigChange('stats', 'workers', '2'):
+            self.assertEqual(2, orlo.executor.get_executor()._max_workers)
+
+    def test_run_queries_matches_sequential(self):
+        """
+        Test queries run on the thread pool return the same rows
+        """
+        now = arrow.utcnow()
+        stats_queries = [
+            orlo.queries.release_stats('user'),
+            orlo.queries.release_stats(stime=now.replace(hours=-1)),
+            orlo.queries.restore_incidents(),
+        ]
+        # One worker, as an in-memory SQLite database has one connection
+        with ConfigChange('stats', 'workers', '1'):
+            concurrent = orlo.executor.run_queries(
+                stats_queries, concurrent=True)
+        sequential = orlo.executor.run_queries(
+            stats_queries, concurrent=False)
+        self.assertEqual([[tuple(r) for r in rows] for rows in sequential],
+                         [[tuple(r) for r in rows] for rows in concurrent])
+        self.assertEqual([(3, 1, 0, 0)],
+                         [tuple(r) for r in concurrent[1]])
@@ -0,0 +1,181 @@
+from __future__ import print_function, unicode_literals
+from test_orm import OrloDbTest
+from orlo import filters
+from orlo.exceptions import InvalidUsage
+from orlo.orm import db, Release, Package, value_hash
+from orlo.queries import apply_filters, build_query
+
+__author__ = 'alforbes'
+
+
+class TestCompileFilters(OrloDbTest):
+    """
+    Test filter arguments are checked and compiled into clauses
+    """
+    def _sql(self, args, object_type=Release):
+        query = db.session.query(object_type.id).filter(
+            *filters.compile_filters(object_type, args).clauses())
+        return str(query.statement).upper()
+
+    def test_invalid_field(self):
+        """
+        Test an unknown field raises InvalidUsage
+        """
+        for args in ({'foo': 'bar'}, {'package_foo': 'bar'},
+                     {'user_after': '2000-01-01'}):
+            with self.assertRaises(InvalidUsage):
+                filters.compile_filters(Release, args)
+
+    def test_invalid_operator(self):
+        """
+        Test an operator the field does not take raises InvalidUsage
+        """
+        with self.assertRaises(InvalidUsage):
+            filters.compile_filters(Release, {'user_gt': 'a'})
+        with self.assertRaises(InvalidUsage):
+            filters.compile_filters(Release, {'stime_after': 'null'})
+
+    def test_invalid_values(self):
+        """
+        Test values which can not be converted raise InvalidUsage
+        """
+        for args in ({'stime_after': 'yesterday'}, {'duration_gt': 'long'},
+                     {'rollback': 'maybe'}, {'status': 'DONE'},
+                     {'package_status': 'DONE'}, {'id': 'not-a-uuid'}):
+            with self.assertRaises(InvalidUsage):
+                filters.compile_filters(Release, args)
+
+    def test_package_prefix_on_packages(self):
+        """
+        Test package_ arguments are refused for Package queries
+        """
+        with self.assertRaises(InvalidUsage):
+            filters.compile_filters(Package, {'package_name': 'a'})
+
+    def test_package_filters_merged(self):
+        """
+        Test all the package filters are one subquery, without a join
+        """
+        sql = self._sql({'package_name': 'a', 'package_rollback': 'true',
+                         'package_status': 'SUCCESSFUL'})
+        self.assertEqual(1, sql.count('FROM PACKAGE'))
+        self.assertNotIn('JOIN', sql)
+
+    def test_semi_join_or_exists(self):
+        """
+        Test an indexed equality is an IN, anything else an EXISTS
+        """
+        self.assertIn('RELEASE.ID IN', self._sql({'package_name': 'a'}))
+        self.assertIn('EXISTS', self._sql({'package_rollback': 'true'}))
+        self.assertIn('RELEASE.ID IN', self._sql({'platform': 'a'}))
+        self.assertIn('NOT (EXISTS', self._sql({'platform': 'null'}))
+
+    def test_reference_hash(self):
+        """
+        Test a reference is looked up by its hash, then compared in full
+        """
+        compiled = filters.compile_filters(Release, {'reference': 'REF'})
+        self.assertEqual(
+            {'filter_reference': 'REF',
+             'filter_reference_hash': value_hash('REF')},
+            compiled.params)
+        sql = self._sql({'reference': 'REF'})
+        self.assertIn('RELEASE_REFERENCE.REFERENCE_HASH =', sql)
+        self.assertIn('RELEASE_REFERENCE.REFERENCE =', sql)
+
+    def test_status_flags_in_shape(self):
+        """
+        Test statuses filtered on a flag have their own shape
+        """
+        shapes = set(filters.compile_filters(Release, {'status': s}).shape
+                     for s in ('SUCCESSFUL', 'IN_PROGRESS', 'FAILED'))
+        self.assertEqual(3, len(shapes))
+        self.assertEqual({}, filters.compile_filters(
+            Release, {'status': 'SUCCESSFUL'}).params)
+
+
+class TestApplyFilters(OrloDbTest):
+    """
+    Test the results of filtering releases and packages
+    """
+    def _release_ids(self, **args):
+        return sorted(r.id for r in build_query(Release, **args))
+
+    def test_no_duplicates(self):
+        """
+        Test a release with many matching packages is returned once
+        """
+        release_id = self._create_release()
+        for _ in range(0, 3):
+            self._create_package(release_id, name='a', rollback=True)
+        self.assertEqual([release_id], self._release_ids(package_name='a'))
+        self.assertEqual([release_id], self._release_ids(
+            package_name='a', package_rollback=True))
+
+    def test_one_package_matches_all(self):
+        """
+        Test package filters have to be matched by the same package
+        """
+        release_id = self._create_release()
+        self._create_package(release_id, name='a', rollback=False)
+        self._create_package(release_id, name='b', rollback=True)
+        self.assertEqual([], self._release_ids(
+            package_name='a', package_rollback=True))
+        self.assertEqual([release_id], self._release_ids(
+            package_name='b', package_rollback=True))
+
+    def test_platform_null(self):
+        """
+        Test platform=null matches releases without a platform
+        """
+        self._create_release(platforms=['a'])
+        release = Release(platforms=[], user='testuser')
+        db.session.add(release)
+        db.session.commit()
+        self.assertEqual([release.id], self._release_ids(platform='null'))
+
+    def test_status_any_package(self):
+        """
+        Test FAILED and IN_PROGRESS match a release if any package is
+        """
+        release_id = self._create_release()
+        failed_id = self._create_package(release_id)
+        self._start_package(failed_id)
+        self._stop_package(failed_id, success=False)
+        self._start_package(self._create_package(release_id))
+        self.assertEqual([release_id], self._release_ids(status='FAILED'))
+        self.assertEqual([release_id], self._release_ids(status='IN_PROGRESS'))
+
+    def test_status_all_packages(self):
+        """
+        Test SUCCESSFUL and NOT_STARTED match a release if all packages are
+        """
+        release_id = self._create_release()
+        successful_id = self._create_package(release_id)
+        self._start_package(successful_id)
+        self._stop_package(successful_id)
+        self._create_package(release_id)
+        for status in ('SUCCESSFUL', 'NOT_STARTED', 'IN_PROGRESS'):
+            self.assertEqual([], self._release_ids(status=status))
+
+    def test_status_without_packages(self):
+        """
+        Test SUCCESSFUL and NOT_STARTED both match a release without packages
+        """
+        release_id = self._create_release()
+        for status in ('SUCCESSFUL', 'NOT_STARTED'):
+            self.assertEqual([release_id], self._release_ids(status=status))
+        for status in ('FAILED', 'IN_PROGRESS'):
+            self.assertEqual([], self._release_ids(status=status))
+
+    def test_packages_joined(self):
+        """
+        Test package_ arguments filter the packages of a package query
+        """
+        release_id = self._create_release(user='someone')
+        package_id = self._create_package(release_id, name='a')
+        self._create_package(release_id, name='b')
+        query = apply_filters(
+            db.session.query(Package.id).join(Release),
+            {'user': 'someone', 'package_name': 'a'}, packages=True)
+        self.assertEqual([package_id], [p.id for p in query])
@@ -0,0 +1,70 @@
+from __future__ import print_function, unicode_literals
+import io
+import unittest
+from orlo.exceptions import InvalidUsage
+from orlo.importer import JSONArrayReader, iter_ndjson
+
+__author__ = 'alforbes'
+
+
+def stream(text):
+    return io.BytesIO(text.encode('utf-8'))
+
+
+class TestJSONArrayReader(unittest.TestCase):
+    """
+    Test the items of a JSON array are read from a stream
+    """
+    def _items(self, text, **kwargs):
+        return list(JSONArrayReader(stream(text), **kwargs))
+
+    def test_items(self):
+        """
+        Test items are read whatever the size of the reads
+        """
+        text = '[{"a": 1}, {"b": "éé"} , [1, 2], 3.5e2 ]'
+        for read_size in (1, 2, 3, 1024):
+            self.assertEqual(
+                [{'a': 1}, {'b': 'éé'}, [1, 2], 350.0],
+                self._items(text, read_size=read_size))
+
+    def test_empty(self):
+        """
+        Test an empty array has no items
+        """
+        self.assertEqual([], self._items(' [ ] '))
+
+    def test_invalid(self):
+        """
+        Test invalid JSON stops the reading with an InvalidUsage
+        """
+        for text in ('{"a": 1}', '[{"a": 1},, {"b": 2}]',
+                     '[{"a": 1} {"b": 2}]', '[{"a": 1}, {"b": 2'):
+            items = self._items(text, read_size=3)
+            self.assertIsInstance(items[-1], InvalidUsage)
+            self.assertNotIn({'b': 2}, items)
+
+    def test_max_item_size(self):
+        """
+        Test an item is only read up to the maximum size
+        """
+        items = self._items('[{"a": "' + 'x' * 100 + '"}]', read_size=8,
+                            max_item_size=50)
+        self.assertEqual(1, len(items))
+        self.assertIsInstance(items[0], InvalidUsage)
+
+
+class TestIterNdjson(unittest.TestCase):
+    """
+    Test newline delimited JSON is read a line at a time
+    """
+    def test_lines(self):
+        """
+        Test invalid lines are yielded as InvalidUsage, blank lines skipped
+        """
+        items = list(iter_ndjson(stream(
+            '{"a": 1}\n\n  \nnot json\n{"b": 2}')))
+        self.assertEqual(3, len(items))
+        self.assertEqual({'a': 1}, items[0])
+        self.assertIsInstance(items[1], InvalidUsage)
+        self.assertEqual({'b': 2}, items[2])
@@ -2,8 +2,10 @@ from __future__ import print_function
 from test_route_base import OrloTest
 from random import randrange
 from orlo.orm import db
-from orlo.orm import Release, Package, PackageResult, Platform
+from orlo.orm import Release, Package, PackageResult, Platform, \
+    ReleaseReference
 from orlo.app import app
+from sqlalchemy import event
 from sqlalchemy.orm import exc
 import arrow
 import datetime
@@ -59,3 +61,161 @@ class TestFields(OrloDbTest):
         self.assertIsInstance(p.duration, datetime.timedelta)
         self.assertIsInstance(p.status, string_types)
         self.assertIsInstance(p.version, string_types)
+
+
+class TestReleaseStatus(OrloDbTest):
+    """
+    Test the denormalized Release.status and Release.has_rollback
+    """
+    def _status(self, release_id):
+        return db.session.query(Release.status, Release.has_rollback) \
+            .filter(Release.id == release_id).one()
+
+    def test_no_packages(self):
+        """
+        Test a release without packages is NOT_STARTED
+        """
+        release_id = self._create_release()
+        self.assertEqual(('NOT_STARTED', False), self._status(release_id))
+
+    def test_transitions(self):
+        """
+        Test the status follows the package through start and stop
+        """
+        release_id = self._create_release()
+        package_id = self._create_package(release_id)
+        self.assertEqual('NOT_STARTED', self._status(release_id)[0])
+        self._start_package(package_id)
+        self.assertEqual('IN_PROGRESS', self._status(release_id)[0])
+        self._stop_package(package_id)
+        self.assertEqual('SUCCESSFUL', self._status(release_id)[0])
+
+    def test_failed_takes_precedence(self):
+        """
+        Test one failed package makes the release FAILED
+        """
+        release_id = self._create_release()
+        package_ids = [self._create_package(release_id, name=name)
+                       for name in ('one', 'two', 'three')]
+        self._start_package(package_ids[0])
+        self._stop_package(package_ids[0], success=False)
+        self._start_package(package_ids[1])
+        self.assertEqual('FAILED', self._status(release_id)[0])
+
+    def test_partially_complete(self):
+        """
+        Test a release with successful and not started packages is IN_PROGRESS
+        """
+        release_id = self._create_release()
+        package_id = self._create_package(release_id, name='one')
+        self._create_package(release_id, name='two')
+        self._start_package(package_id)
+        self._stop_package(package_id)
+        self.assertEqual('IN_PROGRESS', self._status(release_id)[0])
+
+    def test_has_rollback(self):
+        """
+        Test has_rollback is set by a rollback package
+        """
+        release_id = self._create_release()
+        self._create_package(release_id, name='one')
+        self.assertFalse(self._status(release_id)[1])
+        self._create_package(release_id, name='two', rollback=True)
+        self.assertTrue(self._status(release_id)[1])
+
+    def test_package_deleted(self):
+        """
+        Test the status is recalculated when a package is deleted
+        """
+        release_id = self._create_release()
+        package_id = self._create_package(release_id, rollback=True)
+        db.session.delete(
+            db.session.query(Package).filter(Package.id == package_id).one())
+        db.session.commit()
+        self.assertEqual(('NOT_STARTED', False), self._status(release_id))
+
+    def test_loaded_instance_updated(self):
+        """
+        Test a release already in the session sees the new status
+        """
+        release_id = self._create_release()
+        release = db.session.query(Release).filter(
+            Release.id == release_id).one()
+        package = Package(release_id=release_id, name='test-package',
+                          version='1.2.3')
+        package.start()
+        db.session.add(package)
+        db.session.flush()
+        self.assertEqual('IN_PROGRESS', release.status)
+
+
+    def test_new_instance_updated(self):
+        """
+        Test a release flushed along with its packages sees its status
+        """
+        release = Release(platforms=[], user='testuser')
+        package = Package(release_id=release.id, name='test-package',
+                          version='1.2.3')
+        package.start()
+        db.session.add_all([release, package])
+        db.session.flush()
+        self.assertEqual('IN_PROGRESS', release.status)
+
+    def test_releases_updated_together(self):
+        """
+        Test the releases changed by one flush are updated with one statement
+        """
+        release_ids = [self._create_release() for _ in range(0, 3)]
+        package_ids = [self._create_package(release_id)
+                       for release_id in release_ids]
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE release '):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            for package in db.session.query(Package).filter(
+                    Package.id.in_(package_ids)):
+                package.start()
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(1, len(statements))
+        self.assertEqual(['IN_PROGRESS'] * 3,
+                         [self._status(r)[0] for r in release_ids])
+
+
+class TestReleaseReference(OrloDbTest):
+    """
+    Test references are stored as rows, in the order given
+    """
+    def _references(self, release_id):
+        return [r for r, in db.session.query(ReleaseReference.reference)
+                .filter(ReleaseReference.release_id == release_id)
+                .order_by(ReleaseReference.position)]
+
+    def test_list(self):
+        """
+        Test a list of references
+        """
+        release_id = self._create_release(references=['b-2', 'a-1', 'c-3'])
+        self.assertEqual(['b-2', 'a-1', 'c-3'], self._references(release_id))
+
+    def test_string(self):
+        """
+        Test references given as a string, as created from a request
+        """
+        release_id = self._create_release(references='["x-1", "y-2"]')
+        self.assertEqual(['x-1', 'y-2'], self._references(release_id))
+        release_id = self._create_release(references='x-1')
+        self.assertEqual(['x-1'], self._references(release_id))
+
+    def test_to_dict(self):
+        """
+        Test to_dict returns the references in order
+        """
+        release_id = self._create_release(references=['b-2', 'a-1'])
+        db.session.expunge_all()
+        release = db.session.query(Release).get(release_id)
+        self.assertEqual(['b-2', 'a-1'], release.to_dict()['references'])
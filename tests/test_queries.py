@@ -4,8 +4,10 @@ from test_orm import OrloDbTest
 import orlo.queries
 import orlo.exceptions
 import orlo.stats
-from orlo.orm import Release, Package
+import orlo.orm
+from orlo.orm import Release, Package, PackageCurrentVersion
 from time import sleep
+from sqlalchemy import event
 import sqlalchemy.orm
 import logging
 
@@ -364,6 +366,120 @@ class TestPackageVersions(OrloQueryTest):
             self.assertEqual(ver, '1.0')
 
 
+class TestPackageCurrentVersion(OrloQueryTest):
+    """
+    Test the package_current_version table behind package_versions
+    """
+    def _release(self, name, version, success=True, platforms=None):
+        rid = self._create_release(platforms=platforms or ['platformOne'])
+        pid = self._create_package(rid, name=name, version=version)
+        self._start_package(pid)
+        self._stop_package(pid, success=success)
+        return rid
+
+    def _rows(self):
+        table = PackageCurrentVersion.__table__
+        return sorted(tuple(row) for row in
+                      orlo.orm.db.session.query(table).all())
+
+    def test_platforms(self):
+        """
+        Test versions are kept per platform, and the newest is used overall
+        """
+        self._release('packageOne', '1.0', platforms=['platformOne'])
+        sleep(0.1)
+        self._release('packageOne', '2.0', platforms=['platformTwo'])
+        self.assertEqual(
+            [('packageOne', '1.0')],
+            orlo.queries.package_versions(platform='platformOne').all())
+        self.assertEqual([('packageOne', '2.0')],
+                         orlo.queries.package_versions().all())
+
+    def test_finishing_late(self):
+        """
+        Test a package which started earlier but finished later is not current
+        """
+        rid = self._create_release(platforms=['platformOne'])
+        pid = self._create_package(rid, name='packageOne', version='1.0')
+        self._start_package(pid)
+        sleep(0.1)
+        self._release('packageOne', '2.0')
+        self._stop_package(pid)
+        self.assertEqual([('packageOne', '2.0')],
+                         orlo.queries.package_versions().all())
+
+    def test_release_no_longer_successful(self):
+        """
+        Test a release which is no longer successful is no longer current
+        """
+        self._release('packageOne', '1.0')
+        sleep(0.1)
+        rid = self._release('packageOne', '2.0')
+        self.assertEqual(
+            [('packageOne', '2.0')],
+            orlo.queries.package_versions(by_release=True).all())
+        # Another package makes the release in progress again
+        self._create_package(rid, name='packageTwo')
+        self.assertEqual(
+            [('packageOne', '1.0')],
+            orlo.queries.package_versions(by_release=True).all())
+        self.assertEqual([('packageOne', '2.0')],
+                         orlo.queries.package_versions().all())
+
+    def test_older_version_kept_out(self):
+        """
+        Test a version older than the stored one does not replace it
+        """
+        self._release('packageOne', '1.0')
+        table = PackageCurrentVersion.__table__
+        # As a concurrent transaction might have written meanwhile
+        orlo.orm.db.session.execute(table.update().values(
+            version='3.0', stime=arrow.utcnow().shift(days=1),
+            release_version='3.0', release_stime=arrow.utcnow().shift(days=1)))
+        self._release('packageOne', '2.0')
+        self.assertEqual(
+            [('3.0', '3.0')],
+            [(row[2], row[4]) for row in self._rows()])
+
+    def test_one_statement(self):
+        """
+        Test the versions are merged with those stored by one statement,
+        rather than read and written back
+        """
+        rid = self._create_release(platforms=['platformOne', 'platformTwo'])
+        pids = [self._create_package(rid, name='package{}'.format(i))
+                for i in range(0, 3)]
+        for pid in pids:
+            self._start_package(pid)
+        self._release('package0', '0.1')
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if 'package_current_version' in statement:
+                statements.append(statement)
+        engine = orlo.orm.db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            for pid in pids:
+                self._stop_package(pid)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(3, len(statements))
+        self.assertEqual(6, len(self._rows()))
+
+    def test_rebuild(self):
+        """
+        Test a rebuild writes the same rows as were maintained
+        """
+        self._release('packageOne', '1.0')
+        self._release('packageTwo', '1.0', platforms=['platformOne',
+                                                      'platformTwo'])
+        self._release('packageOne', '2.0', success=False)
+        maintained = self._rows()
+        self.assertEqual(3, orlo.orm.rebuild_current_versions(batch_size=1))
+        self.assertEqual(maintained, self._rows())
+
+
 class TestInfo(OrloQueryTest):
     """
     Test the _info functions
@@ -721,6 +837,74 @@ class CountPackagesRollback(CountPackagesTest):
         self.assertEqual(1, result[0][0])
 
 
+class TestReleaseStats(OrloQueryTest):
+    """
+    Test release_stats against count_releases
+    """
+    def setUp(self):
+        super(TestReleaseStats, self).setUp()
+        for _ in range(0, 2):
+            self._create_finished_release()
+        self._create_finished_release(success=False)
+
+        # A release with one rollback package and one normal, on two platforms
+        rid = self._create_release(user='userTwo', team='teamTwo',
+                                   platforms=['platformOne', 'platformTwo'])
+        for rollback in (True, False):
+            pid = self._create_package(rid, name='packageTwo',
+                                       rollback=rollback)
+            self._start_package(pid)
+            self._stop_package(pid)
+
+    def assertMatchesCountReleases(self, field, row):
+        """
+        Assert a row of release_stats matches count_releases for its value
+        """
+        args = {field: row[0]} if field else {}
+        expected = []
+        for rollback in (False, True):
+            for status in ('SUCCESSFUL', 'FAILED'):
+                expected.append(orlo.queries.count_releases(
+                    rollback=rollback, status=status, **args).one()[0])
+        self.assertEqual(expected, list(row[1:] if field else row))
+
+    def test_release_stats_global(self):
+        """
+        Test release_stats with no field returns one row of totals
+        """
+        result = orlo.queries.release_stats().all()
+        self.assertEqual(1, len(result))
+        self.assertEqual([2, 1, 1, 0], list(result[0]))
+        self.assertMatchesCountReleases(None, result[0])
+
+    def test_release_stats_by_field(self):
+        """
+        Test release_stats matches count_releases for every field and value
+        """
+        groups = {'user': 2, 'team': 2, 'platform': 3, 'package': 2}
+        for field, length in groups.items():
+            result = orlo.queries.release_stats(field).all()
+            self.assertEqual(length, len(result))
+            for row in result:
+                self.assertMatchesCountReleases(field, row)
+
+    def test_release_stats_values(self):
+        """
+        Test release_stats only returns the values asked for
+        """
+        result = orlo.queries.release_stats(
+            'platform', values=['platformTwo']).all()
+        self.assertEqual([('platformTwo', 0, 0, 1, 0)],
+                         [tuple(r) for r in result])
+
+    def test_release_stats_bad_field(self):
+        """
+        Test release_stats raises InvalidUsage for an unknown field
+        """
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.queries.release_stats('foo')
+
+
 class TestBuildQuery(OrloQueryTest):
     """
     Test the build_query method
@@ -763,6 +947,26 @@ class TestBuildQuery(OrloQueryTest):
         with self.assertRaises(orlo.exceptions.InvalidUsage):
             orlo.queries.build_query(Release, **args)
 
+    def test_bad_query_with_bad_cursor(self):
+        """
+        Test releases raises InvalidUsage when the cursor is not valid
+        """
+        args = {
+            'cursor': 'bad_cursor',
+        }
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.queries.build_query(Release, **args)
+
+    def test_cursor_round_trip(self):
+        """
+        Test a cursor decodes to the position of the release it came from
+        """
+        release = Release.query.get(self._create_release())
+        stime, release_id = orlo.queries.decode_cursor(
+            orlo.queries.encode_cursor(release))
+        self.assertEqual(release.stime, stime)
+        self.assertEqual(release.id, release_id)
+
     def test_with_package(self):
         """
         Test that query returned by get_package works
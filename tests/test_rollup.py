@@ -0,0 +1,170 @@
+from __future__ import print_function, unicode_literals
+import arrow
+from sqlalchemy import event
+import orlo.queries
+import orlo.rollup
+from orlo.orm import db, ReleaseStatsRollup
+from test_base import ConfigChange
+from test_route_base import OrloHttpTest
+
+__author__ = 'alforbes'
+
+
+class TestRollup(OrloHttpTest):
+    """
+    Test the release stats rollup is maintained through the workflow
+    """
+    FIELDS = ('user', 'team', 'platform', 'package')
+
+    def setUp(self):
+        super(TestRollup, self).setUp()
+        self.config_change = ConfigChange('stats', 'rollup', 'true')
+        self.config_change.__enter__()
+
+        for _ in range(0, 2):
+            self._create_finished_release()
+
+        # Failed
+        rid = self._create_release(user='userTwo')
+        pid = self._create_package(rid)
+        self._start_package(rid, pid)
+        self._stop_package(rid, pid, success=False)
+
+        # Rollback, to two platforms
+        rid = self._create_release(platforms=['platformOne', 'platformTwo'])
+        pid = self._create_package(rid, name='packageTwo', rollback=True)
+        self._start_package(rid, pid)
+        self._stop_package(rid, pid)
+
+        # In progress
+        rid = self._create_release(team='teamTwo')
+        pid = self._create_package(rid)
+        self._start_package(rid, pid)
+
+    def tearDown(self):
+        self.config_change.__exit__(None, None, None)
+        super(TestRollup, self).tearDown()
+
+    def assertMatchesRawTables(self, **kwargs):
+        """
+        Assert the rollup gives the same stats as the raw tables
+        """
+        def counted(rows):
+            # Groups with only in-progress releases are not in the rollup
+            return sorted(tuple(r) for r in rows if any(r[-4:]))
+
+        for field in self.FIELDS:
+            expected = orlo.queries.release_stats(field, **kwargs).all()
+            result = orlo.rollup.release_stats(field, **kwargs)
+            self.assertEqual(counted(expected), counted(result))
+        self.assertEqual(
+            list(orlo.queries.release_stats(**kwargs).one()),
+            list(orlo.rollup.release_stats(**kwargs)[0]))
+
+    def test_rollup_matches_raw_tables(self):
+        """
+        Test the rollup maintained by the workflow matches the raw tables
+        """
+        self.assertMatchesRawTables()
+
+    def test_rollup_counts(self):
+        """
+        Test the global counts read from the rollup
+        """
+        self.assertEqual([(2, 1, 1, 0)], orlo.rollup.release_stats())
+
+    def test_rollup_with_partial_hours(self):
+        """
+        Test a time range which does not fall on hour boundaries
+        """
+        now = arrow.utcnow()
+        self.assertMatchesRawTables(stime=now.replace(minutes=-90),
+                                    ftime=now.replace(minutes=+30))
+        self.assertMatchesRawTables(stime=now.replace(minutes=-1),
+                                    ftime=now.replace(minutes=+1))
+        self.assertMatchesRawTables(ftime=now.replace(hours=-1))
+
+    def test_rollup_one_row_per_key(self):
+        """
+        Test releases counted under the same key update one row
+        """
+        rows = db.session.query(ReleaseStatsRollup).filter(
+            ReleaseStatsRollup.platform.is_(None),
+            ReleaseStatsRollup.package.is_(None),
+            ReleaseStatsRollup.user == 'testuser',
+            ReleaseStatsRollup.team == 'test team').all()
+        self.assertEqual(1, len(rows))
+        self.assertEqual(2, rows[0].normal_successful)
+
+    def test_rollup_one_statement(self):
+        """
+        Test the changes to a release are written to the rollup with one
+        statement, however many keys it has
+        """
+        rid = self._create_release(platforms=['p1', 'p2', 'p3'])
+        pids = [self._create_package(rid, name='package{}'.format(i))
+                for i in range(0, 5)]
+        for pid in pids:
+            self._start_package(rid, pid)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if 'release_stats_rollup' in statement:
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            for pid in pids:
+                self._stop_package(rid, pid)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # The last stop counts the release, under (3 + 1) * (5 + 1) keys
+        self.assertEqual(1, len(statements))
+        self.assertMatchesRawTables()
+
+    def test_rollup_rebuild(self):
+        """
+        Test rebuilding the rollup gives the same result as maintaining it
+        """
+        maintained = orlo.rollup.release_stats('platform')
+        db.session.query(ReleaseStatsRollup).delete()
+        orlo.rollup.rebuild(batch_size=2)
+        self.assertEqual(sorted(maintained),
+                         sorted(orlo.rollup.release_stats('platform')))
+        self.assertMatchesRawTables()
+
+    def test_rollup_used_by_stats(self):
+        """
+        Test /stats reads from the rollup when it is enabled
+        """
+        db.session.query(ReleaseStatsRollup).delete()
+        response = self.client.get('/stats')
+        self.assert200(response)
+        total = response.json['global']['releases']['total']
+        self.assertEqual(0, total['successful'] + total['failed'])
+
+
+class TestSplitTimeRange(OrloHttpTest):
+    def test_split_whole_hours(self):
+        """
+        Test a range on hour boundaries is read entirely from the rollup
+        """
+        stime = arrow.get('2016-01-01T10:00:00Z')
+        ftime = arrow.get('2016-01-01T12:59:59.999999Z')
+        first, last, edges = orlo.rollup._split_time_range(stime, ftime)
+        self.assertEqual(stime, first)
+        self.assertEqual(arrow.get('2016-01-01T12:00:00Z'), last)
+        self.assertEqual([], edges)
+
+    def test_split_partial_hours(self):
+        """
+        Test partial hours at each end are returned as edges
+        """
+        stime = arrow.get('2016-01-01T10:30:00Z')
+        ftime = arrow.get('2016-01-01T12:15:00Z')
+        first, last, edges = orlo.rollup._split_time_range(stime, ftime)
+        self.assertEqual(arrow.get('2016-01-01T11:00:00Z'), first)
+        self.assertEqual(arrow.get('2016-01-01T11:00:00Z'), last)
+        self.assertEqual(
+            [(stime, arrow.get('2016-01-01T10:59:59.999999Z')),
+             (arrow.get('2016-01-01T12:00:00Z'), ftime)],
+            edges)
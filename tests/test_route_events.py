@@ -0,0 +1,146 @@
+from __future__ import print_function, unicode_literals
+import json
+import uuid
+from sqlalchemy import event
+from orlo.orm import db, Package, Release, ReleaseMetadata, ReleaseNote
+from test_route_base import OrloHttpTest
+
+__author__ = 'alforbes'
+
+
+class TestPostEvents(OrloHttpTest):
+    """
+    Test POST /events
+    """
+    def _post_events(self, events, expected_status=200):
+        response = self.client.post(
+            '/events', data=json.dumps({'events': events}),
+            content_type='application/json')
+        self.assertEqual(expected_status, response.status_code)
+        return response.json
+
+    def _release_with_packages(self, count):
+        release_id = self._create_release()
+        return release_id, [
+            self._create_package(release_id, name='p{}'.format(i))
+            for i in range(0, count)]
+
+    def _deploy_events(self, release_id, package_ids):
+        events = []
+        for package_id in package_ids:
+            events.append({'type': 'package_start', 'release_id': release_id,
+                           'package_id': package_id})
+            events.append({'type': 'package_stop', 'release_id': release_id,
+                           'package_id': package_id, 'success': True})
+        events.append({'type': 'release_stop', 'release_id': release_id})
+        return events
+
+    def _count_selects(self, func):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT') and \
+                    'FROM release_stats_rollup' not in statement:
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return statements
+
+    def test_events_applied_in_order(self):
+        """
+        Test events across releases are applied in order
+        """
+        releases = [self._release_with_packages(2) for _ in range(0, 2)]
+        events = []
+        for release_id, package_ids in releases:
+            events.extend(self._deploy_events(release_id, package_ids))
+        events.append({'type': 'release_note', 'release_id': releases[0][0],
+                       'text': 'done'})
+        events.append({'type': 'release_metadata',
+                       'release_id': releases[1][0],
+                       'metadata': {'build': '42'}})
+
+        outcomes = self._post_events(events)['events']
+        self.assertEqual([{'ok': True}] * len(events), outcomes)
+        for release_id, _ in releases:
+            release = db.session.query(Release).get(release_id)
+            self.assertEqual('SUCCESSFUL', release.status)
+            self.assertIsNotNone(release.ftime)
+        self.assertIn('done', [n.content for n in db.session.query(
+            ReleaseNote).filter(ReleaseNote.release_id == releases[0][0])])
+        self.assertEqual('42', db.session.query(ReleaseMetadata.value).filter(
+            ReleaseMetadata.release_id == releases[1][0],
+            ReleaseMetadata.key == 'build').scalar())
+
+    def test_failures_reported(self):
+        """
+        Test events which can not be applied are reported, and the rest
+        applied
+        """
+        release_id, package_ids = self._release_with_packages(2)
+        other_release_id, other_ids = self._release_with_packages(1)
+        outcomes = self._post_events([
+            {'type': 'package_stop', 'release_id': release_id,
+             'package_id': package_ids[0], 'success': True},
+            {'type': 'package_start', 'release_id': release_id,
+             'package_id': other_ids[0]},
+            {'type': 'package_start', 'release_id': str(uuid.uuid4()),
+             'package_id': package_ids[0]},
+            {'type': 'package_start', 'release_id': release_id},
+            {'type': 'release_explode', 'release_id': release_id},
+            {'type': 'release_note', 'release_id': release_id},
+            'package_start',
+            {'type': 'package_start', 'release_id': release_id,
+             'package_id': package_ids[1]},
+        ])['events']
+        self.assertEqual([False] * 7 + [True], [o['ok'] for o in outcomes])
+        self.assertTrue(all(o['message'] for o in outcomes[:7]))
+
+        statuses = dict(db.session.query(Package.id, Package.status))
+        self.assertEqual(
+            ['NOT_STARTED', 'IN_PROGRESS'],
+            [statuses[uuid.UUID(p)] for p in package_ids])
+        self.assertEqual('NOT_STARTED', statuses[uuid.UUID(other_ids[0])])
+
+    def test_bulk_fetch(self):
+        """
+        Test the releases and packages are fetched together, not per event
+        """
+        def deploy(count):
+            events = []
+            for _ in range(0, count):
+                events.extend(self._deploy_events(
+                    *self._release_with_packages(3)))
+            return len(self._count_selects(
+                lambda: self._post_events(events)))
+
+        self.assertEqual(deploy(1), deploy(10))
+
+    def test_one_commit(self):
+        """
+        Test the batch is committed once
+        """
+        events = self._deploy_events(*self._release_with_packages(3))
+        commits = []
+
+        def count(session):
+            commits.append(session)
+        event.listen(db.session, 'after_commit', count)
+        try:
+            self._post_events(events)
+        finally:
+            event.remove(db.session, 'after_commit', count)
+        self.assertEqual(1, len(commits))
+
+    def test_invalid(self):
+        """
+        Test a document without a list of events is rejected
+        """
+        self._post_events('package_start', expected_status=400)
+        response = self.client.post(
+            '/events', data=json.dumps({'event': []}),
+            content_type='application/json')
+        self.assert400(response)
@@ -1,8 +1,15 @@
 from __future__ import print_function, unicode_literals
 import json
-from orlo.orm import Release, Package, Platform, db
+from sqlalchemy import event, func
+from orlo.app import app
+from orlo.orm import Release, Package, Platform, ReleaseStatsRollup, db
 from orlo.config import config
+from test_base import ConfigChange
 from test_route_base import OrloTest
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 
 __author__ = 'alforbes'
 
@@ -233,3 +240,208 @@ class TestNullTime(TestImport):
             self.package.stime.strftime(config.get('main', 'time_format')),
             self.doc_dict[0]['stime'])
 
+
+
+def release_document(i, status='SUCCESSFUL', rollback=False):
+    """
+    Return a generated release document for import
+    """
+    return {
+        'platforms': ['platform{}'.format(i % 2), 'shared'],
+        'user': 'bob',
+        'stime': '2015-12-09T12:00:00Z',
+        'ftime': '2015-12-09T12:05:00Z',
+        'references': ['TICKET-{}'.format(i)],
+        'notes': ['note'],
+        'packages': [
+            {'name': 'package-a', 'version': '1.0.{}'.format(i),
+             'status': status, 'rollback': rollback,
+             'ftime': '2015-12-09T12:01:00Z'},
+            {'name': 'package-b', 'version': '2.0.{}'.format(i),
+             'status': 'SUCCESSFUL', 'ftime': '2015-12-09T12:05:00Z'},
+        ],
+    }
+
+
+class TestBulkImport(OrloTest):
+    """
+    Test releases are imported a chunk at a time, with a statement per table
+    per chunk
+    """
+    def _import(self, releases, expected_status=200):
+        response = self.client.post(
+            '/releases/import', data=json.dumps(releases),
+            content_type='application/json')
+        self.assertEqual(expected_status, response.status_code)
+        return response.json
+
+    def _statements(self, func):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement.split('(')[0].strip())
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return statements
+
+    def test_imported(self):
+        """
+        Test the releases, their links and derived columns are written
+        """
+        ids = self._import([release_document(0, status='FAILED', rollback=True),
+                            release_document(1)])['releases']
+        self.assertEqual(2, db.session.query(Release).count())
+        failed = db.session.query(Release).get(ids[0])
+        self.assertEqual(('FAILED', True),
+                         (failed.status, failed.has_rollback))
+        self.assertEqual(['platform0', 'shared'],
+                         sorted(p.name for p in failed.platforms))
+        self.assertEqual(['TICKET-0'], failed.to_dict()['references'])
+        self.assertEqual(60, db.session.query(Package).filter(
+            Package.release_id == ids[0],
+            Package.name == 'package-a').one().duration.seconds)
+        successful = db.session.query(Release).get(ids[1])
+        self.assertEqual(('SUCCESSFUL', False),
+                         (successful.status, successful.has_rollback))
+        self.assertEqual(3, db.session.query(Platform).count())
+
+        versions = self.client.get('/info/packages/versions').json
+        self.assertEqual('1.0.1', versions['package-a'])
+
+    def test_statements_per_chunk(self):
+        """
+        Test the number of statements depends on the chunks, not the releases
+        """
+        def insert_statements(count):
+            return len([s for s in self._statements(lambda: self._import(
+                [release_document(i) for i in range(0, count)]))
+                if s.startswith('INSERT')])
+
+        # Create the platforms and current versions first
+        self._import([release_document(0), release_document(1)])
+        with ConfigChange('import', 'chunk_size', '100'):
+            self.assertEqual(insert_statements(2), insert_statements(50))
+
+    def test_status_not_recomputed(self):
+        """
+        Test the status is inserted, rather than derived again from the
+        packages
+        """
+        statements = self._statements(lambda: self._import(
+            [release_document(i) for i in range(0, 3)]))
+        self.assertNotIn(
+            'SELECT package.release_id AS package_release_id, max',
+            statements)
+
+    def test_chunks_committed(self):
+        """
+        Test a commit per chunk
+        """
+        commits = []
+
+        def count(session):
+            commits.append(session)
+        event.listen(db.session, 'after_commit', count)
+        try:
+            with ConfigChange('import', 'chunk_size', '2'):
+                self._import([release_document(i) for i in range(0, 5)])
+        finally:
+            event.remove(db.session, 'after_commit', count)
+        self.assertEqual(3, len(commits))
+        self.assertEqual(5, db.session.query(Release).count())
+
+    def test_invalid_release(self):
+        """
+        Test an invalid release stops the import, keeping the chunks before
+        """
+        releases = [release_document(i) for i in range(0, 5)]
+        releases[3]['packages'][0]['status'] = 'DONE'
+        with ConfigChange('import', 'chunk_size', '2'):
+            result = self._import(releases, expected_status=400)
+        self.assertIn('Release 3', result['message'])
+        self.assertEqual(2, len(result['releases']))
+        self.assertEqual(2, db.session.query(Release).count())
+
+    def test_rollup(self):
+        """
+        Test imported releases are counted in the rollup
+        """
+        with ConfigChange('stats', 'rollup', 'true'):
+            self._import([release_document(0, status='FAILED'),
+                          release_document(1), release_document(2)])
+        totals = db.session.query(
+            func.sum(ReleaseStatsRollup.normal_successful),
+            func.sum(ReleaseStatsRollup.normal_failed)) \
+            .filter(ReleaseStatsRollup.platform.is_(None),
+                    ReleaseStatsRollup.package.is_(None)).one()
+        self.assertEqual((2, 1), tuple(totals))
+
+
+class TestStreamImport(OrloTest):
+    """
+    Test releases are imported from newline delimited JSON, or a JSON array,
+    as it is read
+    """
+    def _stream(self, data, content_type='application/x-ndjson'):
+        response = self.client.post(
+            '/releases/import/stream', data=data, content_type=content_type)
+        self.assert200(response)
+        return response.json
+
+    def test_ndjson(self):
+        """
+        Test each line is a release, and invalid lines are reported
+        """
+        lines = [json.dumps(release_document(i)) for i in range(0, 5)]
+        lines[1] = '{"platforms": ["a"]'
+        lines[3] = json.dumps(dict(release_document(3), user=None))
+        with ConfigChange('import', 'chunk_size', '2'):
+            result = self._stream('\n'.join(lines) + '\n')
+        self.assertEqual(3, result['imported'])
+        self.assertEqual(2, result['invalid'])
+        self.assertEqual([1, 3], [e['record'] for e in result['errors']])
+        self.assertEqual(3, db.session.query(Release).count())
+        self.assertEqual(['TICKET-0', 'TICKET-2', 'TICKET-4'], sorted(
+            r.to_dict()['references'][0] for r in db.session.query(Release)))
+
+    def test_json_array(self):
+        """
+        Test the items of a JSON array are releases
+        """
+        releases = [release_document(i) for i in range(0, 3)]
+        result = self._stream(json.dumps(releases), 'application/json')
+        self.assertEqual(3, result['imported'])
+        self.assertEqual(0, result['invalid'])
+        self.assertEqual(3, db.session.query(Release).count())
+
+    def test_json_array_invalid(self):
+        """
+        Test invalid JSON in an array stops the import, keeping the releases
+        before it
+        """
+        data = json.dumps([release_document(i) for i in range(0, 3)])
+        data = data[:-10] + '}},, {]'
+        result = self._stream(data, 'application/json')
+        self.assertEqual(2, result['imported'])
+        self.assertEqual(1, result['invalid'])
+        self.assertEqual(2, db.session.query(Release).count())
+
+    def test_max_errors(self):
+        """
+        Test only max_errors invalid records are described
+        """
+        with ConfigChange('import', 'max_errors', '2'):
+            result = self._stream('x\n' * 5)
+        self.assertEqual(5, result['invalid'])
+        self.assertEqual(2, len(result['errors']))
+
+    def test_body_not_logged(self):
+        """
+        Test the request body is not read before the view
+        """
+        with patch.object(app.logger, 'info') as info:
+            self._stream(json.dumps(release_document(0)))
+        self.assertNotIn('TICKET-0', str(info.call_args_list))
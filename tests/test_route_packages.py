@@ -71,3 +71,31 @@ class GetPackagesTest(OrloHttpTest):
         self.assertIsInstance(p['packages'], list)
         self.assertEqual(3, len(p['packages']))
 
+    def test_packages_cursor(self):
+        """
+        Test paging through packages, including those not yet started
+        """
+        rid = self._create_release()
+        pids = []
+        for name in ('one', 'two', 'three', 'four'):
+            pids.append(self._create_package(rid, name=name))
+        self._start_package(rid, pids[0])
+        self._start_package(rid, pids[1])
+
+        for order in ([], ['asc=true']):
+            ids = []
+            cursor = None
+            while True:
+                filters = ['limit=1'] + order
+                if cursor:
+                    filters.append('cursor={}'.format(cursor))
+                r = self._get_packages(filters=filters)
+                ids.extend(p['id'] for p in r['packages'])
+                cursor = r.get('next')
+                if not cursor:
+                    break
+            expected = [p['id'] for p in
+                        self._get_packages(filters=order or None)['packages']]
+            self.assertEqual(expected, ids)
+            self.assertEqual(sorted(pids), sorted(ids))
+
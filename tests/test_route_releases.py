@@ -4,9 +4,14 @@ import json
 import uuid
 from orlo.orm import db, Package, Release
 from orlo.config import config
+from sqlalchemy import event
 from time import sleep
 from test_route_base import OrloHttpTest
 from test_base import OrloLiveTest
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
 
 
 __author__ = 'alforbes'
@@ -109,6 +114,15 @@ class TestPostContract(OrloHttpTest):
                                     )
         self.assert200(response)
 
+    def test_create_release_duplicate_platforms(self):
+        """
+        Create a release, listing a platform twice
+        """
+        release_id = self._create_release(
+            platforms=['test_platform', 'test_platform'])
+        release = db.session.query(Release).filter(Release.id == release_id).one()
+        self.assertEqual(['test_platform'], [p.name for p in release.platforms])
+
     def test_diffurl_present(self):
         """
         Test that the diff_url parameter is stored
@@ -172,6 +186,237 @@ class TestPostContract(OrloHttpTest):
         self.assertEqual(package.status, 'FAILED')
 
 
+class TestPostDocument(OrloHttpTest):
+    """
+    Test POST /releases/document
+    """
+    DOCUMENT = {
+        'platforms': ['test_platform'],
+        'user': 'testuser',
+        'team': 'test team',
+        'references': ['TICKET-1'],
+        'note': 'a note',
+        'metadata': {'build': '42'},
+        'stime': '2016-01-01T10:00:00Z',
+        'packages': [
+            {'name': 'first', 'version': '1.0.0', 'status': 'SUCCESSFUL',
+             'ftime': '2016-01-01T10:05:00Z'},
+            {'name': 'second', 'version': '2.0.0', 'status': 'SUCCESSFUL',
+             'stime': '2016-01-01T10:01:00Z', 'ftime': '2016-01-01T10:03:00Z',
+             'rollback': True},
+        ],
+    }
+
+    def _post_document(self, document, expected_status=200):
+        response = self.client.post(
+            '/releases/document', data=json.dumps(document),
+            content_type='application/json')
+        self.assertEqual(expected_status, response.status_code)
+        return response.json
+
+    def test_release_created(self):
+        """
+        Test the release and its packages are created as documented
+        """
+        result = self._post_document(self.DOCUMENT)
+        status = db.session.query(Release.status, Release.has_rollback) \
+            .filter(Release.id == result['id']).one()
+        self.assertEqual(('SUCCESSFUL', True), status)
+
+        release = self.client.get(
+            '/releases/{}'.format(result['id'])).json['releases'][0]
+
+        self.assertEqual(['TICKET-1'], release['references'])
+        self.assertEqual(['a note'], release['notes'])
+        self.assertEqual({'build': '42'}, release['metadata'])
+        self.assertEqual(['test_platform'], release['platforms'])
+        # Finished with the last package
+        self.assertEqual(300, release['duration'])
+        packages = dict((p['name'], p) for p in release['packages'])
+        self.assertEqual(result['packages'],
+                         [packages['first']['id'], packages['second']['id']])
+        self.assertEqual(300, packages['first']['duration'])
+        self.assertEqual(120, packages['second']['duration'])
+        self.assertTrue(packages['second']['rollback'])
+
+    def test_one_commit(self):
+        """
+        Test the document is written in one transaction
+        """
+        commits = []
+
+        def count(session):
+            commits.append(session)
+        event.listen(db.session, 'after_commit', count)
+        try:
+            self._post_document(self.DOCUMENT)
+        finally:
+            event.remove(db.session, 'after_commit', count)
+        self.assertEqual(1, len(commits))
+
+    def test_unfinished(self):
+        """
+        Test a release with unfinished packages is left unfinished
+        """
+        document = dict(self.DOCUMENT, packages=[
+            {'name': 'first', 'version': '1.0.0', 'status': 'IN_PROGRESS'},
+            {'name': 'second', 'version': '1.0.0'},
+        ])
+        result = self._post_document(document)
+        release = db.session.query(Release).get(result['id'])
+        self.assertIsNone(release.ftime)
+        self.assertEqual('IN_PROGRESS', release.status)
+
+    def test_invalid(self):
+        """
+        Test an invalid document is rejected without writing anything
+        """
+        package = self.DOCUMENT['packages'][0]
+        for document in (
+                dict(self.DOCUMENT, user=None),
+                dict(self.DOCUMENT, stime='yesterday'),
+                dict(self.DOCUMENT, packages=[{'name': 'first'}]),
+                dict(self.DOCUMENT, packages=[dict(package, status='DONE')]),
+                dict(self.DOCUMENT, packages=[
+                    dict(package, status='IN_PROGRESS')]),
+                dict(self.DOCUMENT, packages=[
+                    dict(package, ftime='2015-01-01T00:00:00Z')]),
+        ):
+            self._post_document(document, expected_status=400)
+        self.assertEqual(0, db.session.query(Release).count())
+
+
+class TestPostPackagesBatch(OrloHttpTest):
+    """
+    Test the batch package endpoints
+    """
+    def _post_batch(self, release_id, action, packages, expected_status=200):
+        response = self.client.post(
+            '/releases/{}/packages/{}'.format(release_id, action),
+            data=json.dumps({'packages': packages}),
+            content_type='application/json')
+        self.assertEqual(expected_status, response.status_code)
+        return response.json
+
+    def _package_statements(self, func):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith(('INSERT INTO package ', 'UPDATE package ')):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        return statements
+
+    def _batch_release(self, count=3):
+        release_id = self._create_release()
+        results = self._post_batch(release_id, 'batch', [
+            {'name': 'package-{}'.format(i), 'version': '1.0.{}'.format(i)}
+            for i in range(0, count)])['packages']
+        return release_id, [r['id'] for r in results]
+
+    def test_create(self):
+        """
+        Test packages are created in one statement, and invalid ones reported
+        """
+        release_id = self._create_release()
+        results = []
+        statements = self._package_statements(lambda: results.append(
+            self._post_batch(release_id, 'batch', [
+                {'name': 'first', 'version': '1.0.0'},
+                {'name': 'second'},
+                {'name': 'third', 'version': '3.0.0', 'rollback': True},
+            ])['packages']))
+        self.assertEqual(1, len(statements))
+        results = results[0]
+        self.assertEqual([True, False, True], [r['ok'] for r in results])
+        self.assertIn('message', results[1])
+
+        packages = db.session.query(Package.id, Package.name, Package.status) \
+            .filter(Package.release_id == release_id)
+        self.assertEqual(
+            sorted([(uuid.UUID(results[0]['id']), 'first', 'NOT_STARTED'),
+                    (uuid.UUID(results[2]['id']), 'third', 'NOT_STARTED')]),
+            sorted(packages))
+        release = db.session.query(Release).get(release_id)
+        self.assertTrue(release.has_rollback)
+
+    def test_start_stop(self):
+        """
+        Test packages are started and stopped together, and the release status
+        follows them
+        """
+        release_id, package_ids = self._batch_release()
+        statements = self._package_statements(lambda: self._post_batch(
+            release_id, 'start', package_ids[:2]))
+        self.assertEqual(1, len(statements))
+        self.assertEqual(
+            'IN_PROGRESS', db.session.query(Release).get(release_id).status)
+
+        results = self._post_batch(release_id, 'stop', [
+            {'id': package_ids[0], 'success': True},
+            {'id': package_ids[1], 'success': 'false'},
+            {'id': package_ids[2], 'success': True},
+        ])['packages']
+        self.assertEqual([True, True, False], [r['ok'] for r in results])
+
+        packages = dict(db.session.query(Package.id, Package.status)
+                        .filter(Package.release_id == release_id))
+        self.assertEqual(['SUCCESSFUL', 'FAILED', 'NOT_STARTED'],
+                         [packages[uuid.UUID(p)] for p in package_ids])
+        self.assertEqual(
+            'FAILED', db.session.query(Release).get(release_id).status)
+        for package in self.client.get('/packages?release_id={}'.format(
+                release_id)).json['packages']:
+            if package['status'] != 'NOT_STARTED':
+                self.assertIsNotNone(package['duration'])
+
+    def test_current_versions(self):
+        """
+        Test stopping a batch updates the current versions
+        """
+        release_id, package_ids = self._batch_release(count=1)
+        self._post_batch(release_id, 'start', package_ids)
+        self._post_batch(release_id, 'stop',
+                         [{'id': package_ids[0], 'success': True}])
+        response = self.client.get('/info/packages/versions')
+        self.assertEqual('1.0.0', response.json['package-0'])
+
+    def test_unknown_packages(self):
+        """
+        Test packages which are not in the release are reported
+        """
+        release_id, package_ids = self._batch_release(count=1)
+        other_release_id, other_ids = self._batch_release(count=1)
+        results = self._post_batch(release_id, 'start', [
+            package_ids[0], other_ids[0], str(uuid.uuid4()), 'not-a-uuid',
+        ])['packages']
+        self.assertEqual([True, False, False, False],
+                         [r['ok'] for r in results])
+        self.assertEqual('NOT_STARTED', db.session.query(Package.status)
+                         .filter(Package.id == other_ids[0]).scalar())
+
+    def test_invalid(self):
+        """
+        Test invalid batches are rejected
+        """
+        release_id, package_ids = self._batch_release(count=1)
+        self._post_batch(str(uuid.uuid4()), 'start', package_ids,
+                         expected_status=400)
+        self._post_batch(release_id, 'start', [{'id': package_ids[0]}],
+                         expected_status=400)
+        self._post_batch(release_id, 'stop', package_ids,
+                         expected_status=400)
+        response = self.client.post(
+            '/releases/{}/packages/batch'.format(release_id),
+            data=json.dumps({'packages': 'first'}),
+            content_type='application/json')
+        self.assert400(response)
+
+
 class TestGetContract(OrloHttpTest):
     """
     Test the HTTP GET contract
@@ -486,6 +731,80 @@ class TestGetContract(OrloHttpTest):
         for r in first_results['releases']:
             self.assertEqual(r['references'], ['REF'])
 
+    def test_get_release_filter_reference_exact(self):
+        """
+        Test the reference filter matches any one reference exactly
+        """
+        release_id = self._create_release(references=['REF-1', 'REF-12'])
+        self._create_release(references=['REF-123'])
+
+        results = self._get_releases(filters=['reference=REF-12'])
+        self.assertEqual([release_id],
+                         [r['id'] for r in results['releases']])
+        self._get_releases(filters=['reference=REF'], expected_status=404)
+
+    def test_get_release_filter_reference_long(self):
+        """
+        Test a reference too long for an index is stored and filtered on
+        """
+        # Random, as the database would compress a repetitive one
+        reference = 'REF-' + ''.join(uuid.uuid4().hex for _ in range(0, 400))
+        release_id = self._create_release(references=[reference])
+        self._create_release(references=[reference[:-1]])
+
+        results = self._get_releases(filters=['reference=' + reference])
+        self.assertEqual([release_id],
+                         [r['id'] for r in results['releases']])
+
+    def test_get_release_filter_metadata(self):
+        """
+        Test filtering on metadata keys and values
+        """
+        first = self._create_release()
+        self._post_releases_metadata(first, {'build': '12', 'pipeline': 'a'})
+        second = self._create_release()
+        self._post_releases_metadata(second, {'build': '123'})
+        third = self._create_release()
+
+        def ids(*filters):
+            return sorted(r['id'] for r in
+                          self._get_releases(filters=list(filters))['releases'])
+
+        self.assertEqual([first], ids('metadata_build=12'))
+        self.assertEqual([first], ids('metadata_build=12',
+                                      'metadata_pipeline=a'))
+        self.assertEqual(sorted([first, second, third]),
+                         ids('metadata_env=test'))
+        self.assertEqual([third], ids('metadata_build=null'))
+        self._get_releases(filters=['metadata_build=1'], expected_status=404)
+        self._get_releases(filters=['metadata_env=12'], expected_status=404)
+
+    def test_get_release_filter_metadata_long(self):
+        """
+        Test a metadata value too long for an index is stored and filtered on
+        """
+        # Random, as the database would compress a repetitive one
+        value = ''.join(uuid.uuid4().hex for _ in range(0, 400))
+        release_id = self._create_release()
+        self._post_releases_metadata(release_id, {'log': value})
+        self._post_releases_metadata(self._create_release(),
+                                     {'log': value[:-1]})
+
+        results = self._get_releases(filters=['metadata_log=' + value])
+        self.assertEqual([release_id],
+                         [r['id'] for r in results['releases']])
+
+    def test_get_release_filter_metadata_key_characters(self):
+        """
+        Test a metadata key which is not valid in a parameter name
+        """
+        release_id = self._create_release()
+        self._post_releases_metadata(release_id, {'ci job (%)': 'x'})
+        results = self._get_releases(
+            filters=['metadata_ci%20job%20(%25)=x', 'metadata_env=test'])
+        self.assertEqual([release_id],
+                         [r['id'] for r in results['releases']])
+
     def test_get_release_limit_one(self):
         """
         Should return only one release
@@ -527,6 +846,84 @@ class TestGetContract(OrloHttpTest):
         # Last in list should be last to be created
         self.assertEqual(r['releases'][2]['id'], rid)
 
+    def _get_all_pages(self, filters):
+        """
+        Follow the next cursors from the first page, return the ids and pages
+        """
+        ids, pages = [], 0
+        cursor = None
+        while True:
+            page_filters = list(filters)
+            if cursor:
+                page_filters.append('cursor={}'.format(cursor))
+            r = self._get_releases(filters=page_filters)
+            ids.extend(release['id'] for release in r['releases'])
+            pages += 1
+            cursor = r.get('next')
+            if not cursor:
+                return ids, pages
+
+    def test_get_release_cursor(self):
+        """
+        Test following the next cursor returns every release once, in order
+        """
+        rids = [self._create_release() for _ in range(0, 5)]
+        ids, pages = self._get_all_pages(['limit=2'])
+        self.assertEqual(3, pages)
+        self.assertEqual(set(rids), set(ids))
+        all_ids = [r['id'] for r in self._get_releases()['releases']]
+        self.assertEqual(all_ids, ids)
+
+    def test_get_release_cursor_asc(self):
+        """
+        Test the cursor pages in ascending order
+        """
+        for _ in range(0, 4):
+            self._create_release()
+        ids, pages = self._get_all_pages(['limit=2', 'asc=true'])
+        # Exactly two full pages, so no next on the second
+        self.assertEqual(2, pages)
+        all_ids = [r['id'] for r in
+                   self._get_releases(filters=['asc=true'])['releases']]
+        self.assertEqual(all_ids, ids)
+
+    def test_get_release_cursor_with_filter(self):
+        """
+        Test the cursor pages through filtered releases
+        """
+        rids = [self._create_release(user='pageuser') for _ in range(0, 3)]
+        self._create_release(user='otheruser')
+        ids, pages = self._get_all_pages(['limit=1', 'user=pageuser'])
+        self.assertEqual(3, pages)
+        self.assertEqual(sorted(rids), sorted(ids))
+
+    def test_get_release_no_next_when_complete(self):
+        """
+        Test there is no next cursor when all releases fit in the page
+        """
+        self._create_release()
+        r = self._get_releases(filters=['limit=2'])
+        self.assertNotIn('next', r)
+
+    def test_get_release_cursor_with_offset(self):
+        """
+        Test cursor and offset can not be combined
+        """
+        self._create_release()
+        self._create_release()
+        r = self._get_releases(filters=['limit=1'])
+        self._get_releases(
+            filters=['cursor={}'.format(r['next']), 'offset=1'],
+            expected_status=400)
+
+    def test_get_release_invalid_cursor(self):
+        """
+        Test an invalid cursor is a 400
+        """
+        self._create_release()
+        self._get_releases(filters=['cursor=notacursor'],
+                           expected_status=400)
+
     def test_get_release_package_name(self):
         """
         Filter on releases which have a particular package name
@@ -725,3 +1122,101 @@ class TestGetContract(OrloHttpTest):
             notes
         )
 
+
+class TestGetQueryCount(OrloHttpTest):
+    """
+    Test the number of queries to serve a page of releases
+    """
+    def _create_full_release(self):
+        release_id = self._create_release()
+        for name in ('package-one', 'package-two'):
+            self._create_package(release_id, name=name)
+        return release_id
+
+    def _count_queries(self, path):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = self.client.get(path)
+            # The body is streamed, read it while counting
+            doc = json.loads(response.get_data(as_text=True))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assert200(response)
+        return len(statements), doc
+
+    def test_query_count_independent_of_page_size(self):
+        """
+        Test a page of many releases takes as many queries as a page of one
+        """
+        for _ in range(0, 5):
+            self._create_full_release()
+        one, _ = self._count_queries('/releases?limit=1')
+        five, doc = self._count_queries('/releases?limit=5')
+        self.assertEqual(5, len(doc['releases']))
+        self.assertEqual(one, five)
+
+    def test_query_count(self):
+        """
+        Test the releases are queried once, then each relationship once
+        """
+        for _ in range(0, 3):
+            self._create_full_release()
+        count, _ = self._count_queries('/releases')
+        # Releases, then packages, platforms, notes, references and metadata
+        self.assertEqual(6, count)
+
+    def test_no_results_query_count(self):
+        """
+        Test a 404 takes only the one query
+        """
+        self._create_full_release()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = self.client.get('/releases?user=nobody')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assert404(response)
+        self.assertEqual(1, len(statements))
+
+    def test_relationships_loaded(self):
+        """
+        Test the batch loaded relationships are serialized as before
+        """
+        release_id = self._create_full_release()
+        doc = self.client.get('/releases').json['releases'][0]
+        expected = db.session.query(Release).get(release_id).to_dict()
+        self.assertEqual(expected['platforms'], doc['platforms'])
+        self.assertEqual(expected['notes'], doc['notes'])
+        self.assertEqual(expected['references'], doc['references'])
+        self.assertEqual(expected['metadata'], doc['metadata'])
+        self.assertEqual(
+            sorted(p['id'] for p in expected['packages']),
+            sorted(p['id'] for p in doc['packages']))
+
+    def test_chunks(self):
+        """
+        Test pages spanning several chunks are complete and in order
+        """
+        for _ in range(0, 5):
+            self._create_full_release()
+        expected = [r['id'] for r in
+                    self.client.get('/releases').json['releases']]
+        with patch('orlo.util.STREAM_CHUNK_SIZE', 2):
+            doc = self.client.get('/releases?limit=4').json
+            self.assertEqual(expected[:4],
+                             [r['id'] for r in doc['releases']])
+            doc = self.client.get(
+                '/releases?limit=4&cursor={}'.format(doc['next'])).json
+        self.assertEqual(expected[4:], [r['id'] for r in doc['releases']])
+        self.assertEqual(2, len(doc['releases'][0]['packages']))
+
@@ -99,6 +99,16 @@ class TestTeamStats(TestStats):
         response = self.client.get(self.ENDPOINT + '/test%20team')
         self.assertIsInstance(response.json, dict)
 
+    def test_stats_team_without_team(self):
+        """
+        Test releases without a team are counted under null
+        """
+        self._create_release(team=None)
+        response = self.client.get(self.ENDPOINT)
+        self.assert200(response)
+        self.assertIn('null', response.json)
+        self.assertIn('test team', response.json)
+
 
 class TestPlatformStats(TestStats):
     ENDPOINT = '/stats/platform'
@@ -197,6 +207,20 @@ class TestStatsByDateRelease(TestStats):
         self.assert200(response)
         self.assertEqual({}, response.json)
 
+    def test_stats_by_date_with_tz(self):
+        """
+        Test /stats/by_date with a time zone
+        """
+        response = self.client.get(self.ENDPOINT + '?unit=hour&tz=Asia/Kolkata')
+        self.assert200(response)
+
+    def test_stats_by_date_with_invalid_tz(self):
+        """
+        Test /stats/by_date with an unknown time zone returns 400
+        """
+        response = self.client.get(self.ENDPOINT + '?tz=Bad/Zone')
+        self.assert400(response)
+
 
 class TestStatsByDatePackage(OrloDbTest):
     """
@@ -231,3 +255,99 @@ class TestStatsByDatePackage(OrloDbTest):
         year = str(arrow.utcnow().year)
         month = str(arrow.utcnow().month)
         self.assertIn('test-package', response.json[year][month])
+
+
+class TestStatsDurations(OrloDbTest):
+    """
+    Testing the "durations" urls
+    """
+    ENDPOINT = '/stats/durations'
+
+    def setUp(self):
+        super(OrloDbTest, self).setUp()
+        for r in range(0, 3):
+            self._create_finished_release()
+
+    def test_stats_durations(self):
+        """
+        Test /stats/durations returns percentiles
+        """
+        response = self.client.get(self.ENDPOINT)
+        self.assert200(response)
+        self.assertEqual(3, response.json['count'])
+        self.assertIn('p95', response.json)
+
+    def test_stats_durations_package_by_platform(self):
+        """
+        Test /stats/durations/package grouped by platform
+        """
+        response = self.client.get(self.ENDPOINT + '/package?group_by=platform')
+        self.assert200(response)
+        self.assertEqual(3, response.json['test_platform']['count'])
+
+    def test_stats_durations_by_time(self):
+        """
+        Test /stats/durations grouped by time, with a filter
+        """
+        response = self.client.get(
+            self.ENDPOINT + '?group_by=time&unit=day&summarize_by_unit=1'
+            '&platform=test_platform')
+        self.assert200(response)
+        self.assertIn(str(arrow.utcnow().day), response.json)
+
+    def test_stats_durations_bad_subject(self):
+        """
+        Test /stats/durations with an unknown subject returns 400
+        """
+        response = self.client.get(self.ENDPOINT + '/foo')
+        self.assert400(response)
+
+
+class TestStatsDora(OrloDbTest):
+    """
+    Testing the "dora" url
+    """
+    ENDPOINT = '/stats/dora'
+
+    def setUp(self):
+        super(OrloDbTest, self).setUp()
+        for r in range(0, 3):
+            self._create_finished_release()
+
+    def test_stats_dora(self):
+        """
+        Test /stats/dora returns the metrics
+        """
+        response = self.client.get(self.ENDPOINT + '?window=30')
+        self.assert200(response)
+        self.assertEqual(3, response.json['deployments'])
+        self.assertEqual(0, response.json['change_failure_rate'])
+
+    def test_stats_dora_by_platform(self):
+        """
+        Test /stats/dora grouped by platform
+        """
+        response = self.client.get(self.ENDPOINT + '?group_by=platform')
+        self.assert200(response)
+        self.assertEqual(3, response.json['test_platform']['deployments'])
+
+    def test_stats_dora_without_team(self):
+        """
+        Test releases without a team are grouped under null
+        """
+        release_id = self._create_release(team=None)
+        package_id = self._create_package(release_id)
+        self._start_package(package_id)
+        self._stop_package(package_id)
+        self._stop_release(release_id)
+        response = self.client.get(self.ENDPOINT + '?group_by=team')
+        self.assert200(response)
+        self.assertEqual(1, response.json['null']['deployments'])
+        self.assertEqual(3, response.json['test team']['deployments'])
+
+    def test_stats_dora_bad_window(self):
+        """
+        Test /stats/dora with a bad window returns 400
+        """
+        response = self.client.get(self.ENDPOINT + '?window=foo')
+        self.assert400(response)
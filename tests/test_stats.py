@@ -1,4 +1,5 @@
 from __future__ import print_function, unicode_literals
+import datetime
 import arrow
 import orlo.queries
 import orlo.exceptions
@@ -48,6 +49,15 @@ class TestGeneral(OrloStatsTest):
         orlo.stats.append_tree_recursive(tree, nodes[0], nodes)
         self.assertEqual(tree, {'parent': {'child': 2}})
 
+    def test_append_tree(self):
+        """
+        Test that append_tree adds the count given to the leaf
+        """
+        tree = {'parent': {'other': 1}}
+        orlo.stats.append_tree(tree, ['parent', 'child', 'leaf'], count=3)
+        orlo.stats.append_tree(tree, ['parent', 'child', 'leaf'])
+        self.assertEqual(tree, {'parent': {'other': 1, 'child': {'leaf': 4}}})
+
 
 class TestReleaseTime(OrloStatsTest):
     """
@@ -122,6 +132,52 @@ class TestReleaseTime(OrloStatsTest):
     def test_release_time_with_unit_day(self):
         pass
 
+    def test_release_time_iso(self):
+        """
+        Test stats.add_objects_by_time_to_dict by iso calendar
+        """
+        result = orlo.stats.releases_by_time('iso', **self.ARGS)
+        year, week, day = [str(i) for i in arrow.utcnow().isocalendar()]
+        self.assertEqual(7, result[year][week][day]['normal']['successful'])
+
+    def test_release_time_with_tz(self):
+        """
+        Test stats.add_objects_by_time_to_dict breaks down in the time zone given
+        """
+        result = orlo.stats.releases_by_time('hour', tz='Asia/Kolkata', **self.ARGS)
+        now = arrow.utcnow().to('Asia/Kolkata')
+        self.assertEqual(
+            7,
+            result[str(now.year)][str(now.month)][str(now.day)][str(now.hour)]
+            ['normal']['successful'],
+        )
+
+    def test_release_time_invalid_unit(self):
+        """
+        Test an invalid unit raises InvalidUsage
+        """
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.stats.releases_by_time('fortnight', **self.ARGS)
+
+    def test_python_time_parts_match_db(self):
+        """
+        Test the time parts worked out in python match those from the database
+        """
+        for unit in orlo.stats.TIME_UNIT_PARTS:
+            from_db = orlo.stats.releases_by_time(unit, **self.ARGS)
+            query = orlo.queries.apply_filters(
+                orlo.stats.db.session.query(
+                    orlo.stats.Release.id, orlo.stats.Release.stime),
+                self.ARGS)
+            from_python = {}
+            for release in query:
+                parts = orlo.stats.python_time_parts(
+                    release.stime, orlo.stats.TIME_UNIT_PARTS[unit])
+                orlo.stats.append_tree_recursive(
+                    from_python, str(parts[0]),
+                    [str(p) for p in parts] + ['normal', 'successful'])
+            self.assertEqual(from_python, from_db)
+
 
 class TestPackageTime(OrloStatsTest):
     """
@@ -194,3 +250,158 @@ class TestPackageTime(OrloStatsTest):
 
     def test_package_time_with_unit_day(self):
         pass
+
+
+class TestTimeCategories(OrloStatsTest):
+    """
+    Test objects are placed under the right categories by time
+    """
+    def setUp(self):
+        super(TestTimeCategories, self).setUp()
+        self._create_finished_release(success=False)
+
+        # Rollback release with two packages, one of which is a rollback
+        release_id = self._create_release()
+        for rollback in (True, False):
+            package_id = self._create_package(
+                release_id, name='rollback-package', rollback=rollback)
+            self._start_package(package_id)
+            self._stop_package(package_id, success=False)
+
+        # In progress
+        release_id = self._create_release()
+        self._start_package(self._create_package(release_id))
+
+    def test_release_time_categories(self):
+        """
+        Test releases are counted once under their category
+        """
+        result = orlo.stats.releases_by_time('year', **self.ARGS)
+        year = str(arrow.utcnow().year)
+        self.assertEqual(
+            {'normal': {'successful': 7, 'failed': 1},
+             'rollback': {'failed': 1}},
+            result[year])
+
+    def test_package_time_categories(self):
+        """
+        Test packages are counted under the category of their release
+        """
+        result = orlo.stats.packages_by_time('year', **self.ARGS)
+        year = str(arrow.utcnow().year)
+        self.assertEqual(
+            {'test-package': {'normal': {'successful': 7, 'failed': 1}},
+             'rollback-package': {'rollback': {'failed': 2}}},
+            result[year])
+
+
+class TestDurationPercentiles(OrloStatsTest):
+    """
+    Test stats.duration_percentiles
+    """
+    def setUp(self):
+        super(TestDurationPercentiles, self).setUp()
+        # Durations of 10, 20, ... 70 seconds
+        releases = orlo.stats.db.session.query(orlo.stats.Release) \
+            .order_by(orlo.stats.Release.stime)
+        for i, release in enumerate(releases):
+            release.duration = datetime.timedelta(seconds=(i + 1) * 10)
+            for package in release.packages:
+                package.duration = datetime.timedelta(seconds=(i + 1))
+        orlo.stats.db.session.commit()
+
+    def test_release_percentiles(self):
+        """
+        Test percentiles are interpolated between durations
+        """
+        result = orlo.stats.duration_percentiles('release', **self.ARGS)
+        self.assertEqual(7, result['count'])
+        self.assertEqual(40, result['p50'])
+        self.assertAlmostEqual(64, result['p90'])
+        self.assertAlmostEqual(69.4, result['p99'])
+
+    def test_package_percentiles_by_package(self):
+        """
+        Test package percentiles grouped by package name
+        """
+        result = orlo.stats.duration_percentiles(
+            'package', group_by='package', **self.ARGS)
+        self.assertEqual(['test-package'], list(result.keys()))
+        self.assertEqual(4, result['test-package']['p50'])
+
+    def test_percentiles_by_time(self):
+        """
+        Test percentiles grouped by time
+        """
+        result = orlo.stats.duration_percentiles(
+            'release', group_by='time', unit='year', **self.ARGS)
+        self.assertEqual(40, result[str(arrow.utcnow().year)]['p50'])
+
+    def test_percentiles_no_releases(self):
+        """
+        Test percentiles are None when nothing matches
+        """
+        result = orlo.stats.duration_percentiles('release', user='nobody')
+        self.assertEqual(0, result['count'])
+        self.assertIsNone(result['p50'])
+
+    def test_percentiles_bad_group_by(self):
+        """
+        Test grouping by an unknown field raises InvalidUsage
+        """
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.stats.duration_percentiles('release', group_by='colour')
+
+
+class TestDoraMetrics(OrloStatsTest):
+    """
+    Test stats.dora_metrics
+    """
+    def setUp(self):
+        super(TestDoraMetrics, self).setUp()
+        # Two failures then a fix, 10 and 20 minutes apart, then an open
+        # failure
+        base = arrow.utcnow().replace(hours=-2)
+        for minutes, success in ((0, False), (10, False), (30, True),
+                                 (40, False)):
+            release_id = self._create_release()
+            package_id = self._create_package(release_id, name='flaky')
+            self._start_package(package_id)
+            self._stop_package(package_id, success=success)
+            package = orlo.stats.db.session.query(orlo.stats.Package) \
+                .filter(orlo.stats.Package.id == package_id).one()
+            package.stime = base.replace(minutes=minutes)
+            package.ftime = base.replace(minutes=minutes + 1)
+            release = package.release
+            release.stime = package.stime
+        orlo.stats.db.session.commit()
+
+    def test_dora_metrics(self):
+        """
+        Test the metrics over all releases
+        """
+        result = orlo.stats.dora_metrics(window=10)
+        self.assertEqual(11, result['deployments'])
+        self.assertEqual(3, result['change_failures'])
+        self.assertAlmostEqual(1.1, result['deployment_frequency'])
+        self.assertAlmostEqual(3 / 11.0, result['change_failure_rate'])
+        self.assertEqual(1, result['restores'])
+        self.assertEqual(30 * 60, result['mean_time_to_restore'])
+
+    def test_dora_metrics_by_package(self):
+        """
+        Test the metrics grouped by package
+        """
+        result = orlo.stats.dora_metrics(group_by='package')
+        self.assertEqual(7, result['test-package']['deployments'])
+        self.assertIsNone(result['test-package']['mean_time_to_restore'])
+        self.assertEqual(4, result['flaky']['deployments'])
+        self.assertEqual(0.75, result['flaky']['change_failure_rate'])
+        self.assertEqual(30 * 60, result['flaky']['mean_time_to_restore'])
+
+    def test_dora_metrics_bad_group_by(self):
+        """
+        Test grouping by an unknown field raises InvalidUsage
+        """
+        with self.assertRaises(orlo.exceptions.InvalidUsage):
+            orlo.stats.dora_metrics(group_by='user')